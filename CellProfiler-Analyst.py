@@ -540,6 +540,9 @@ class CPAnalyst(wx.App):
 
 
 if __name__ == "__main__":    
+    # Needed by the worker processes of frozen builds (eg: SQLite import)
+    import multiprocessing
+    multiprocessing.freeze_support()
     # Initialize the app early because the fancy exception handler
     # depends on it in order to show a 
     app = CPAnalyst(redirect=False)
@@ -182,7 +182,7 @@ class DataSourcePanel(wx.Panel):
         if fltr is not None:
             q.add_filter(fltr)
 
-        res = db.execute(str(q))
+        res = db.execute_cached(str(q))
         res = np.array(res, dtype=object)
         # replaces Nones with NaNs
         for row in res:
@@ -19,7 +19,9 @@ from trainingset import TrainingSet
 from cStringIO import StringIO
 from time import time
 import icons
+import crossvalidation
 import dbconnect
+import multiclasssql
 import dirichletintegrate
 import imagetools
 import polyafit
@@ -27,6 +29,7 @@ import sortbin
 import logging
 import numpy as np
 import os
+import threading
 import wx
 import re
 import cpa.helpmenu
@@ -85,6 +88,8 @@ class Classifier(wx.Frame):
         self.pmb = None
         self.worker = None
         self.trainingSet = None
+        self.predictionIndex = None   # see StartPredictionIndex
+        self.predictionIndexGeneration = 0
         self.classBins = []
         self.binsCreated = 0
         self.chMap = p.image_channel_colors[:]
@@ -435,6 +440,7 @@ class Classifier(wx.Frame):
 
         # Make sure the classifier is cleared before running a new training session
         self.algorithm.ClearModel()
+        self.InvalidatePredictionIndex()
 
         # Update the classBins in the model
         self.algorithm.UpdateBins(self.classBins)
@@ -782,6 +788,7 @@ class Classifier(wx.Frame):
         self.algorithm.UpdateBins([])
         if clearModel:
             self.algorithm.ClearModel()
+            self.InvalidatePredictionIndex()
         self.rules_text.SetValue('')
         for bin in self.classBins:
             bin.trained = False
@@ -963,6 +970,28 @@ class Classifier(wx.Frame):
                                                                                         zip(colNames, groupKey)])))
                         return
 
+            if fltr_sel == 'experiment':
+                loopMsg = ' from whole experiment'
+            elif fltr_sel == 'image':
+                loopMsg = ' from image %s' % (imKey,)
+            elif fltr_sel in p._filters_ordered:
+                loopMsg = ' from filter %s' % (fltr_sel)
+            elif fltr_sel in p._groups_ordered:
+                loopMsg = ' from group %s: %s' % (fltr_sel,
+                                                  ', '.join(
+                                                      ['%s=%s' % (n, v) for n, v in zip(colNames, groupKey)]))
+
+            # Draw the objects from the prediction index if it is ready
+            index = self.predictionIndex
+            if index is not None and (obClassName != 'uncertain' or index.has_probabilities()):
+                scope = None if fltr_sel == 'experiment' else filteredImKeys
+                if obClassName == 'uncertain':
+                    obKeys = index.most_uncertain(nObjects, scope)
+                else:
+                    obKeys = index.sample(obClass, nObjects, scope)
+                nObjects = len(obKeys)
+                statusMsg = 'Fetched %d %s %s' % (nObjects, obClassName, p.object_name[1])
+
             total_attempts = attempts = 0
             # Now check which objects fall within the classification
             while len(obKeys) < nObjects:
@@ -976,23 +1005,14 @@ class Classifier(wx.Frame):
                         obKeysToTry = 'ABS(RANDOM()) %% %s < 100' % (dm.get_total_object_count())
                     else:
                         obKeysToTry = dm.GetRandomObjects(100)
-                    loopMsg = ' from whole experiment'
                 elif fltr_sel == 'image':
                     # All objects are tried in first pass
                     if attempts > 0:
                         break
-                    imKey = self.GetGroupKeyFromGroupSizer()
                     obKeysToTry = [imKey]
-                    loopMsg = ' from image %s' % (imKey,)
                 else:
                     obKeysToTry = dm.GetRandomObjects(100, filteredImKeys)
                     obKeysToTry.sort()
-                    if fltr_sel in p._filters_ordered:
-                        loopMsg = ' from filter %s' % (fltr_sel)
-                    elif fltr_sel in p._groups_ordered:
-                        loopMsg = ' from group %s: %s' % (fltr_sel,
-                                                          ', '.join(
-                                                              ['%s=%s' % (n, v) for n, v in zip(colNames, groupKey)]))
 
                 self.PostMessage('Classifying %s.' % (p.object_name[1]))
 
@@ -1094,6 +1114,7 @@ class Classifier(wx.Frame):
         finally:
             self.UpdateClassChoices()
             self.keysAndCounts = None
+            self.InvalidatePredictionIndex()
 
 
 
@@ -1124,17 +1145,18 @@ class Classifier(wx.Frame):
         '''
         dlg = wx.FileDialog(self, "Select the file containing your classifier training set.",
                             defaultDir=os.getcwd(),
-                            wildcard='Text files (*.txt)|*.txt|CSV files (*.csv)|*.csv',
+                            wildcard='Text files (*.txt)|*.txt|CSV files (*.csv)|*.csv|'
+                                     'Binary training sets (*.npz)|*.npz',
                             style=wx.OPEN | wx.FD_CHANGE_DIR)
         if dlg.ShowModal() == wx.ID_OK:
             filename = dlg.GetPath()
             name, file_extension = os.path.splitext(filename)
-            if '.txt' == file_extension: 
+            if file_extension in ['.txt', '.npz']:
                 self.LoadTrainingSet(filename)
             elif '.csv' == file_extension:
                 self.LoadTrainingSetCSV(filename)
             else:
-                logging.error("Couldn't load the file! Make sure it is .txt or .csv")
+                logging.error("Couldn't load the file! Make sure it is .txt, .csv or .npz")
 
     # def OnLoadFullTrainingSet(self, evt):
     #     '''
@@ -1166,7 +1188,7 @@ class Classifier(wx.Frame):
 
             keysPerBin = {}
             for (label, key) in self.trainingSet.entries:
-                keysPerBin[label] = keysPerBin.get(label, []) + [key]
+                keysPerBin.setdefault(label, []).append(key)
 
             num_objs = 0
             for bin in self.classBins:
@@ -1195,7 +1217,7 @@ class Classifier(wx.Frame):
 
             keysPerBin = {}
             for (label, key) in self.trainingSet.entries:
-                keysPerBin[label] = keysPerBin.get(label, []) + [key]
+                keysPerBin.setdefault(label, []).append(key)
 
             num_objs = 0
             for bin in self.classBins:
@@ -1215,15 +1237,18 @@ class Classifier(wx.Frame):
             self.defaultTSFileName = 'MyTrainingSet.csv'
         saveDialog = wx.FileDialog(self, message="Save as:", defaultDir=os.getcwd(),
                                    defaultFile=self.defaultTSFileName,
-                                   wildcard='Text files (*.csv)|*.csv|All files (*.*)|*.*',
+                                   wildcard='Text files (*.csv)|*.csv|'
+                                            'Binary training sets (*.npz)|*.npz|All files (*.*)|*.*',
                                    style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT | wx.FD_CHANGE_DIR)
         if saveDialog.ShowModal() == wx.ID_OK:
             filename = saveDialog.GetPath()
             self.defaultTSFileName = os.path.split(filename)[1]
-            self.SaveTrainingSetAsCSV(filename)
+            if os.path.splitext(filename)[1] == '.npz':
+                self.SaveTrainingSetAsBinary(filename)
+            else:
+                self.SaveTrainingSetAsCSV(filename)
 
-    def SaveTrainingSetAsCSV(self, filename):
-        classDict = {}
+    def UpdateTrainingSetForSave(self):
         trainingSet = self.trainingSet # Create Save Copy
         try:
             self.trainingSet = TrainingSet(p)
@@ -1231,8 +1256,15 @@ class Classifier(wx.Frame):
         except:
             logging.info("Couldn't update TrainingSet. Using last AutoSave.")
             self.trainingSet = trainingSet # Use backup
+
+    def SaveTrainingSetAsCSV(self, filename):
+        self.UpdateTrainingSetForSave()
         self.trainingSet.SaveAsCSV(filename)
 
+    def SaveTrainingSetAsBinary(self, filename):
+        self.UpdateTrainingSetForSave()
+        self.trainingSet.SaveBinary(filename)
+
     def OnAddSortClass(self, evt):
         label = 'class_' + str(self.binsCreated)
         self.AddSortClass(label)
@@ -1398,6 +1430,7 @@ class Classifier(wx.Frame):
             return
 
         self.keysAndCounts = None  # Must erase current keysAndCounts so they will be recalculated from new rules
+        self.InvalidatePredictionIndex()
 
         if not self.UpdateTrainingSet():
             return
@@ -1448,6 +1481,51 @@ class Classifier(wx.Frame):
             else:
                 bin.trained = False
         self.UpdateClassChoices()#
+        self.StartPredictionIndex()
+
+    def InvalidatePredictionIndex(self):
+        '''
+        Discards the prediction index, and stops building it if it is being
+        built, because the model has changed.
+        '''
+        self.predictionIndexGeneration += 1
+        self.predictionIndex = None
+
+    def StartPredictionIndex(self):
+        '''
+        Classifies every object with the trained model in a background
+        thread, so OnFetch can draw objects of a class from the results
+        (see multiclasssql.PredictionIndex) instead of classifying random
+        objects until it finds enough.
+        '''
+        self.InvalidatePredictionIndex()
+        generation = self.predictionIndexGeneration
+        algorithm = self.algorithm
+
+        def cb(frac):
+            if generation != self.predictionIndexGeneration:
+                raise StopCalculating()
+
+        def build():
+            try:
+                t1 = time()
+                index = algorithm.BuildPredictionIndex(cb=cb)
+                if generation == self.predictionIndexGeneration:
+                    self.predictionIndex = index
+                    logging.info('Classified %d %s for fetching in %.2fs.'
+                                 % (len(index), p.object_name[1], time() - t1))
+            except StopCalculating:
+                pass
+            except Exception as e:
+                logging.warn('Could not classify every object for fetching: %s' % (e))
+            finally:
+                # return the thread's connection to the pool
+                db.ReleaseConnection()
+
+        thread = threading.Thread(target=build)
+        thread.setName('PredictionIndex_%s' % (thread.getName()))
+        thread.setDaemon(True)
+        thread.start()
 
     def OnScoreImage(self, evt):
         self.UpdateTrainingSet()
@@ -1576,10 +1654,27 @@ class Classifier(wx.Frame):
             # into phenotype classes and count phenotype-hits per-image.
             self.lastScoringFilter = filter
 
+            overwrite_class_table = False
+            classes_saved = False
+            incremental = False
+            class_names = [bin.label for bin in self.classBins]
             if p.class_table:
                 overwrite_class_table = True
+                if self.algorithm.name != "FastGentleBoosting":
+                    # If this classifier already scored some images into
+                    # p.class_table, offer to score just the other images.
+                    scored = multiclasssql.scored_images(multiclasssql.model_fingerprint(self.algorithm, class_names))
+                    if scored:
+                        dlg = wx.MessageDialog(self,
+                                               'The database table "%s" already holds the classes this classifier '
+                                               'gave the %s in %d images. Score only the images that have not been '
+                                               'scored yet?' % (p.class_table, p.object_name[1], len(scored)),
+                                               'Score new images only?',
+                                               wx.YES_NO | wx.YES_DEFAULT | wx.ICON_QUESTION)
+                        incremental = (dlg.ShowModal() == wx.ID_YES)
+                        dlg.Destroy()
                 # If p.class_table is already in the db, we need to confirm whether or not to overwrite it.
-                if db.table_exists(p.class_table):
+                if not incremental and db.table_exists(p.class_table):
                     dlg = wx.MessageDialog(self,
                                            'The database table "%s" already exists. Overwrite '
                                            'this table with new per-object class data?' % (p.class_table),
@@ -1604,6 +1699,13 @@ class Classifier(wx.Frame):
                 # Adapter Pattern to switch between Legacy code and SciKit Learn
                 if self.algorithm.name == "FastGentleBoosting":
                     self.keysAndCounts = self.algorithm.PerImageCounts(filter_name=filter, cb=update)
+                elif overwrite_class_table:
+                    # Classes are saved while the objects are being counted,
+                    # along with the counts, so that later only new images
+                    # need to be scored.
+                    self.keysAndCounts = multiclasssql.IncrementalPerImageCounts(
+                        self.algorithm, class_names, filter, update, rescore=not incremental)
+                    classes_saved = True
                 else:
                     number_of_classes = self.GetNumberOfClasses()
                     self.keysAndCounts = self.algorithm.PerImageCounts(number_of_classes, filter, update)
@@ -1624,8 +1726,9 @@ class Classifier(wx.Frame):
                 return
 
             if p.class_table and overwrite_class_table:
-                self.PostMessage('Saving %s classes to database...' % (p.object_name[0]))
-                self.algorithm.CreatePerObjectClassTable([bin.label for bin in self.classBins])
+                if not classes_saved:
+                    self.PostMessage('Saving %s classes to database...' % (p.object_name[0]))
+                    self.algorithm.CreatePerObjectClassTable(class_names)
                 self.PostMessage('%s classes saved to table "%s"' % (p.object_name[0].capitalize(), p.class_table))
 
         t2 = time()
@@ -2081,7 +2184,7 @@ class Classifier(wx.Frame):
     def Destroy(self):
         ''' Kill off all threads before combusting. '''
         super(Classifier, self).Destroy()
-        import threading
+        self.InvalidatePredictionIndex()
         for thread in threading.enumerate():
             if thread != threading.currentThread() and thread.getName().lower().startswith('tileloader'):
                 logging.debug('Aborting thread %s' % thread.getName())
@@ -2237,7 +2340,7 @@ class Classifier(wx.Frame):
         plt.show()
 
     def PlotLearningCurve(self,estimator, plot_title, X, y, ylim=None, cv=None,
-                        n_jobs=1, train_sizes=np.linspace(0.1, 1.0, 5),
+                        n_jobs=None, train_sizes=np.linspace(0.1, 1.0, 5),
                         scoring=None):
         """
         Generate a simple plot of the test and training learning curve.
@@ -2264,12 +2367,32 @@ class Classifier(wx.Frame):
         cv : integer, cross-validation generator, optional
             If an integer is passed, it is the number of folds (defaults to 3).
             Specific cross-validation objects can be passed, see
-            sklearn.cross_validation module for the list of possible objects
+            sklearn.model_selection module for the list of possible objects
 
         n_jobs : integer, optional
-            Number of jobs to run in parallel (default 1).
+            Number of processes to fit in (default: that of the algorithm,
+            see crossvalidation.run_folds).
         """    
-        from sklearn.learning_curve import learning_curve
+        from sklearn.model_selection import StratifiedKFold
+        if cv is None or isinstance(cv, int):
+            cv = StratifiedKFold(n_splits=cv or 3)
+        if n_jobs is None:
+            n_jobs = getattr(self.algorithm, 'n_jobs', 1)
+
+        dlg = wx.ProgressDialog('Computing learning curve...', '0% Complete', 100, self,
+                                wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
+        def cb(frac):
+            cont, skip = dlg.Update(int(frac * 100.), '%d%% Complete' % (frac * 100.))
+            if not cont:
+                raise StopCalculating()
+        try:
+            train_sizes, train_scores, test_scores = crossvalidation.learning_curve(
+                estimator, X, y, cv, train_sizes, scoring=scoring, n_jobs=n_jobs, cb=cb)
+        except StopCalculating:
+            self.PostMessage('User canceled the learning curve.')
+            return
+        finally:
+            dlg.Destroy()
         
         plt.figure()
         plt.title(plot_title)
@@ -2277,10 +2400,6 @@ class Classifier(wx.Frame):
             plt.ylim(*ylim)
         plt.xlabel("Training examples")
         plt.ylabel("Cost = 1 - Score")
-        train_sizes, train_scores, test_scores = learning_curve(estimator, X, y,
-                                                                cv=cv, n_jobs=n_jobs,
-                                                                train_sizes=train_sizes,
-                                                                scoring=scoring)
         train_scores_mean = np.mean(train_scores, axis=1)
         train_scores_std = np.std(train_scores, axis=1)
         test_scores_mean = np.mean(test_scores, axis=1)
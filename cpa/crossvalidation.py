@@ -0,0 +1,183 @@
+'''
+Runs the folds of a cross-validation in a pool of worker processes.
+
+A fold is evaluated by a task, a module-level function task(data, fold)
+where data is everything shared by the folds (eg: the training set), sent
+to each worker process once, and fold is what tells the folds apart (eg:
+the indices of the examples held out).  run_folds yields the result of each
+fold as soon as it is finished, so callers can show progress fold by fold,
+and stops the workers if the caller's callback raises an exception.
+'''
+from __future__ import print_function
+import cPickle
+import logging
+import numpy as np
+from sklearn.base import clone
+from sklearn.metrics import get_scorer
+
+
+class StopEvaluation(Exception):
+    '''Raised by progress callbacks to cancel an evaluation.'''
+    pass
+
+
+def default_num_jobs():
+    '''
+    Number of processes to evaluate folds in: one per CPU but one, which is
+    left for the user interface.  On a single CPU folds are evaluated in
+    the calling process.
+    '''
+    try:
+        import multiprocessing
+        return max(multiprocessing.cpu_count() - 1, 1)
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+_process_task = None
+_process_data = None
+
+def _init_fold_process(task, data):
+    global _process_task, _process_data
+    _process_task = task
+    _process_data = data
+
+def _run_fold_in_process(indexed_fold):
+    i, fold = indexed_fold
+    return i, _process_task(_process_data, fold)
+
+def _make_pool(task, data, n_jobs):
+    try:
+        cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+        from multiprocessing import Pool
+        return Pool(n_jobs, _init_fold_process, (task, data))
+    except Exception as e:
+        logging.info('Could not start cross-validation processes, evaluating '
+                     'the folds in this process instead: %s'%(e))
+        return None
+
+class FoldPool(object):
+    '''
+    Worker processes for several runs of run_folds with the same task and
+    data (eg: repeated cross-validations of a training set), so the data is
+    sent to the processes, and anything derived from it prepared, only
+    once.  With n_jobs <= 1 (or data that can't be pickled) the folds are
+    evaluated in the calling process.  Close the pool when done, or use it
+    in a with statement; it must be closed if a run was canceled, since the
+    rest of its folds are still being evaluated.
+    '''
+    def __init__(self, task, data, n_jobs):
+        self.task = task
+        self.data = data
+        self.n_jobs = n_jobs
+        self.pool = _make_pool(task, data, n_jobs) if n_jobs > 1 else None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def run_folds(task, data, folds, n_jobs=1, cb=None, pool=None):
+    '''
+    Yields (i, task(data, folds[i])) for each fold, in the order they are
+    finished.  With n_jobs > 1 the folds are evaluated in that many worker
+    processes (unless data can't be pickled), otherwise one after the other
+    in this process.
+    cb -- callback function called with the fraction of folds finished
+        after each fold.  It may raise an exception to cancel, which stops
+        the worker processes.
+    pool -- a FoldPool of task and data to evaluate the folds with, instead
+        of starting n_jobs processes (and stopping them when done)
+    '''
+    folds = list(folds)
+    own_pool = pool is None
+    if own_pool:
+        pool = FoldPool(task, data, min(n_jobs, len(folds)) if len(folds) > 1 else 1)
+    try:
+        if pool.pool is None:
+            results = ((i, pool.task(pool.data, fold)) for i, fold in enumerate(folds))
+        else:
+            # hand out a few folds at a time when there are many small ones
+            # (eg: leave-one-out)
+            chunksize = max(len(folds) // (pool.n_jobs * 20), 1)
+            results = pool.pool.imap_unordered(_run_fold_in_process, enumerate(folds), chunksize)
+        for done, (i, result) in enumerate(results):
+            yield i, result
+            if cb:
+                cb((done + 1) / float(len(folds)))
+    finally:
+        if own_pool:
+            pool.close()
+
+
+def _score(estimator, values, labels, scoring):
+    if scoring is None:
+        return estimator.score(values, labels)
+    return get_scorer(scoring)(estimator, values, labels)
+
+def fit_and_score(data, fold):
+    '''
+    Task for run_folds: fits a copy of an estimator to some examples and
+    scores it on others.
+    data -- (estimator, values, labels, scoring), where scoring is a
+        scikit-learn scorer name, or None for the estimator's score method
+    fold -- (train, test) index arrays
+    Returns the score on the test examples.
+    '''
+    estimator, values, labels, scoring = data
+    train, test = fold
+    estimator = clone(estimator).fit(values[train], labels[train])
+    return _score(estimator, values[test], labels[test], scoring)
+
+def fit_and_predict(data, fold):
+    '''
+    Task for run_folds: like fit_and_score, but returns the predicted
+    labels of the test examples.
+    '''
+    estimator, values, labels = data[:3]
+    train, test = fold
+    return clone(estimator).fit(values[train], labels[train]).predict(values[test])
+
+def learning_curve_point(data, fold):
+    '''
+    Task for run_folds: like fit_and_score, but returns the scores on both
+    the training and the test examples.
+    '''
+    estimator, values, labels, scoring = data
+    train, test = fold
+    estimator = clone(estimator).fit(values[train], labels[train])
+    return (_score(estimator, values[train], labels[train], scoring),
+            _score(estimator, values[test], labels[test], scoring))
+
+
+def learning_curve(estimator, values, labels, cv, train_sizes, scoring=None,
+                   n_jobs=1, cb=None):
+    '''
+    Like sklearn.model_selection.learning_curve, but with the fits run by
+    run_folds.  For each split of cv (a scikit-learn splitter) and each
+    training set size, the estimator is fit to the first examples of the
+    training set.
+    train_sizes -- fractions of the training set (or numbers of examples)
+    RETURNS: (sizes, train_scores, test_scores), the scores being arrays
+        with a row per size and a column per split.
+    '''
+    splits = list(cv.split(values, labels))
+    n_train = min([len(train) for train, test in splits])
+    sizes = np.asarray(train_sizes)
+    if sizes.dtype.kind == 'f':
+        sizes = (sizes * n_train).astype(int)
+    sizes = np.unique(np.clip(sizes, 1, n_train))
+    folds = [(train[:size], test) for size in sizes for train, test in splits]
+    scores = np.zeros((len(folds), 2))
+    for i, result in run_folds(learning_curve_point, (estimator, values, labels, scoring),
+                               folds, n_jobs, cb):
+        scores[i] = result
+    scores = scores.reshape((len(sizes), len(splits), 2))
+    return sizes, scores[:, :, 0], scores[:, :, 1]
@@ -1,14 +1,214 @@
 from __future__ import print_function
+import json
 import logging
-from random import randint
+import os
+import random
+import time
 import numpy as np
 from dbconnect import *
+from featurestore import table_summary
 from singleton import *
 from properties import Properties
 
 p = Properties.getInstance()
 db = DBConnect.getInstance()
 
+
+class ObjectIDIndex(object):
+    '''
+    Maps each image key to the sorted object IDs of the objects in that
+    image so object keys can be looked up by position (see
+    DBConnect.GetObjectIDAtIndex) without querying the database.
+    The IDs of all images are kept in a single compact array.  The index
+    remembers the objects modify date it was built for and reports itself
+    stale once the object table has changed, or if the modify date is
+    unknown.  SQLite only records when the database file changed (eg: when
+    a class table was written), so there the index is kept if the table
+    still has the same number of objects and the same first and last object
+    keys (like FeatureStore.is_valid).
+    '''
+    CHECK_INTERVAL = 5.0   # minimum seconds between modify date checks
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ids = np.zeros(0, dtype='i4')
+        self.spans = {}            # {imKey : (start, count), ...} into self.ids
+        self.modify_date = None
+        self.summary = None
+        self.last_checked = 0
+
+    def IsEmpty(self):
+        return self.spans == {}
+
+    def build(self):
+        '''Reads the object IDs of all images in one streaming query.'''
+        self.clear()
+        modify_date = _modify_stamp()
+        summary = _sqlite_summary()
+        nkeys = len(image_key_columns())
+        query = 'SELECT %s, %s FROM %s ORDER BY %s, %s'%(
+            UniqueImageClause(), p.object_id, p.object_table,
+            UniqueImageClause(), p.object_id)
+        chunks = []
+        spans = {}
+        last_key = None
+        n = 0
+        for rows in db.iter_query(query):
+            block = np.array(rows, dtype='i8')
+            # positions in the block where a new image starts
+            starts = np.flatnonzero(np.any(block[1:, :nkeys] != block[:-1, :nkeys], axis=1)) + 1
+            starts = [0] + starts.tolist()
+            for start, end in zip(starts, starts[1:] + [len(block)]):
+                key = tuple([int(k) for k in block[start, :nkeys]])
+                if key == last_key:
+                    span_start, count = spans[key]
+                    spans[key] = (span_start, count + end - start)
+                else:
+                    spans[key] = (n + start, end - start)
+                    last_key = key
+            chunks.append(block[:, nkeys])
+            n += len(block)
+        ids = np.concatenate(chunks) if chunks else np.zeros(0, dtype='i8')
+        if len(ids) == 0 or ids.max() < 2**31:
+            ids = ids.astype('i4')
+        self.ids = ids
+        self.spans = spans
+        self.modify_date = modify_date
+        self.summary = summary
+        self.last_checked = time.time()
+        logging.info('Indexed %d object IDs in %d images'%(len(ids), len(spans)))
+
+    def is_current(self):
+        '''
+        Returns False if the object table has changed since the index was
+        built.  The modify date is checked at most every CHECK_INTERVAL
+        seconds.
+        '''
+        if self.IsEmpty():
+            return False
+        if time.time() - self.last_checked < self.CHECK_INTERVAL:
+            return True
+        self.last_checked = time.time()
+        stamp = _current_stamp(self.modify_date, self.summary)
+        if stamp is None:
+            return False
+        self.modify_date = stamp
+        return True
+
+    def get_object_ids(self, imKey):
+        '''Returns the sorted array of object IDs in the given image.'''
+        start, count = self.spans.get(tuple(imKey), (0, 0))
+        return self.ids[start : start + count]
+
+    def get_object_key(self, imKey, index):
+        '''Returns the key of the index'th object (1,2,3...) of an image.'''
+        start, count = self.spans[tuple(imKey)]
+        if not 1 <= index <= count:
+            raise IndexError('Image %s has no object at index %s'%(imKey, index))
+        return tuple(list(imKey) + [int(self.ids[start + index - 1])])
+
+    def save(self, filename):
+        keys = sorted(self.spans.keys())
+        tmp = filename + '.tmp.npz'
+        np.savez(tmp, ids=self.ids, 
+                 keys=np.array(keys, dtype='i8').reshape((len(keys), -1)),
+                 spans=np.array([self.spans[k] for k in keys], dtype='i8').reshape((len(keys), 2)),
+                 modify_date=np.array(self.modify_date),
+                 summary=np.array(json.dumps(self.summary)))
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp, filename)
+
+    def load(self, filename):
+        '''
+        Loads an index saved with save.  Returns False (and leaves the index
+        empty) if there is no such file or it is out of date.
+        '''
+        self.clear()
+        if not os.path.exists(filename):
+            return False
+        try:
+            with open(filename, 'rb') as f:
+                saved = np.load(f)
+                summary = json.loads(str(saved['summary'])) if 'summary' in saved.files else None
+                modify_date = _current_stamp(str(saved['modify_date']), summary)
+                if modify_date is None:
+                    return False
+                ids = saved['ids']
+                keys = saved['keys']
+                spans = saved['spans']
+        except Exception as e:
+            logging.warn('Could not read object index %s: %s'%(filename, e))
+            return False
+        self.ids = ids
+        self.spans = dict((tuple([int(k) for k in key]), (int(start), int(count)))
+                          for key, (start, count) in zip(keys, spans))
+        self.modify_date = modify_date
+        self.summary = summary
+        self.last_checked = time.time()
+        return True
+
+
+def _modify_stamp():
+    '''
+    Returns the modify date of the object table as a string, or None if it is
+    unknown (eg: MySQL doesn't record update times for all table types).
+    '''
+    date = db.get_objects_modify_date()
+    return None if date is None else str(date)
+
+def _sqlite_summary():
+    '''Returns the table_summary of the object table on SQLite, else None.'''
+    if p.db_type and p.db_type.lower() == 'sqlite':
+        return table_summary()
+    return None
+
+def _current_stamp(modify_date, summary):
+    '''
+    Returns the modify date of the object table if an object index built
+    at modify_date, when the table had the given summary (see
+    _sqlite_summary), is still current.  Otherwise returns None.
+    '''
+    stamp = _modify_stamp()
+    if stamp is None or modify_date in (None, 'None'):
+        return None
+    if stamp == modify_date or (summary is not None and summary == _sqlite_summary()):
+        return stamp
+    return None
+
+
+def object_index_filename():
+    '''
+    Returns the file the object index of the current database is persisted
+    to, or None if object_index_dir is not set.
+    '''
+    if not p.object_index_dir:
+        return None
+    import hashlib
+    source = '%s|%s|%s|%s|%s'%(p.db_type, p.db_host, p.db_name, 
+                               p.db_sqlite_file, p.object_table)
+    return os.path.join(p.object_index_dir, 
+                        'object_index_%s.npz'%(hashlib.md5(source).hexdigest()))
+
+
+def allocate_evenly(n, sizes):
+    '''
+    Splits n into one quota per stratum size, as evenly as possible without
+    any quota exceeding its size.  Returns the list of quotas.
+    '''
+    quotas = [0] * len(sizes)
+    remaining = min(n, sum(sizes))
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for k, i in enumerate(order):
+        # the smallest strata are filled first so what they can't take is
+        # shared by the larger ones
+        quotas[i] = min(sizes[i], -(-remaining // (len(order) - k)))
+        remaining -= quotas[i]
+    return quotas
+
+
 class DataModel(Singleton):
     '''
     DataModel is a dictionary of perImageObjectCounts indexed by (TableNumber,ImageNumber)
@@ -26,9 +226,12 @@ class DataModel(Singleton):
         self.cumSums = []        # cumSum[i]: sum of objects in images 1..i (inclusive) 
         self.obCount = 0
         self.keylist = []
+        self.counts = np.zeros(0, dtype='i8')  # counts[i]: object count of image keylist[i]
+        self.wellMap = None      # {imKey:wellKey, ...} used to stratify samples by well
         self.filterkeys = {}     # sets of image keys keyed by filter name
         self.plate_map = {}      # maps well names to (x,y) plate locations
         self.rev_plate_map = {}  # maps (x,y) plate locations to well names
+        self.object_index = ObjectIDIndex()  # sorted object IDs of each image
         
     def __str__(self):
         return str(self.obCount)+" objects in "+ \
@@ -64,20 +267,48 @@ class DataModel(Singleton):
         self.keylist = list(self.data.keys())
 
         # Build a cumulative sum array to use for generating random objects quickly
-        self.cumSums = np.zeros(len(self.data)+1, dtype='int')
-        for i, imKey in enumerate(self.keylist):
-            self.cumSums[i+1] = self.cumSums[i]+self.data[imKey]
+        self.counts = np.array([self.data[imKey] for imKey in self.keylist], dtype='i8')
+        self.cumSums = np.concatenate(([0], np.cumsum(self.counts)))
 
         self.groupMaps, self.groupColNames = db.GetGroupMaps()
         self.revGroupMaps, _ = db.GetGroupMaps(reverse=True)
         for group in self.groupMaps:
             self.groupColTypes[group] = [type(col) for col in self.groupMaps[group].items()[0][1]]
 
+        if p.object_table and p.object_id:
+            self.load_object_index()
+
+    def load_object_index(self):
+        '''
+        Builds the index of object IDs per image, or loads it from
+        object_index_dir if it was saved there and is still current.
+        '''
+        if _modify_stamp() is None:
+            # the index could never be checked, so objects are looked up in
+            # the database instead
+            logging.info('Object table modify date unknown, not indexing object IDs.')
+            self.object_index.clear()
+            return
+        filename = object_index_filename()
+        if filename and self.object_index.load(filename):
+            logging.info('Loaded object index from %s'%(filename))
+            return
+        self.object_index.build()
+        if filename:
+            try:
+                self.object_index.save(filename)
+            except (IOError, OSError) as e:
+                logging.warn('Could not save object index to %s: %s'%(filename, e))
+
     def DeleteModel(self):
         self.data = {}
         self.groupMaps = {}
         self.cumSums = []
+        self.keylist = []
+        self.counts = np.zeros(0, dtype='i8')
+        self.wellMap = None
         self.obCount = 0
+        self.object_index.clear()
         
     def _if_empty_populate(self):
         if self.IsEmpty:
@@ -88,27 +319,8 @@ class DataModel(Singleton):
         return self.obCount
         
     def GetRandomObject(self, N):
-        '''
-        Returns a random object key
-        We expect self.data.keys() to return the keys in the SAME ORDER
-        every time since we build cumSums from that same ordering.  This
-        need not necessarily be in sorted order.
-        '''
-        self._if_empty_populate()
-        obIdxs = random.sample(range(1, self.obCount + 1), N)
-        obKeys = []
-        for obIdx in obIdxs:
-            imIdx = np.searchsorted(self.cumSums, obIdx, 'left')
-            # SUBTLETY: images which have zero objects will appear as repeated
-            #    sums in the cumulative array, so we must pick the first index
-            #    of any repeated sum, otherwise we are picking an image with no
-            #    objects
-            while self.cumSums[imIdx] == self.cumSums[imIdx-1]:
-                imIdx -= 1
-            imKey = self.data.keys()[imIdx-1]
-            obIdx = obIdx-self.cumSums[imIdx-1]  # object number relative to this image
-            obKeys.append(db.GetObjectIDAtIndex(imKey, obIdx))
-        return obKeys
+        '''Returns N random object keys from the whole experiment.'''
+        return self.SampleObjects(N)
 
     def GetRandomObjects(self, N, imKeys=None):
         '''
@@ -116,42 +328,169 @@ class DataModel(Singleton):
         If a list of imKeys is specified, GetRandomObjects will return 
         objects from only these images.
         '''
+        if imKeys == []:
+            return []
+        return self.SampleObjects(N, imKeys)
+
+    def SampleObjects(self, N, imKeys=None, filter_name=None, group=None,
+                      groupKey=None, stratify=None):
+        '''
+        Returns the keys of N distinct random objects (or of all objects if
+        there are fewer than N).
+        imKeys -- sample only from these images
+        filter_name -- sample only from images in this filter
+        group, groupKey -- sample only from images in this group (groupKey
+            may contain '__ANY__' wildcards)
+        stratify -- None to sample objects uniformly, or 'image', 'well' or
+            a group name to spread the sample as evenly as possible over the
+            images, wells or groups the objects are in.
+        The images are located for all draws at once by searching the
+        cumulative object counts, and the object keys are then looked up in
+        one batch.
+        '''
         self._if_empty_populate()
-        if N > self.obCount:
-            logging.info(str(N) +' is greater than the number of objects. Fetching ' + str(self.obCount) + ' objects.')
-            N = self.obCount
-            print(self.obCount)
-        if imKeys == None:
-            return self.GetRandomObject(N)
-        elif imKeys == []:
+        keys, counts = self._sampling_frame(imKeys, filter_name, group, groupKey)
+        total = int(counts.sum()) if len(counts) else 0
+        if N > total:
+            logging.info('%s is greater than the number of objects. Fetching %s objects.'%(N, total))
+            N = total
+        if N <= 0:
             return []
+        cumsums = np.concatenate(([0], np.cumsum(counts)))
+        if stratify is None:
+            draws = np.array(random.sample(xrange(total), N), dtype='i8')
         else:
-            sums = np.cumsum([self.data[imKey] for imKey in imKeys])
-            if sums[-1] < 1:
-                return []
-            obs = []
-            obIdxs = random.sample(range(1, sums[-1]+1), N)#randint(1, sums[-1])
-            for obIdx in obIdxs:
-                index = np.searchsorted(sums, obIdx, 'left')
-                if index != 0:
-                    while sums[index] == sums[index-1]:
-                        index -= 1
-                    obIdx = obIdx-sums[index-1]
-                obKey = db.GetObjectIDAtIndex(imKeys[index], obIdx)
-                obs.append(obKey)
-            return obs
-            
+            draws = self._stratified_draws(N, keys, counts, cumsums, stratify)
+        # Images without objects repeat the previous sum, so searching on the
+        # right always lands on the image that actually holds the draw.
+        imIdxs = np.searchsorted(cumsums, draws, 'right') - 1
+        indices = draws - cumsums[imIdxs] + 1
+        return self.GetObjectKeysAtIndices([keys[i] for i in imIdxs], indices)
+
+    def _sampling_frame(self, imKeys, filter_name, group, groupKey):
+        '''Returns the image keys to sample from and an array of their object counts.'''
+        if imKeys is None and filter_name is None and group is None:
+            return self.keylist, self.counts
+        if group is not None:
+            imKeys = self.GetImagesInGroupWithWildcards(group, groupKey, filter_name)
+        elif imKeys is None:
+            imKeys = self.GetAllImageKeys(filter_name)
+        elif filter_name is not None:
+            filtered = set([tuple(k) for k in self.GetAllImageKeys(filter_name)])
+            imKeys = [k for k in imKeys if tuple(k) in filtered]
+        keys = [tuple([int(k) for k in imKey]) for imKey in imKeys]
+        counts = np.array([self.data.get(imKey, 0) for imKey in keys], dtype='i8')
+        return keys, counts
+
+    def _stratified_draws(self, N, keys, counts, cumsums, stratify):
+        '''
+        Returns N draws (positions in the cumulative counts) spread as
+        evenly as possible over the strata of the given images.
+        '''
+        strata = {}
+        for i, label in enumerate(self._strata_labels(keys, stratify)):
+            strata.setdefault(label, []).append(i)
+        strata = [np.array(ims) for ims in strata.values()]
+        sizes = [int(counts[ims].sum()) for ims in strata]
+        draws = []
+        for ims, size, quota in zip(strata, sizes, allocate_evenly(N, sizes)):
+            if quota == 0:
+                continue
+            # draw within the stratum then map back to the whole frame
+            local = np.array(random.sample(xrange(size), quota), dtype='i8')
+            sub_cumsums = np.concatenate(([0], np.cumsum(counts[ims])))
+            j = np.searchsorted(sub_cumsums, local, 'right') - 1
+            draws += (cumsums[ims[j]] + local - sub_cumsums[j]).tolist()
+        random.shuffle(draws)
+        return np.array(draws, dtype='i8')
+
+    def _strata_labels(self, keys, stratify):
+        '''Returns the stratum of each image key.'''
+        if stratify == 'image':
+            return keys
+        if stratify == 'well':
+            if self.wellMap is None:
+                self.wellMap = self._get_well_map()
+            return [self.wellMap.get(imKey) for imKey in keys]
+        if stratify in self.groupMaps:
+            return [self.groupMaps[stratify].get(imKey) for imKey in keys]
+        raise ValueError('Cannot stratify objects by "%s"'%(stratify))
+
+    def _get_well_map(self):
+        '''Returns {imKey : wellKey} read from the image table.'''
+        well_cols = well_key_columns()
+        if well_cols is None:
+            raise ValueError('Cannot stratify objects by well: well_id is not set in the properties file.')
+        nkeys = len(image_key_columns())
+        res = db.execute('SELECT %s, %s FROM %s'%(UniqueImageClause(), ', '.join(well_cols), p.image_table))
+        return dict([(tuple([int(k) for k in row[:nkeys]]), tuple(row[nkeys:]))
+                     for row in res])
+
+    def GetObjectKeysAtIndices(self, imKeys, indices):
+        '''
+        Returns the keys of the indices[i]'th object (1,2,3...) of image
+        imKeys[i] for every i.  With the object index this is a single array
+        lookup, otherwise each distinct image is queried once.
+        '''
+        if len(imKeys) == 0:
+            return []
+        indices = np.asarray(indices, dtype='i8')
+        if self._object_index_current():
+            spans = np.array([self.object_index.spans[tuple(imKey)] for imKey in imKeys],
+                             dtype='i8').reshape((len(imKeys), 2))
+            bad = np.flatnonzero((indices < 1) | (indices > spans[:, 1]))
+            if len(bad):
+                raise IndexError('Image %s has no object at index %s'%(imKeys[bad[0]], indices[bad[0]]))
+            ids = self.object_index.ids[spans[:, 0] + indices - 1]
+            return [tuple(list(imKey) + [int(obId)]) for imKey, obId in zip(imKeys, ids)]
+        obIds = {}
+        obKeys = []
+        for imKey, index in zip(imKeys, indices):
+            imKey = tuple(imKey)
+            if imKey not in obIds:
+                obIds[imKey] = self._get_object_ids_from_db(imKey)
+            if not 1 <= index <= len(obIds[imKey]):
+                raise IndexError('Image %s has no object at index %s'%(imKey, index))
+            obKeys.append(tuple(list(imKey) + [obIds[imKey][index - 1]]))
+        return obKeys
+
+    def _get_object_ids_from_db(self, imKey):
+        '''Returns the sorted object IDs of an image from the object table.'''
+        res = db.execute('SELECT %s FROM %s WHERE %s ORDER BY %s'%(
+            p.object_id, p.object_table, GetWhereClauseForImages([imKey]), p.object_id))
+        return [int(row[0]) for row in res]
+
+    def GetObjectIDAtIndex(self, imKey, index):
+        '''
+        Returns the key of the index'th object (1,2,3...) of an image, using
+        the object index unless the object table has changed since it was
+        built (in which case it is rebuilt).
+        '''
+        if self._object_index_current():
+            return self.object_index.get_object_key(imKey, index)
+        return db.GetObjectIDAtIndex(imKey, index)
+
     def GetObjectsFromImage(self, imKey):
         self._if_empty_populate()
-        obKeys=[]
-        for i in xrange(1,self.GetObjectCountFromImage(imKey)+1):
-            obKeys.append(db.GetObjectIDAtIndex(imKey, i))
-        return obKeys
+        if self._object_index_current():
+            return [tuple(list(imKey) + [int(obId)]) 
+                    for obId in self.object_index.get_object_ids(imKey)]
+        return [tuple(list(imKey) + [obId]) 
+                for obId in self._get_object_ids_from_db(imKey)]
         # JK - The above code was previously removed in favor of the code below.
         # However the new code is sensitive to objects not having consecutive IDs 
         # in an image, whereas the above code is not making it more robust
 #        return [tuple(list(imKey) + [i]) 
 #                for i in xrange(1, self.GetObjectCountFromImage(imKey) + 1)]
+
+    def _object_index_current(self):
+        '''Rebuilds the object index if the object table has changed.'''
+        if self.object_index.IsEmpty():
+            return False
+        if not self.object_index.is_current():
+            logging.info('Object table has changed, rebuilding the object index.')
+            self.load_object_index()
+        return not self.object_index.IsEmpty()
     
     def GetAllImageKeys(self, filter_name=None):
         ''' Returns all object keys. If a filter is passed in, only the image
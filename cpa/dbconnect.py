@@ -4,6 +4,7 @@ import types
 import random
 from properties import Properties
 from singleton import Singleton
+from sqliteimport import SQLiteImporter, defer_primary_key
 from sys import stderr
 import exceptions
 import numpy as np
@@ -15,7 +16,10 @@ import traceback
 import re
 import os.path
 import logging
+import collections
 import copy
+import itertools
+import time
 # This module should be usable on systems without wx.
 
 verbose = True
@@ -55,6 +59,16 @@ class DBDisconnectedException(Exception):
     Raised when a query or other database operation fails because the
     database is shutting down or the connection has been lost.
     """
+    # MySQL error codes: server has gone away, lost connection during query,
+    # server shutdown in progress
+    MYSQL_DISCONNECT_ERRORS = [2006, 2013, 1053]
+
+    def is_disconnect_error(cls, e):
+        '''returns whether the given db exception means the connection is lost'''
+        return (isinstance(e, DBOperationalError()) and len(e.args) > 0 and
+                e.args[0] in cls.MYSQL_DISCONNECT_ERRORS)
+    is_disconnect_error = classmethod(is_disconnect_error)
+
     def with_mysql_retry(cls, f):
         """
         Decorator that tries calling its function a second time if a
@@ -65,6 +79,9 @@ class DBDisconnectedException(Exception):
                 return f(db, *args, **kwargs)
             except DBDisconnectedException:
                 logging.info('Lost connection to the MySQL database; reconnecting.')
+                # Throw away the dead connection rather than returning it to
+                # the pool, then check out a fresh one.
+                db.DiscardConnection()
                 db.connect()
                 return f(db, *args, **kwargs)
         return fn
@@ -179,15 +196,19 @@ def GetWhereClauseForObjects(obkeys, table_name=None):
 
     return split(obkeys,table_name)
 
-def GetWhereClauseForImages(imkeys):
+def GetWhereClauseForImages(imkeys, table_name=None):
     '''
     Return a SQL WHERE clause that matches any of the given image keys.
     Example: GetWhereClauseForImages([(3,), (4,)]) => 
              "(ImageNumber IN (3, 4))"
     '''
+    if table_name is None:
+        table_name = ''
+    if table_name != '':
+        table_name += '.'
     imkeys.sort()
     if not p.table_id:
-        return '%s IN (%s)'%(p.image_id, ','.join([str(k[0]) for k in imkeys]))
+        return '%s%s IN (%s)'%(table_name, p.image_id, ','.join([str(k[0]) for k in imkeys]))
     else:
         imkeys = np.array(imkeys)
         count = 0
@@ -197,8 +218,8 @@ def GetWhereClauseForImages(imkeys):
             imnums = imkeys[(imkeys[:,0]==tnum), 1]
             count += len(imnums)
             if len(imnums)>0:
-                wheres += ['(%s=%s AND %s IN (%s))'%(p.table_id, tnum, 
-                            p.image_id, ','.join([str(k) for k in imnums]))]
+                wheres += ['(%s%s=%s AND %s%s IN (%s))'%(table_name, p.table_id, tnum, 
+                            table_name, p.image_id, ','.join([str(k) for k in imnums]))]
             tnum += 1
         return ' OR '.join(wheres)
 
@@ -276,6 +297,375 @@ class SqliteClassifier():
         return int(class_num)
 
 
+DEFAULT_FETCH_SIZE = 10000   # rows per fetchmany batch when streaming results
+KEY_TABLE = '_cpa_keys'      # temporary table used to look up many keys at once
+INLINE_KEY_LIMIT = 500       # larger KeySets are matched through a temporary table
+
+
+def _safe_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def to_float_array(values, fill=None):
+    '''
+    Converts a 1-D or 2-D sequence of DB values to a float64 array.
+    NULLs and values that can't be parsed as numbers become NaN, or fill if
+    it is given.  Only columns containing unparseable values are converted
+    element by element; everything else is converted by numpy directly.
+    '''
+    try:
+        out = np.array(values, dtype='f8')
+    except (TypeError, ValueError):
+        values = np.asarray(values, dtype=object)
+        if values.ndim == 1:
+            out = np.fromiter((_safe_float(v) for v in values), dtype='f8', 
+                              count=len(values))
+        else:
+            out = np.empty(values.shape, dtype='f8')
+            for j in xrange(values.shape[1]):
+                out[:, j] = to_float_array(values[:, j])
+    if fill is not None:
+        out[np.isnan(out)] = fill
+    return out
+
+def _infer_dtype_from_value(value):
+    if isinstance(value, bool) or isinstance(value, (int, long)):
+        return 'i8'
+    elif isinstance(value, (float, decimal.Decimal)):
+        return 'f8'
+    else:
+        return 'O'
+
+def infer_dtypes_from_rows(ncols, rows):
+    '''
+    Returns a numpy dtype string for each of ncols columns from a sample of
+    result rows.  Columns that are entirely NULL in the sample are 'f8'.
+    '''
+    dtypes = [None] * ncols
+    for row in rows:
+        for i, value in enumerate(row):
+            if value is None or dtypes[i] == 'O':
+                continue
+            dt = _infer_dtype_from_value(value)
+            if dtypes[i] is None or dt == 'O' or (dt == 'f8' and dtypes[i] == 'i8'):
+                dtypes[i] = dt
+        if None not in dtypes and 'i8' not in dtypes:
+            break
+    return [dt or 'f8' for dt in dtypes]
+
+def _convert_column(values, dtype):
+    '''
+    Converts a column of DB values to the given dtype, returning the array and
+    the dtype actually used: integer columns containing NULLs or fractional
+    values are promoted to float.
+    '''
+    kind = np.dtype(dtype).kind
+    if kind in 'iub':
+        floats = to_float_array(values)
+        if np.isnan(floats).any() or (floats != np.floor(floats)).any():
+            return floats, 'f8'
+        return floats.astype(dtype), dtype
+    elif kind == 'f':
+        return to_float_array(values), dtype
+    else:
+        return np.asarray(values, dtype=object), 'O'
+
+
+class _ArrayBuilder(object):
+    '''
+    Accumulates 1-D (or 2-D, with ncols) blocks of rows into a preallocated
+    numpy array, growing it geometrically so appends are amortized O(1).
+    '''
+    def __init__(self, dtype, capacity, ncols=None):
+        self.shape_tail = () if ncols is None else (ncols,)
+        self.data = np.empty((max(capacity, 1),) + self.shape_tail, dtype=dtype)
+        self.n = 0
+
+    def append(self, block):
+        if block.dtype != self.data.dtype and np.dtype(block.dtype).kind != self.data.dtype.kind:
+            # promote what we have so far (eg: int column that turned out to hold NULLs)
+            self.data = self.data.astype(np.promote_types(self.data.dtype, block.dtype))
+        needed = self.n + len(block)
+        if needed > len(self.data):
+            grown = np.empty((max(needed, 2 * len(self.data)),) + self.shape_tail, dtype=self.data.dtype)
+            grown[:self.n] = self.data[:self.n]
+            self.data = grown
+        self.data[self.n:needed] = block
+        self.n = needed
+
+    def result(self):
+        if self.n < len(self.data):
+            return self.data[:self.n].copy()
+        return self.data
+
+
+TYPE_SAMPLE_ROWS = 10000   # CSV rows read to infer column types
+
+
+DEFAULT_POOL_SIZE = 10
+POOL_CHECKOUT_TIMEOUT = 60.0   # seconds to wait for a free connection
+
+DEFAULT_QUERY_CACHE_MB = 64
+QUERY_CACHE_CHECK_INTERVAL = 5.0   # minimum seconds between modify date checks
+
+
+class ConnectionPoolExhausted(DBException):
+    '''Raised when no database connection becomes free in time.'''
+    pass
+
+
+class ConnectionPool(object):
+    '''
+    A bounded pool of open database connections.
+
+    The pool only keeps track of idle connections and of how many connections
+    are open in total; DBConnect keeps the connections that are currently
+    checked out, keyed by connection ID.  At most max_size connections are
+    open at once.  When the pool is full, checkout waits (calling reclaim to
+    recover connections from threads that have exited) until a connection is
+    checked back in or the timeout expires.
+    '''
+    def __init__(self, max_size=None, timeout=POOL_CHECKOUT_TIMEOUT):
+        self._max_size = max_size
+        self.timeout = timeout
+        self.idle = []   # [(connection, connection_info), ...]
+        self.size = 0    # number of open connections, idle or checked out
+        self.cond = threading.Condition()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.stats = {'created' : 0,     # new connections opened
+                      'reused' : 0,      # idle connections handed out again
+                      'checkins' : 0,    # connections returned to the pool
+                      'reclaimed' : 0,   # returned on behalf of dead threads
+                      'discarded' : 0,   # closed or failed health check
+                      'waits' : 0}       # checkouts that had to wait
+
+    def get_max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        try:
+            return max(1, int(p.db_pool_size or DEFAULT_POOL_SIZE))
+        except ValueError:
+            logging.warn('Invalid db_pool_size "%s", using %d.'%(p.db_pool_size, DEFAULT_POOL_SIZE))
+            return DEFAULT_POOL_SIZE
+    max_size = property(get_max_size)
+
+    def checkout(self, is_healthy=None, reclaim=None, block=True):
+        '''
+        Returns an idle (connection, connection_info) pair that passed the
+        is_healthy check, or None if the caller should open a new connection.
+        In the latter case a slot has been reserved for the new connection and
+        the caller MUST call created() or discard() once it has tried.
+        reclaim -- optional function called while waiting on a full pool to
+                   check in connections that are no longer in use
+        block -- if false, raise ConnectionPoolExhausted right away instead of
+                 waiting when the pool is full
+        '''
+        import time
+        deadline = time.time() + self.timeout
+        waited = False
+        self.cond.acquire()
+        try:
+            while True:
+                while self.idle:
+                    conn, info = self.idle.pop()
+                    if is_healthy is None or is_healthy(conn):
+                        self.stats['reused'] += 1
+                        return conn, info
+                    self._close(conn)
+                if self.size < self.max_size:
+                    self.size += 1
+                    return None
+                if reclaim is not None:
+                    reclaim()
+                    if self.idle:
+                        continue
+                remaining = deadline - time.time()
+                if not block:
+                    raise ConnectionPoolExhausted('All %d database connections '
+                                                  'are in use.'%(self.max_size))
+                if remaining <= 0:
+                    raise ConnectionPoolExhausted('Timed out waiting for a free database '
+                                      'connection (db_pool_size = %d). '
+                                      'Try increasing db_pool_size in your '
+                                      'properties file.'%(self.max_size))
+                if not waited:
+                    self.stats['waits'] += 1
+                    waited = True
+                self.cond.wait(min(remaining, 1.0))
+        finally:
+            self.cond.release()
+
+    def created(self):
+        '''Records that a connection was opened in a reserved slot.'''
+        self.cond.acquire()
+        self.stats['created'] += 1
+        self.cond.release()
+
+    def checkin(self, conn, info):
+        '''Returns a connection to the pool so another thread may use it.'''
+        self.cond.acquire()
+        try:
+            self.idle.append((conn, info))
+            self.stats['checkins'] += 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def discard(self, conn=None):
+        '''
+        Frees the slot held by a checked-out connection (or by a connection
+        that failed to open) and closes it.
+        '''
+        self.cond.acquire()
+        try:
+            self._close(conn)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _close(self, conn):
+        # caller must hold self.cond
+        self.size = max(0, self.size - 1)
+        self.stats['discarded'] += 1
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def close_all(self):
+        '''Closes all idle connections and forgets about checked out ones.'''
+        self.cond.acquire()
+        try:
+            for conn, info in self.idle:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self.idle = []
+            self.size = 0
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def free_slots(self):
+        '''
+        Returns how many connections can be checked out right now without
+        waiting: the idle ones and those that may still be opened.
+        '''
+        self.cond.acquire()
+        try:
+            return len(self.idle) + max(0, self.max_size - self.size)
+        finally:
+            self.cond.release()
+
+    def statistics(self):
+        '''Returns a dict of pool counters and the current pool occupancy.'''
+        self.cond.acquire()
+        try:
+            stats = dict(self.stats)
+            stats['size'] = self.size
+            stats['idle'] = len(self.idle)
+            stats['max_size'] = self.max_size
+            return stats
+        finally:
+            self.cond.release()
+
+
+def estimate_result_size(rows):
+    '''Returns a rough number of bytes used by a list of result rows.'''
+    size = sys.getsizeof(rows)
+    if len(rows) == 0:
+        return size
+    sample = rows[::max(1, len(rows) // 20)]
+    per_row = sum([sys.getsizeof(row) + sum([sys.getsizeof(v) for v in row])
+                   for row in sample]) / float(len(sample))
+    return int(size + len(rows) * per_row)
+
+def normalize_sql(query):
+    '''Collapses whitespace outside of quoted strings.'''
+    parts = re.split(r'(\'[^\']*\'|"[^"]*")', query.strip())
+    return ''.join([part if i % 2 else ' '.join(part.split())
+                    for i, part in enumerate(parts)])
+
+
+class QueryCache(object):
+    '''
+    A least recently used cache of query results holding at most max_bytes
+    (estimated) bytes.  Results bigger than that are not cached.  DBConnect
+    keys the results on the normalized SQL and the object table's modify
+    date so they expire when the data changes.
+    '''
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self.entries = collections.OrderedDict()   # {key : (value, nbytes)}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.stats = {'hits' : 0,
+                      'misses' : 0,
+                      'evictions' : 0,       # entries dropped to make room
+                      'invalidations' : 0,   # times the cache was cleared
+                      'too_big' : 0}         # results too big to cache
+
+    def get_max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        try:
+            return int(float(p.db_cache_size or DEFAULT_QUERY_CACHE_MB) * 1024 * 1024)
+        except ValueError:
+            logging.warn('Invalid db_cache_size "%s", using %d.'%(p.db_cache_size, DEFAULT_QUERY_CACHE_MB))
+            return DEFAULT_QUERY_CACHE_MB * 1024 * 1024
+    max_bytes = property(get_max_bytes)
+
+    def get(self, key):
+        '''Returns (True, value) on a hit or (False, None) on a miss.'''
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries.pop(key)
+                self.entries[key] = entry   # most recently used go last
+                self.stats['hits'] += 1
+                return True, entry[0]
+            self.stats['misses'] += 1
+            return False, None
+
+    def put(self, key, value, nbytes):
+        max_bytes = self.max_bytes
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            if nbytes > max_bytes:
+                self.stats['too_big'] += 1
+                return
+            while self.nbytes + nbytes > max_bytes:
+                old_value, old_nbytes = self.entries.popitem(last=False)[1]
+                self.nbytes -= old_nbytes
+                self.stats['evictions'] += 1
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.stats['invalidations'] += 1
+
+    def statistics(self):
+        '''Returns a dict of cache counters and the current cache occupancy.'''
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.nbytes
+            stats['max_bytes'] = self.max_bytes
+            return stats
+
+
 def _check_colname_user(properties, table, colname):
     if table in [properties.image_table, properties.object_table] and not colname.lower().startswith('user_'):
         raise ValueError('User-defined columns in the image and object tables must have names beginning with "User_".')
@@ -283,16 +673,22 @@ def _check_colname_user(properties, table, colname):
     
 class DBConnect(Singleton):
     '''
-    DBConnect abstracts calls to MySQLdb/SQLite. It's a singleton that maintains
-    unique connections for each thread that uses it.  These connections are 
-    automatically created on "execute", and results are automatically returned
-    as a list.
+    DBConnect abstracts calls to MySQLdb/SQLite. It's a singleton that hands
+    out a connection to each thread that uses it.  Connections come from a
+    bounded pool (see ConnectionPool and the db_pool_size property); they are
+    automatically checked out on "execute" and returned to the pool when the
+    thread releases them or exits.  Results are automatically returned as a
+    list.
     '''
     def __init__(self):
         self.classifierColNames = None
-        self.connections = {}
+        self.connections = {}      # checked out connections keyed by connID
         self.cursors = {}
         self.connectionInfo = {}
+        self.connection_pool = ConnectionPool()
+        self.query_cache = QueryCache()
+        self._cache_stamp = None   # objects modify date the cache is keyed on
+        self._cache_stamp_checked = 0
         #self.link_cols = {}  # link_cols['table'] = columns that link 'table' to the per-image table
         self.sqlite_classifier = SqliteClassifier()
         self.gui_parent = None
@@ -303,8 +699,10 @@ class DBConnect(Singleton):
             
     def connect(self, empty_sqlite_db=False):
         '''
-        Attempts to create a new connection to the specified database using
-          the current thread name as a connection ID.
+        Checks out a connection to the specified database for the current
+          thread, using the thread name as a connection ID. Idle pooled
+          connections are reused after a health check; otherwise a new
+          connection is opened if the pool is not full.
         If properties.db_type is 'sqlite', it will create a sqlite db in a
           temporary directory from the csv files specified by
           properties.image_csv_file and properties.object_csv_file
@@ -317,20 +715,39 @@ class DBConnect(Singleton):
             if self.connectionInfo[connID] == (p.db_host, p.db_user, 
                                                (p.db_passwd or None), p.db_name):
                 logging.warn('A connection already exists for this thread. %s as %s@%s (connID = "%s").'%(p.db_name, p.db_user, p.db_host, connID))
+                self.DiscardConnection(connID)
             else:
                 raise DBException('A connection already exists for this thread (%s). Close this connection first.'%(connID,))
 
+        self._reclaim_dead_connections()
+        pooled = self.connection_pool.checkout(self._connection_is_alive,
+                                               self._reclaim_dead_connections)
+        if pooled is not None:
+            conn, info = pooled
+            self._bind_connection(connID, conn, info)
+            logging.debug('[%s] Reusing pooled database connection'%(connID))
+            return
+        try:
+            self._open_connection(connID, empty_sqlite_db)
+        except:
+            # free the slot reserved for this connection
+            conn = self.connections.pop(connID, None)
+            self.cursors.pop(connID, None)
+            self.connectionInfo.pop(connID, None)
+            self.connection_pool.discard(conn)
+            raise
+        self.connection_pool.created()
+
+    def _open_connection(self, connID, empty_sqlite_db=False):
+        '''Opens a brand new connection for connID.'''
         # MySQL database: connect normally
         if p.db_type.lower() == 'mysql':
             import MySQLdb
-            from MySQLdb.cursors import SSCursor
             try:
                 conn = MySQLdb.connect(host=p.db_host, db=p.db_name, 
                                        user=p.db_user, passwd=(p.db_passwd or None))
-                self.connections[connID] = conn
-                self.cursors[connID] = SSCursor(conn)
-                self.connectionInfo[connID] = (p.db_host, p.db_user, 
-                                               (p.db_passwd or None), p.db_name)
+                self._bind_connection(connID, conn, (p.db_host, p.db_user, 
+                                                     (p.db_passwd or None), p.db_name))
                 logging.debug('[%s] Connected to database: %s as %s@%s'%(connID, p.db_name, p.db_user, p.db_host))
                 if p.classification_type == 'image':
                     self.CreateObjectImageTable()
@@ -370,56 +787,8 @@ class DBConnect(Singleton):
                     
                 p.db_sqlite_file = os.path.join(dbpath, dbname)
             logging.info('[%s] SQLite file: %s'%(connID, p.db_sqlite_file))
-            self.connections[connID] = sqlite.connect(p.db_sqlite_file)
-            self.connections[connID].text_factory = str
-            self.cursors[connID] = self.connections[connID].cursor()
-            self.connectionInfo[connID] = ('sqlite', 'cpa_user', '', 'CPA_DB')
-            self.connections[connID].create_function('greatest', -1, max)
-            # Create MEDIAN function
-            class median:
-                def __init__(self):
-                    self.reset()
-                def reset(self):
-                    self.values = []
-                def step(self, val):
-                    if val is not None:
-                        if not np.isnan(float(val)):
-                            self.values.append(float(val))
-                def finalize(self):
-                    n = len(self.values)
-                    if n == 0:
-                        return None
-                    self.values.sort()
-                    if n%2 == 1:
-                        return self.values[n//2]
-                    else:
-                        return (self.values[n//2-1] + self.values[n//2]) / 2
-            self.connections[connID].create_aggregate('median', 1, median)
-            # Create STDDEV function
-            class stddev:
-                def __init__(self):
-                    self.reset()
-                def reset(self):
-                    self.values = []
-                def step(self, val):
-                    if val is not None:
-                        if not np.isnan(float(val)):
-                            self.values.append(float(val))
-                def finalize(self):
-                    if len(self.values) == 0:
-                        return None
-                    avg = np.mean(self.values)
-                    b = np.sum([(x-avg)**2 for x in self.values])
-                    std = np.sqrt(b/len(self.values))
-                    return std
-            self.connections[connID].create_aggregate('stddev', 1, stddev)
-            # Create REGEXP function
-            def regexp(expr, item):
-                reg = re.compile(expr)
-                return reg.match(item) is not None
-            self.connections[connID].create_function("REGEXP", 2, regexp)
-            # Create classifier function
-            self.connections[connID].create_function('classifier', -1, self.sqlite_classifier.classify)
+            self._bind_connection(connID, self._new_sqlite_connection(), 
+                                  ('sqlite', 'cpa_user', '', 'CPA_DB'))
             
             try:
                 # Try the connection
@@ -429,23 +798,23 @@ class DBConnect(Singleton):
                     self.GetAllImageKeys()
             except Exception:
                 # If this is the first connection, then we need to create the DB from the csv files
-                if len(self.connections) == 1:
+                if self.connection_pool.size == 1:
                     if p.db_sql_file:
                         # TODO: prompt user "create db, y/n"
                         logging.info('[%s] Creating SQLite database at: %s.'%(connID, p.db_sqlite_file))
                         try:
                             self.CreateSQLiteDBFromCSVs()
                         except Exception as e:
-                            try:
-                                if os.path.isfile(p.db_sqlite_file):
-                                    os.remove(p.db_sqlite_file)
-                            except:
-                                pass
+                            self._remove_failed_sqlite_db(connID)
                             raise e
                     elif p.image_csv_file and p.object_csv_file:
                         # TODO: prompt user "create db, y/n"
                         logging.info('[%s] Creating SQLite database at: %s.'%(connID, p.db_sqlite_file))
-                        self.CreateSQLiteDB()
+                        try:
+                            self.CreateSQLiteDB()
+                        except Exception as e:
+                            self._remove_failed_sqlite_db(connID)
+                            raise e
                     else:
                         raise DBException('Database at %s appears to be empty.'%(p.db_sqlite_file))
             if p.classification_type == 'image':
@@ -458,6 +827,81 @@ class DBConnect(Singleton):
         else:
             raise DBException("Unknown db_type in properties: '%s'\n"%(p.db_type))
 
+    def _remove_failed_sqlite_db(self, connID):
+        '''
+        Deletes a SQLite database that failed to be created, so it isn't
+        opened half-loaded the next time.  The import runs without a
+        rollback journal (see sqliteimport.IMPORT_PRAGMAS), so a rollback
+        can't undo what was written.
+        '''
+        try:
+            self.connections[connID].close()
+        except Exception:
+            pass
+        try:
+            if os.path.isfile(p.db_sqlite_file):
+                os.remove(p.db_sqlite_file)
+        except:
+            pass
+
+    def _new_sqlite_connection(self):
+        '''
+        Opens a connection to p.db_sqlite_file and registers the SQL
+        functions CPA needs (greatest, median, stddev, REGEXP, classifier).
+        '''
+        import sqlite3 as sqlite
+        # Pooled connections may be handed to a different thread later, but
+        # only ever to one thread at a time.
+        conn = sqlite.connect(p.db_sqlite_file, check_same_thread=False)
+        conn.text_factory = str
+        conn.create_function('greatest', -1, max)
+        # Create MEDIAN function
+        class median:
+            def __init__(self):
+                self.reset()
+            def reset(self):
+                self.values = []
+            def step(self, val):
+                if val is not None:
+                    if not np.isnan(float(val)):
+                        self.values.append(float(val))
+            def finalize(self):
+                n = len(self.values)
+                if n == 0:
+                    return None
+                self.values.sort()
+                if n%2 == 1:
+                    return self.values[n//2]
+                else:
+                    return (self.values[n//2-1] + self.values[n//2]) / 2
+        conn.create_aggregate('median', 1, median)
+        # Create STDDEV function
+        class stddev:
+            def __init__(self):
+                self.reset()
+            def reset(self):
+                self.values = []
+            def step(self, val):
+                if val is not None:
+                    if not np.isnan(float(val)):
+                        self.values.append(float(val))
+            def finalize(self):
+                if len(self.values) == 0:
+                    return None
+                avg = np.mean(self.values)
+                b = np.sum([(x-avg)**2 for x in self.values])
+                std = np.sqrt(b/len(self.values))
+                return std
+        conn.create_aggregate('stddev', 1, stddev)
+        # Create REGEXP function
+        def regexp(expr, item):
+            reg = re.compile(expr)
+            return reg.match(item) is not None
+        conn.create_function("REGEXP", 2, regexp)
+        # Create classifier function
+        conn.create_function('classifier', -1, self.sqlite_classifier.classify)
+        return conn
+
     def setup_sqlite_classifier(self, thresh, a, b):
         self.sqlite_classifier.setup_classifier(thresh, a, b)
 
@@ -467,6 +911,8 @@ class DBConnect(Singleton):
         self.connections = {}
         self.cursors = {}
         self.connectionInfo = {}
+        self.connection_pool.close_all()
+        self.invalidate_cache()
         self.classifierColNames = None
     
     def CloseConnection(self, connID=None):
@@ -477,12 +923,102 @@ class DBConnect(Singleton):
                 self.connections[connID].commit()
             except: pass
             self.cursors.pop(connID)
-            self.connections.pop(connID).close()
+            self.connection_pool.discard(self.connections.pop(connID))
             (db_host, db_user, db_passwd, db_name) = self.connectionInfo.pop(connID)
             logging.info('Closed connection: %s as %s@%s (connID="%s").' % (db_name, db_user, db_host, connID))
         else:
             logging.warn('No database connection ID "%s" found!' %(connID))
 
+    def ReleaseConnection(self, connID=None):
+        '''
+        Returns the connection held by connID (default: the current thread)
+        to the pool so that other threads can reuse it. The thread will check
+        out a connection again the next time it executes a query.
+        '''
+        if not connID:
+            connID = threading.currentThread().getName()
+        if connID not in self.connections:
+            return
+        conn = self.connections.pop(connID)
+        cursor = self.cursors.pop(connID)
+        info = self.connectionInfo.pop(connID)
+        try:
+            # closing the cursor also drains any unread streamed results
+            cursor.close()
+            conn.commit()
+        except Exception as e:
+            logging.info('[%s] Dropping connection that could not be released: %s'%(connID, e))
+            self.connection_pool.discard(conn)
+            return
+        self.connection_pool.checkin(conn, info)
+        logging.debug('[%s] Released database connection to the pool'%(connID))
+
+    def DiscardConnection(self, connID=None):
+        '''
+        Closes the connection held by connID (default: the current thread)
+        without returning it to the pool, eg: because it has been lost.
+        '''
+        if not connID:
+            connID = threading.currentThread().getName()
+        if connID not in self.connections:
+            return
+        self.cursors.pop(connID, None)
+        self.connectionInfo.pop(connID, None)
+        self.connection_pool.discard(self.connections.pop(connID))
+
+    def GetPoolStatistics(self):
+        '''
+        Returns a dictionary of connection pool statistics: connections
+        created, reused, checked in, reclaimed from exited threads, discarded,
+        checkouts that had to wait, and the current size, idle count, number
+        checked out and max_size of the pool.
+        '''
+        stats = self.connection_pool.statistics()
+        stats['checked_out'] = len(self.connections)
+        return stats
+
+    def _bind_connection(self, connID, conn, info):
+        self.connections[connID] = conn
+        self.cursors[connID] = self._new_cursor(conn)
+        self.connectionInfo[connID] = info
+
+    def _new_cursor(self, conn):
+        if p.db_type.lower() == 'mysql':
+            # Server-side cursor so large results are streamed
+            from MySQLdb.cursors import SSCursor
+            return SSCursor(conn)
+        else:
+            return conn.cursor()
+
+    def _connection_is_alive(self, conn):
+        '''Health check run on idle connections before they are reused.'''
+        try:
+            cursor = self._new_cursor(conn)
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception as e:
+            if DBDisconnectedException.is_disconnect_error(e):
+                logging.info('Discarding pooled connection to the MySQL database that has gone away.')
+            else:
+                logging.info('Discarding pooled connection that failed health check: %s'%(e))
+            return False
+
+    def _reclaim_dead_connections(self):
+        '''Returns connections held by threads that have exited to the pool.'''
+        live = set([t.getName() for t in threading.enumerate()])
+        # hold the pool's lock so that threads reclaiming at the same time
+        # don't check in the same connection twice
+        self.connection_pool.cond.acquire()
+        try:
+            for connID in list(self.connections.keys()):
+                if connID not in live and connID in self.connections:
+                    self.ReleaseConnection(connID)
+                    self.connection_pool.stats['reclaimed'] += 1
+        finally:
+            self.connection_pool.cond.release()
+
     @DBDisconnectedException.with_mysql_retry
     def execute(self, query, args=None, silent=False, return_result=True):
         '''
@@ -517,7 +1053,7 @@ class DBConnect(Singleton):
                 return self._get_results_as_list()
         except Exception as e:
             try:
-                if isinstance(e, DBOperationalError()) and e.args[0] in [2006, 2013, 1053]:
+                if DBDisconnectedException.is_disconnect_error(e):
                     raise DBDisconnectedException()
                 else:
                     raise DBException('Database query failed for connection "%s"'
@@ -529,6 +1065,55 @@ class DBConnect(Singleton):
                                   '\nFirst exception was: %s'
                                   '\nSecond exception was: %s'%(connID, query, e, e2))
             
+    def execute_cached(self, query, silent=False):
+        '''
+        Like execute, but returns the result of an earlier run of the same
+        query if the object table hasn't changed since (see QueryCache).
+        Meant for read-only queries whose results are asked for again and
+        again, eg: filters, groups, table schemas and plotted columns.
+        Each caller gets its own list of the (immutable) result rows.
+        '''
+        return list(self._execute_cached(query, silent)[0])
+
+    def _execute_cached(self, query, silent=False):
+        '''Returns the (rows, column names) of a query, using the cache.'''
+        key = self._cache_key(query)
+        if key is not None:
+            hit, value = self.query_cache.get(key)
+            if hit:
+                return value
+        rows = self.execute(query, silent=silent)
+        cursor = self.cursors[threading.currentThread().getName()]
+        colnames = [d[0] for d in (cursor.description or [])]
+        if key is not None:
+            self.query_cache.put(key, (rows, colnames), estimate_result_size(rows))
+        return rows, colnames
+
+    def _cache_key(self, query):
+        '''
+        Returns the cache key for a query, or None if results can't be
+        cached because the modify date of the object table is unknown.
+        '''
+        now = time.time()
+        if now - self._cache_stamp_checked >= QUERY_CACHE_CHECK_INTERVAL:
+            self._cache_stamp_checked = now
+            try:
+                stamp = self.get_objects_modify_date()
+            except Exception as e:
+                logging.debug('Not caching query results: %s'%(e))
+                stamp = None
+            # eg: MySQL doesn't record update times for all table types
+            self._cache_stamp = None if stamp is None else str(stamp)
+        if self._cache_stamp is None:
+            return None
+        return (p.db_type, p.db_name, p.db_sqlite_file, self._cache_stamp, normalize_sql(query))
+
+    def invalidate_cache(self):
+        '''Forgets all cached query results.  Call after writing to the database.'''
+        self.query_cache.clear()
+        self._cache_stamp_checked = 0
+        logging.debug('Query cache cleared: %s'%(self.query_cache.statistics()))
+
     def Commit(self):
         connID = threading.currentThread().getName()
         try:
@@ -559,13 +1144,19 @@ class DBConnect(Singleton):
         connID = threading.currentThread().getName()
         return list(self.cursors[connID].fetchall())
 
-    def result_dtype(self):
+    def result_dtype(self, rows=None, cursor=None):
         """
         Return an appropriate descriptor for a numpy array in which the
-        result can be stored.
+        result can be stored.  MySQL cursors report column types; SQLite
+        cursors don't, so there the types are inferred from rows, a sample
+        of the result rows.
+        cursor -- cursor holding the result (default: this thread's cursor)
         """
-        #XXX: This doesn't work for SQLite... no cursor.description_flags
-        cursor = self.cursors[threading.currentThread().getName()]
+        if cursor is None:
+            cursor = self.cursors[threading.currentThread().getName()]
+        names = [d[0] for d in cursor.description]
+        if not hasattr(cursor, 'description_flags'):
+            return zip(names, infer_dtypes_from_rows(len(names), rows or []))
         descr = []
         for (name, type_code, display_size, internal_size, precision, 
              scale, null_ok), flags in zip(cursor.description, 
@@ -582,24 +1173,232 @@ class DBConnect(Singleton):
             if fun2 in [decimal.Decimal, types.FloatType]:
                 dtype = 'f8'
             elif fun2 in [types.IntType, types.LongType]:
-                dtype = 'i4'
+                dtype = 'i8'
             elif fun2 in [types.StringType]:
                 dtype = '|S%d'%(internal_size,)
+            else:
+                dtype = 'O'
             descr.append((name, dtype))
         return descr
 
-    def get_results_as_structured_array(self, n=None):
-        #XXX: this doesn't work for SQLite
-        col_names = self.GetResultColumnNames()
-        connID = threading.currentThread().getName()
-        records = []
+    def _batch_to_arrays(self, cursor, rows, feature_start, dtype, fill, 
+                         coltypes=None):
+        '''
+        Converts a batch of result rows from cursor into numpy arrays.
+        Returns (columns, matrix, coltypes) where columns holds 1-D arrays for
+        the first feature_start columns (all columns if feature_start is None),
+        matrix is the remaining columns as a 2-D array of dtype (or None) and
+        coltypes are the column dtypes to pass in with the next batch.
+        '''
+        ncols = len(cursor.description)
+        if coltypes is None:
+            coltypes = [dt for name, dt in self.result_dtype(rows, cursor)]
+        block = None
+        # Fast path: an all-numeric batch converts in one shot
+        if all([np.dtype(dt).kind in 'biuf' for dt in coltypes]):
+            try:
+                block = np.array(rows, dtype='f8')
+            except (TypeError, ValueError):
+                pass
+        if block is None:
+            block = np.array(rows, dtype=object)
+        if block.ndim == 1:
+            block = block.reshape((len(rows), ncols))
+        nkeys = ncols if feature_start is None else feature_start
+        columns = []
+        for i in range(nkeys):
+            col, coltypes[i] = _convert_column(block[:, i], coltypes[i])
+            columns.append(col)
+        matrix = None
+        if feature_start is not None:
+            matrix = to_float_array(block[:, feature_start:], fill).astype(dtype)
+        return columns, matrix, coltypes
+
+    def _fetch_columnar(self, feature_start=None, dtype='f8', fill=None,
+                        nrows=None, batch_size=DEFAULT_FETCH_SIZE):
+        '''
+        Streams the remaining results of the last query on this thread's
+        cursor into typed numpy arrays. See execute_columnar.
+        '''
+        cursor = self.cursors[threading.currentThread().getName()]
+        ncols = len(cursor.description)
+        capacity = nrows or batch_size
+        builders = None
+        coltypes = None
         while True:
-            r = self.cursors[connID].fetchmany(n)
-            print(len(r))
-            if len(r) == 0:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
                 break
-            records.extend(list(r))
-        return np.array(records, dtype=self.result_dtype())
+            columns, block, coltypes = self._batch_to_arrays(
+                cursor, rows, feature_start, dtype, fill, coltypes)
+            if builders is None:
+                builders = [_ArrayBuilder(col.dtype, capacity) for col in columns]
+                if feature_start is not None:
+                    matrix = _ArrayBuilder(dtype, capacity, ncols - feature_start)
+            for builder, col in zip(builders, columns):
+                builder.append(col)
+            if feature_start is not None:
+                matrix.append(block)
+        if builders is None:
+            coltypes = [dt for name, dt in self.result_dtype([], cursor)]
+            if feature_start is not None:
+                return ([np.empty(0, dtype=dt) for dt in coltypes[:feature_start]],
+                        np.empty((0, ncols - feature_start), dtype=dtype))
+            return [np.empty(0, dtype=dt) for dt in coltypes]
+        columns = [builder.result() for builder in builders]
+        if feature_start is not None:
+            return columns, matrix.result()
+        return columns
+
+    def execute_columnar(self, query, feature_start=None, dtype='f8', fill=None,
+                         nrows=None, batch_size=DEFAULT_FETCH_SIZE, silent=False):
+        '''
+        Executes the given query and returns the results column by column as
+        numpy arrays.  Rows are streamed from the cursor with fetchmany in
+        batches of batch_size straight into preallocated arrays, so the full
+        list of result tuples is never built.  Works for MySQL and SQLite.
+        
+        feature_start -- None to return a list of 1-D arrays, one per column,
+            with dtypes inferred from the cursor.  Otherwise, return a tuple
+            (key_columns, matrix) where key_columns is a list of 1-D arrays for
+            the first feature_start columns and matrix is a 2-D array of the
+            given dtype holding the remaining columns.
+        fill -- value for NULL and non-numeric entries of the matrix (these
+            are NaN when fill is None)
+        nrows -- expected number of rows, if known, used to size the arrays
+        '''
+        self.execute(query, silent=silent, return_result=False)
+        return self._fetch_columnar(feature_start, dtype, fill, nrows, batch_size)
+
+    def iter_query(self, query, batch_size=DEFAULT_FETCH_SIZE, feature_start=None,
+                   dtype='f8', fill=None, nrows=None, cb=None, silent=False):
+        '''
+        Executes the given query and yields its results in batches of at most
+        batch_size rows, so that arbitrarily large results can be processed in
+        constant memory.  Works for MySQL (server-side cursor) and SQLite.
+        
+        feature_start -- None to yield each batch as a list of row tuples.
+            Otherwise yield (key_columns, matrix) chunks as described in
+            execute_columnar.
+        nrows -- expected number of rows, if known, used for progress
+        cb -- callback function called with the fraction complete after each
+            batch has been consumed (0 if nrows is not given). It may raise an
+            exception (eg: StopCalculating) to cancel the query.
+        
+        The query runs on a separate pooled connection so the current thread
+        may execute other queries while it consumes the batches.  If no
+        connection is free, the thread's own connection is used instead and
+        other queries must wait until the iteration is finished.  Breaking
+        out of the loop early abandons the rest of the result.
+        '''
+        connID = threading.currentThread().getName()
+        if not connID in self.connections.keys():
+            # also makes sure the SQLite database has been created
+            self.connect()
+        try:
+            conn, info = self._checkout_private_connection()
+            cursor = self._new_cursor(conn)
+            private = True
+        except ConnectionPoolExhausted:
+            logging.debug('[%s] No free connection to stream query, using '
+                          'the connection of this thread.'%(connID))
+            cursor = self.cursors[connID]
+            private = False
+        if verbose and not silent:
+            logging.debug('[%s] (streaming) %s'%(connID, query))
+        exhausted = False
+        try:
+            try:
+                cursor.execute(query)
+            except Exception as e:
+                raise DBException('Database query failed for connection "%s"'
+                                  '\nQuery was: "%s"'
+                                  '\nException was: %s'%(connID, query, e))
+            coltypes = None
+            nread = 0
+            while True:
+                try:
+                    rows = cursor.fetchmany(batch_size)
+                except DBError() as e:
+                    raise DBException('Error retrieving results from database: %s'%(e,))
+                if len(rows) == 0:
+                    exhausted = True
+                    break
+                nread += len(rows)
+                if feature_start is None:
+                    yield list(rows)
+                else:
+                    columns, matrix, coltypes = self._batch_to_arrays(
+                        cursor, rows, feature_start, dtype, fill, coltypes)
+                    yield columns, matrix
+                if cb:
+                    cb(min(1.0, nread / float(nrows)) if nrows else 0.)
+        finally:
+            if private:
+                self._checkin_private_connection(conn, info, cursor, exhausted)
+            elif not exhausted and p.db_type.lower() == 'mysql':
+                # An unread streamed result blocks the connection
+                logging.info('[%s] Dropping connection with abandoned '
+                             'streamed results.'%(connID))
+                self.DiscardConnection(connID)
+
+    def _checkout_private_connection(self):
+        '''
+        Returns a (connection, connection_info) pair from the pool that is
+        not bound to any thread. Raises ConnectionPoolExhausted rather than
+        waiting if the pool is full.
+        '''
+        pooled = self.connection_pool.checkout(self._connection_is_alive,
+                                               self._reclaim_dead_connections,
+                                               block=False)
+        if pooled is not None:
+            return pooled
+        try:
+            if p.db_type.lower() == 'mysql':
+                import MySQLdb
+                info = (p.db_host, p.db_user, (p.db_passwd or None), p.db_name)
+                conn = MySQLdb.connect(host=p.db_host, db=p.db_name, 
+                                       user=p.db_user, passwd=(p.db_passwd or None))
+            else:
+                info = ('sqlite', 'cpa_user', '', 'CPA_DB')
+                conn = self._new_sqlite_connection()
+        except:
+            self.connection_pool.discard(None)
+            raise
+        self.connection_pool.created()
+        return conn, info
+
+    def _checkin_private_connection(self, conn, info, cursor, exhausted):
+        '''
+        Returns a connection from _checkout_private_connection to the pool.
+        MySQL connections whose streamed result was not read to the end are
+        closed instead, since draining the result could take a long time.
+        '''
+        if not exhausted and p.db_type.lower() == 'mysql':
+            self.connection_pool.discard(conn)
+            return
+        try:
+            cursor.close()
+            conn.commit()
+        except Exception as e:
+            logging.info('Dropping connection that could not be released: %s'%(e))
+            self.connection_pool.discard(conn)
+            return
+        self.connection_pool.checkin(conn, info)
+
+    def get_results_as_structured_array(self, n=None):
+        '''
+        Returns the remaining results of the last query as a numpy structured
+        array with one field per result column.
+        n -- number of rows to fetch per batch
+        '''
+        col_names = self.GetResultColumnNames()
+        columns = self._fetch_columnar(batch_size=(n or DEFAULT_FETCH_SIZE))
+        records = np.empty(len(columns[0]) if columns else 0, 
+                           dtype=[(name, col.dtype) for name, col in zip(col_names, columns)])
+        for name, col in zip(col_names, columns):
+            records[name] = col
+        return records
     
     def GetObjectIDAtIndex(self, imKey, index):
         '''
@@ -610,8 +1409,10 @@ class DBConnect(Singleton):
         index: a POSITIVE integer (1,2,3...)
         '''
         where_clause = " AND ".join(['%s=%s'%(col, val) for col, val in zip(image_key_columns(), imKey)])
-        object_number = self.execute('SELECT %s FROM %s WHERE %s LIMIT %s,1'
-                                     %(p.object_id, p.object_table, where_clause, index - 1))
+        # objects are ordered by ID to agree with DataModel's object index
+        object_number = self.execute('SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT %s,1'
+                                     %(p.object_id, p.object_table, where_clause, 
+                                       p.object_id, index - 1))
         object_number = object_number[0][0]
         return tuple(list(imKey)+[int(object_number)])
     
@@ -649,15 +1450,32 @@ class DBConnect(Singleton):
                         p.cell_x_loc, p.cell_y_loc, p.object_table, 
                         GetWhereClauseForObjects([obKey])), silent=silent)
         if len(res) == 0 or res[0][0] is None or res[0][1] is None:
-            message = ('Failed to load coordinates for object key %s. This may '
-                       'indicate a problem with your per-object table.\n'
-                       'You can check your per-object table "%s" in TableViewer'
-                       %(', '.join(['%s:%s'%(col, val) for col, val in 
-                                    zip(object_key_columns(), obKey)]), 
-                       p.object_table))
-            raise Exception(message)
+            raise Exception(self._missing_coords_message(obKey))
         else:
             return res[0]
+
+    def GetObjectCoordsBatch(self, obKeys, none_ok=False, silent=False):
+        '''
+        Returns an Nx2 array of the x, y coordinates of the given objects, in
+        the order of obKeys, looked up in a single query.
+        none_ok -- if True, objects without coordinates get NaN rows instead
+            of raising an exception.
+        '''
+        coords = self._lookup_objects(obKeys, [p.cell_x_loc, p.cell_y_loc], 
+                                      silent=silent)
+        if not none_ok:
+            bad = np.flatnonzero(np.isnan(coords).any(axis=1))
+            if len(bad) > 0:
+                raise Exception(self._missing_coords_message(obKeys[bad[0]]))
+        return coords
+
+    def _missing_coords_message(self, obKey):
+        return ('Failed to load coordinates for object key %s. This may '
+                'indicate a problem with your per-object table.\n'
+                'You can check your per-object table "%s" in TableViewer'
+                %(', '.join(['%s:%s'%(col, val) for col, val in 
+                             zip(object_key_columns(), obKey)]), 
+                  p.object_table))
     
     def GetAllObjectCoordsFromImage(self, imKey):
         ''' Returns a list of lists x, y coordinates for all objects in the given image. '''
@@ -733,13 +1551,13 @@ class DBConnect(Singleton):
                                                           ','.join(image_key_columns()))
             query = query[:where_idx] + join_clause + query[where_idx:]
         try:
-            res = self.execute(query)
+            res, col_names = self._execute_cached(query)
         except DBException as e:
             raise DBException('Group query failed for group "%s". Check the SQL'
                               ' syntax in your properties file.\n'
                               'Error was: "%s"'%(group, e))
         
-        col_names = self.GetResultColumnNames()[key_size:]
+        col_names = col_names[key_size:]
         from_clause = query[from_idx+6 : where_idx].strip()
         if ',' not in from_clause and ' ' not in from_clause:
             col_names = ['%s.%s'%(from_clause, col) for col in col_names]
@@ -780,7 +1598,7 @@ class DBConnect(Singleton):
         ''' Returns a list of imKeys from the given filter. '''
         try:
             f = p._filters[filter_name]
-            return self.execute(self.filter_sql(filter_name))
+            return self.execute_cached(self.filter_sql(filter_name))
         except Exception as e:
             logging.error('Filter query failed for filter "%s". Check the MySQL syntax in your properties file.'%(filter_name))
             logging.error(e)
@@ -808,8 +1626,8 @@ class DBConnect(Singleton):
     def GetColumnNames(self, table):
         '''Returns a list of the column names for the specified table. '''
         # NOTE: SQLite doesn't like DESCRIBE or SHOW statements so we do it this way.
-        self.execute('SELECT * FROM %s LIMIT 1'%(table))
-        return self.GetResultColumnNames()   # return the column names
+        rows, col_names = self._execute_cached('SELECT * FROM %s LIMIT 1'%(table))
+        return list(col_names)   # return the column names
     
 
     
@@ -1044,10 +1862,10 @@ class DBConnect(Singleton):
     def GetColumnTypeStrings(self, table):
         '''Returns the SQL type string for each column of the given table.'''
         if p.db_type.lower() == 'sqlite':
-            res = self.execute('PRAGMA table_info(%s)'%(table))
+            res = self.execute_cached('PRAGMA table_info(%s)'%(table))
             return [r[2] for r in res]
         elif p.db_type == 'mysql':
-            res = self.execute('SHOW COLUMNS FROM %s'%(table))
+            res = self.execute_cached('SHOW COLUMNS FROM %s'%(table))
             return [r[1] for r in res]
         
     def GetColumnTypeString(self, table, colname):
@@ -1148,6 +1966,87 @@ class DBConnect(Singleton):
         values = [x if type(x) in [int, long, float] else 0.0 for x in data[0]]
         return np.array(values)
 
+    def GetCellDataBatch(self, obKeys, columns=None):
+        '''
+        Returns the measurements of the given objects as a 2-D array with
+        one row per key, in the order of obKeys, looked up in a single query.
+        columns -- the object table columns to return (default: all).
+        Non-numeric values are returned as 0 like in GetCellData.  Objects
+        that aren't in the object table get rows of NaN.
+        '''
+        if columns is None:
+            select = ['o.*']
+        else:
+            select = ['o.`%s`'%(col) for col in columns]
+        data = self._lookup_objects(obKeys, select, fill=0.0, silent=True)
+        missing = np.flatnonzero(np.isnan(data).all(axis=1)) if data.shape[1] else []
+        if len(missing) > 0:
+            logging.error('No data for %d of %d obKeys, eg: %s'%(
+                len(missing), len(obKeys), str(obKeys[missing[0]])))
+        return data
+
+    def _lookup_objects(self, obKeys, select, fill=None, silent=False):
+        '''
+        Selects the given expressions (on the object table aliased as "o")
+        for each key in obKeys by joining the object table against a
+        temporary table of the keys.  Returns a float array with one row per
+        key in the order of obKeys.  Rows of keys that aren't found are NaN.
+        '''
+        self._fill_key_table(obKeys, object_key_columns())
+        try:
+            on = ' AND '.join(['o.%s = k.%s'%(col, col) for col in object_key_columns()])
+            query = 'SELECT k._pos, %s FROM %s k JOIN %s o ON %s'%(
+                ', '.join(select), KEY_TABLE, p.object_table, on)
+            (pos,), values = self.execute_columnar(query, feature_start=1, 
+                                                   fill=fill, silent=silent)
+        finally:
+            self._drop_key_table()
+        result = np.empty((len(obKeys), values.shape[1]))
+        result.fill(np.nan)
+        result[pos.astype(int)] = values
+        return result
+
+    def insert_rows(self, table, columns, rows):
+        '''
+        Inserts rows (a sequence of tuples of python values) into the given
+        columns of a table with a single parameterized executemany on this
+        thread's connection.  The caller commits.
+        '''
+        connID = threading.currentThread().getName()
+        if not connID in self.connections.keys():
+            self.connect()
+        placeholder = '?' if p.db_type.lower() == 'sqlite' else '%s'
+        insert = 'INSERT INTO %s (%s) VALUES (%s)'%(table, ', '.join(columns),
+                                                    ', '.join([placeholder] * len(columns)))
+        try:
+            self.cursors[connID].executemany(insert, rows)
+        except Exception as e:
+            raise DBException('Failed to insert rows into %s: %s'%(table, e))
+
+    def _fill_key_table(self, keys, columns, table=KEY_TABLE):
+        '''
+        Creates a temporary table on this thread's connection holding the
+        given keys, with an index on the key columns and a _pos column
+        giving each key's position in the list.
+        '''
+        connID = threading.currentThread().getName()
+        if not connID in self.connections.keys():
+            self.connect()
+        self._drop_key_table(table)
+        self.execute('CREATE TEMPORARY TABLE %s (_pos INTEGER, %s)'%(
+            table, ', '.join(['%s INTEGER'%(col) for col in columns])), return_result=False)
+        rows = [tuple([i] + [int(k) for k in key]) for i, key in enumerate(keys)]
+        self.insert_rows(table, ['_pos'] + list(columns), rows)
+        self.execute('CREATE INDEX %s_idx ON %s (%s)'%(table, table, ', '.join(columns)), 
+                     return_result=False)
+
+    def _drop_key_table(self, table=KEY_TABLE):
+        if p.db_type.lower() == 'sqlite':
+            self.execute('DROP TABLE IF EXISTS %s'%(table), return_result=False)
+        else:
+            # DROP TEMPORARY doesn't commit the current transaction
+            self.execute('DROP TEMPORARY TABLE IF EXISTS %s'%(table), return_result=False)
+
     def GetPlateNames(self):
         '''
         Returns the names of each plate in the per-image table.
@@ -1215,6 +2114,7 @@ class DBConnect(Singleton):
         if not re.match('^[A-Za-z]\w*$', colname):
             raise ValueError('Column name may contain only alphanumeric characters and underscore, and must begin with a letter.')
         self.execute('ALTER TABLE %s ADD %s %s'%(table, colname, coltype))
+        self.invalidate_cache()
         
     def UpdateWells(self, table, colname, value, wellkeys):
         '''
@@ -1234,92 +2134,66 @@ class DBConnect(Singleton):
                                                 GetWhereClauseForWells(wellkeys)))
         # for some reason non string columns need to be committed or they will not be saved
         self.Commit()
+        self.invalidate_cache()
     
     def CreateSQLiteDB(self):
         '''
         Creates an SQLite database from files specified in properties
         image_csv_file and object_csv_file.
         '''
-        import csv
-        # CREATE THE IMAGE TABLE
-        # All the ugly code is to establish the type of each column in the table
-        # so we can form a proper CREATE TABLE statement.
-        f = open(p.image_csv_file, 'U')
-        r = csv.reader(f)
-        columnLabels = r.next()
-        columnLabels = [lbl.strip() for lbl in columnLabels]
-
-        dtable = get_data_table_from_csv_reader(r)
-        colTypes = self.InferColTypesFromData(dtable, len(columnLabels))
-        
-        # Build the CREATE TABLE statement
-        statement = 'CREATE TABLE '+p.image_table+' ('
-        statement += ',\n'.join([lbl+' '+colTypes[i] for i, lbl in enumerate(columnLabels)])
-        keys = ','.join([x for x in [p.table_id, p.image_id, p.object_id] if x in columnLabels])
-        statement += ',\nPRIMARY KEY (' + keys + ') )'
-        f.close()
-        
-        logging.info('Creating table: %s'%(p.image_table))
-        self.execute('DROP TABLE IF EXISTS %s'%(p.image_table))
-        self.execute(statement)
-
+        tables = [(p.image_table, p.image_csv_file)]
         if not p.classification_type == 'image':
-            # CREATE THE OBJECT TABLE
-            # For the object table we assume that all values are type FLOAT
-            # except for the primary keys
-            f = open(p.object_csv_file, 'U')
-            r = csv.reader(f)
-            columnLabels = r.next()
-            columnLabels = [lbl.strip() for lbl in columnLabels]
-            dtable = get_data_table_from_csv_reader(r)
-            colTypes = self.InferColTypesFromData(dtable, len(columnLabels))
-            statement = 'CREATE TABLE '+p.object_table+' ('
+            tables += [(p.object_table, p.object_csv_file)]
+        
+        index_stmts = []
+        jobs = []
+        for table, csv_file in tables:
+            # Establish the type of each column in the table from a sample of
+            # the rows so we can form a proper CREATE TABLE statement.
+            columnLabels, colTypes = self.InferColTypesFromCSV(csv_file)
+            statement = 'CREATE TABLE '+table+' ('
             statement += ',\n'.join([lbl+' '+colTypes[i] for i, lbl in enumerate(columnLabels)])
             keys = ','.join([x for x in [p.table_id, p.image_id, p.object_id] if x in columnLabels])
             statement += ',\nPRIMARY KEY (' + keys + ') )'
-            f.close()
-
-            logging.info('Creating table: %s'%(p.object_table))
-            self.execute('DROP TABLE IF EXISTS '+p.object_table)
+            
+            logging.info('Creating table: %s'%(table))
+            self.execute('DROP TABLE IF EXISTS %s'%(table))
+            # primary key indexes are built after the tables have been loaded
+            statement, index = defer_primary_key(statement)
             self.execute(statement)
+            if index:
+                index_stmts.append(index)
+            jobs.append((table, csv_file, True))
         
-        # POPULATE THE IMAGE TABLE
-        f = open(p.image_csv_file, 'U')
-        r = csv.reader(f)
-        row = r.next() # skip the headers
-        row = r.next()
-        while row:
-            self.execute('INSERT INTO '+p.image_table+' VALUES ('+','.join(["'%s'"%(i) for i in row])+')',
-                         silent=True)
-            try:
-                row = r.next()
-            except StopIteration:
-                break
-        f.close()
-        
-        # POPULATE THE OBJECT TABLE
-        if not p.classification_type == 'image':
-            f = open(p.object_csv_file, 'U')
+        # POPULATE THE TABLES
+        # The importer converts the values to the column types and binds them
+        # with executemany, committing once at the end.
+        self._import_csvs(jobs, index_stmts)
+
+    def InferColTypesFromCSV(self, filename, sample_rows=TYPE_SAMPLE_ROWS):
+        '''
+        Returns the column labels of a CSV file with a header row and the
+        column types (see InferColTypesFromData) that its first sample_rows
+        rows can be converted to.  Only the sample is read.  SQLite uses the
+        declared types as a preference only, so values further down that
+        don't fit a column's type are still stored.
+        '''
+        import csv
+        import itertools
+        f = open(filename, 'U')
+        try:
             r = csv.reader(f)
-            row = r.next() # skip the headers
-            row = r.next()
-            while row:
-                self.execute('INSERT INTO '+p.object_table+' VALUES ('+','.join(["'%s'"%(i) for i in row])+')',
-                             silent=True)
-                try:
-                    row = r.next()
-                except StopIteration: break
+            columnLabels = [lbl.strip() for lbl in r.next()]
+            sample = [row for row in itertools.islice(r, sample_rows) if len(row) > 0]
+        finally:
             f.close()
-        
-        self.Commit()
+        return columnLabels, self.InferColTypesFromData(sample, len(columnLabels))
         
     def CreateSQLiteDBFromCSVs(self):
         '''
         Creates an SQLite database from files generated by CellProfiler's
         ExportToDatabase module.
         '''
-        import csv
-        
         imcsvs, obcsvs = get_csv_filenames_from_sql_file()
                 
         # Verify that the CSVs exist
@@ -1353,35 +2227,42 @@ class DBConnect(Singleton):
                     in_create_stmt = True
         f.close()
         
+        # primary key indexes are built after the tables have been loaded
+        index_stmts = []
         for q in create_stmts:
+            q, index = defer_primary_key(q)
             self.execute(q)
+            if index:
+                index_stmts.append(index)
         
+        jobs = [(p.image_table, os.path.join(csv_dir, file), False) for file in imcsvs]
+        if not p.classification_type == 'image':
+            assert len(obcsvs)>0, ('Failed to parse object csv filenames from %s. '
+                              'Make sure db_sql_file in your properties file is'
+                              ' set to the .SQL file output by CellProfiler\'s '
+                              'ExportToDatabase module.'%(os.path.split(p.db_sql_file)[1]))
+            if p.check_tables:
+                object_table = p.object_table.split('_checked')[0]
+            else:
+                object_table = p.object_table
+            jobs += [(object_table, os.path.join(csv_dir, file), False) for file in obcsvs]
+        
+        self._import_csvs(jobs, index_stmts)
+
+    def _import_csvs(self, jobs, index_stmts):
+        '''
+        Loads CSV files into the (already created) tables of the SQLite
+        database of this thread, then runs index_stmts.
+        jobs -- list of (table, filename, skip_header) tuples
+        '''
         import wx
         if self.gui_parent is not None and issubclass(self.gui_parent.__class__, wx.Window):
             dlg = wx.ProgressDialog('Creating sqlite DB...', '0% Complete', 100, self.gui_parent, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
         else:
             dlg = None
 
-        # find the number of bytes we're going to read
-        total_bytes = 0
-        for file in imcsvs + obcsvs:
-            total_bytes += os.path.getsize(os.path.join(csv_dir, file))
-        total_bytes = float(total_bytes)
-
-        base_bytes = 0
-        connID = threading.currentThread().getName()
-        # populate tables with contents of csv files
-        for file in imcsvs:
-            logging.info('Populating image table with data from %s'%file)
-            f = open(os.path.join(csv_dir, file), 'U')
-            r = csv.reader(f)
-            row1 = r.next()
-            command = 'INSERT INTO '+p.image_table+' VALUES ('+','.join(['?' for i in row1])+')'
-            self.cursors[connID].execute(command, row1)
-            self.cursors[connID].executemany(command, [l for l in r if len(l)>0])
-            f.close()
-            base_bytes += os.path.getsize(os.path.join(csv_dir, file))
-            pct = min(int(100 * base_bytes / total_bytes), 100)
+        def update(fraction):
+            pct = min(int(100 * fraction), 100)
             if dlg:
                 c, s = dlg.Update(pct, '%d%% Complete'%(pct))
                 if not c:
@@ -1394,59 +2275,34 @@ class DBConnect(Singleton):
                                       'the next time use use the current '
                                       'database settings.', 'Error')
                     raise Exception('cancelled load')
-            logging.info("... loaded %d%% of CSV data"%(pct))
 
-        line_count = 0
-        if not p.classification_type == 'image':
-            assert len(obcsvs)>0, ('Failed to parse object csv filenames from %s. '
-                              'Make sure db_sql_file in your properties file is'
-                              ' set to the .SQL file output by CellProfiler\'s '
-                              'ExportToDatabase module.'%(os.path.split(p.db_sql_file)[1]))
+        connID = threading.currentThread().getName()
+        importer = SQLiteImporter(self.connections[connID], 
+                                  n_workers=self._import_workers(), cb=update)
+        try:
+            # Commits only at the very end. No use in committing if the db is
+            # incomplete.
+            importer.load(jobs)
+            logging.info("Finished loading CSV data")
+            if dlg:
+                dlg.Update(100, 'Creating indexes...')
+            for q in index_stmts:
+                logging.info('Creating index: %s'%(q))
+                self.execute(q)
+            self.Commit()
+        finally:
+            if dlg:
+                dlg.Destroy()
 
-            for file in obcsvs:
-                logging.info('Populating object table with data from %s'%file)
-                f = open(csv_dir+os.path.sep+file, 'U')
-                r = csv.reader(f)
-                row1 = r.next()
-                if p.check_tables:
-                    object_table = p.object_table
-                    object_table = object_table.split('_checked')[0]
-                    command = 'INSERT INTO '+object_table+' VALUES ('+','.join(['?' for i in row1])+')'
-                else:
-                    command = 'INSERT INTO '+p.object_table+' VALUES ('+','.join(['?' for i in row1])+')'
-                # guess at a good number of lines, about 250 megabytes, assuming floats)
-                nlines = (250*1024*1024) / (len(row1) * 64)
-                self.cursors[connID].execute(command, row1)
-                while True:
-                    # fetch a certain number of lines efficiently
-                    args = [l for idx, l in zip(range(nlines), r) if len(l) > 0]
-                    if args == []:
-                        break
-                    self.cursors[connID].executemany(command, args)
-                    line_count += len(args)
-
-                    pct = min(int(100 * (f.tell() + base_bytes) / total_bytes), 100)
-                    if dlg:
-                        c, s = dlg.Update(pct, '%d%% Complete'%(pct))
-                        if not c:
-                            try:
-                                os.remove(p.db_sqlite_file)
-                            except OSError:
-                                wx.MessageBox('Could not remove incomplete database'
-                                              ' at "%s". This file must be removed '
-                                              'manually or CPAnalyst will load it '
-                                              'the next time use use the current '
-                                              'database settings.', 'Error')
-                            raise Exception('cancelled load')
-                    logging.info("... loaded %d%% of CSV data"%(pct))
-                f.close()
-                logging.info("Finished loading CSV data")
-                base_bytes += os.path.getsize(os.path.join(csv_dir, file))
-
-        # Commit only at very end. No use in committing if the db is incomplete.
-        self.Commit()
-        if dlg:
-            dlg.Destroy()
+    def _import_workers(self):
+        '''Number of CSV parsing processes set by db_import_workers, or None.'''
+        if not p.db_import_workers:
+            return None
+        try:
+            return max(0, int(p.db_import_workers))
+        except ValueError:
+            logging.warn('Invalid db_import_workers "%s", using the default.'%(p.db_import_workers))
+            return None
 
     def GetImageWidthHeight(self,list_of_cols):
         # Get image width and height
@@ -1582,6 +2438,7 @@ class DBConnect(Singleton):
             self.execute('CREATE TABLE %s (%s)'%(tablename, coldefs))
         else:
             self.execute('CREATE TEMPORARY TABLE %s (%s)'%(tablename, coldefs))
+        self.invalidate_cache()
 
     def create_default_indexes_on_table(self, tablename):
         '''automatically adds indexes to all the image, object, and well key 
@@ -1628,6 +2485,7 @@ class DBConnect(Singleton):
         logging.info('Populating %stable %s...'%((temporary and 'temporary ' or ''), tablename))
         self.insert_rows_into_table(tablename, colnames, coltypes, dtable)
         self.Commit()
+        self.invalidate_cache()
         return True
     
     def is_view(self, table):
@@ -1769,6 +2627,72 @@ class DBConnect(Singleton):
     def register_gui_parent(self, parent):
         self.gui_parent = parent
 
+
+
+class KeySet(object):
+    '''
+    A list of image keys or object keys to restrict a query to.  Up to
+    inline_limit keys are matched with an inline IN/OR clause (see
+    GetWhereClauseForImages and GetWhereClauseForObjects).  Larger sets are
+    loaded into a temporary table with an index on the key columns, so the
+    query stays small however many keys there are.
+
+    The temporary table belongs to the current thread's connection and
+    exists for the duration of a with block, so the query must be run on
+    that thread with execute (not iter_query):
+        with KeySet(obKeys) as keys:
+            db.execute('SELECT ... FROM %s WHERE %s'%(
+                p.object_table, keys.where_clause(p.object_table)))
+    '''
+    _ids = itertools.count()
+
+    def __init__(self, keys, inline_limit=INLINE_KEY_LIMIT):
+        self.keys = [tuple(key) for key in keys]
+        self.is_image_keys = (len(self.keys) > 0 and
+                              len(self.keys[0]) == len(image_key_columns()))
+        self.inline_limit = inline_limit
+        self.table = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key_columns(self, table_name=''):
+        if self.is_image_keys:
+            return image_key_columns(table_name)
+        return object_key_columns(table_name)
+
+    def __enter__(self):
+        if len(self.keys) > self.inline_limit:
+            self.table = '_cpa_keyset_%d'%(next(KeySet._ids))
+            DBConnect.getInstance()._fill_key_table(self.keys, self.key_columns(), self.table)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.table is not None:
+            table, self.table = self.table, None
+            DBConnect.getInstance()._drop_key_table(table)
+        return False
+
+    def where_clause(self, table_name):
+        '''
+        Returns a WHERE clause that matches the keys in the given table.
+        table_name qualifies the key columns, which the clause compares
+        with the temporary table's.
+        '''
+        if len(self.keys) == 0:
+            return '0=1'
+        if self.table is None:
+            if self.is_image_keys:
+                return GetWhereClauseForImages(list(self.keys), table_name)
+            return GetWhereClauseForObjects(self.keys, table_name)
+        columns = self.key_columns()
+        if len(columns) == 1:
+            return '%s IN (SELECT %s FROM %s)'%(self.key_columns(table_name)[0],
+                                                columns[0], self.table)
+        return 'EXISTS (SELECT 1 FROM %s _k WHERE %s)'%(self.table, ' AND '.join(
+            ['_k.%s = %s'%(col, qualified) for col, qualified in 
+             zip(columns, self.key_columns(table_name))]))
+
         
 class Entity(object):
     """Abstract class containing code that is common to Images and
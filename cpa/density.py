@@ -232,7 +232,7 @@ class DataSourcePanel(wx.Panel):
         if self.filter != None:
             q.add_filter(self.filter)
             
-        return db.execute(str(q))
+        return db.execute_cached(str(q))
         
     def save_settings(self):
         '''save_settings is called when saving a workspace to file.
@@ -1,10 +1,12 @@
 from __future__ import print_function
 import re
+import crossvalidation
 import dbconnect
 import logging
 import multiclasssql_legacy as multiclasssql # Legacy code for scoring cells
 import numpy as np
 import matplotlib.pyplot as plt
+from fastgentleboostingmulticlass import WeakLearnerSearch, StumpEvaluator
 from sys import stdin, stdout, argv, exit
 from time import time
 
@@ -17,6 +19,7 @@ class FastGentleBoosting(object):
         self.classBins = []
         self.classifier = classifier
         self.features = []
+        self.n_jobs = crossvalidation.default_num_jobs() # processes to cross-validate in
 
     # Set features
     def _set_features(self, features):
@@ -64,26 +67,30 @@ class FastGentleBoosting(object):
         scale = step_time_1 / (10 * step_time_1 + step_time_2)
 
         xvalid_50 = []
+        colnames = self.classifier.trainingSet.colnames
+        label_matrix = self.classifier.trainingSet.label_matrix
+        values = self.classifier.trainingSet.values
 
         try:
-            n_iter = 1
-            for i in range(10):
-                xval = self.XValidate(
-                    self.classifier.trainingSet.colnames, nRules, self.classifier.trainingSet.label_matrix,
-                    self.classifier.trainingSet.values, 2, groups, progress_callback)
-                if xval is not None:
-                    xvalid_50 += xval
-                    n_iter += 1
-
-                # each round makes one "scale" size step in progress
-                base += scale
-            xvalid_50 = sum(xvalid_50) / float(n_iter)
-
-            # only one more step
-            scale = 1.0 - base
-            xvalid_95 = self.XValidate(
-                self.classifier.trainingSet.colnames, nRules, self.classifier.trainingSet.label_matrix,
-                self.classifier.trainingSet.values, 20, groups, progress_callback)
+            # the examples are sorted, and sent to the worker processes,
+            # once for all 11 cross-validations
+            with self.FoldPool(colnames, nRules, label_matrix, values) as pool:
+                n_iter = 1
+                for i in range(10):
+                    xval = self.XValidate(colnames, nRules, label_matrix, values, 2, groups,
+                                          progress_callback, pool=pool)
+                    if xval is not None:
+                        xvalid_50 += xval
+                        n_iter += 1
+
+                    # each round makes one "scale" size step in progress
+                    base += scale
+                xvalid_50 = sum(xvalid_50) / float(n_iter)
+
+                # only one more step
+                scale = 1.0 - base
+                xvalid_95 = self.XValidate(colnames, nRules, label_matrix, values, 20, groups,
+                                           progress_callback, pool=pool)
 
             dlg.Destroy()
             figure = plt.figure()
@@ -162,6 +169,9 @@ class FastGentleBoosting(object):
     def PerImageCounts(self, filter_name=None, cb=None):
         return multiclasssql.PerImageCounts(self.model, filter_name=filter_name, cb=cb)
 
+    def BuildPredictionIndex(self, cb=None):
+        return multiclasssql.BuildPredictionIndex(self.model, cb=cb)
+
     def SaveModel(self, model_filename, bin_labels):
 
         # For loading scikit learn library
@@ -181,11 +191,13 @@ class FastGentleBoosting(object):
         else:
             return ''
 
-    def Train(self, colnames, num_learners, label_matrix, values, fout=None, do_prof=False, test_values=None, callback=None):
+    def Train(self, colnames, num_learners, label_matrix, values, fout=None, do_prof=False, test_values=None, callback=None, search=None):
         '''
         label_matrix is an n by k numpy array containing values of either +1 or -1
         values is the n by j numpy array of cell measurements
         n = #example cells, k = #classes, j = #measurements
+        search is the WeakLearnerSearch of label_matrix and values, if
+        there already is one (see WeakLearnerSearch.subset)
         Return a list of learners.  Each learner is a tuple (column, thresh, a,
         b, average_margin), where column is an integer index into colnames
         '''
@@ -209,15 +221,12 @@ class FastGentleBoosting(object):
             num_examples_class = sum(classmask)
             weights[np.tile(classmask, (1, num_classes))] /= num_examples_class
         balancing = weights.copy()
+        # sorts each feature once for all the rounds
+        if search is None:
+            search = WeakLearnerSearch(label_matrix, values)
 
         def GetOneWeakLearner(ctl=None, tlbi=None):
-            best_error = float(np.Infinity)
-            for feature_idx in range(values.shape[1]):
-                thresh, err, a, b = self.TrainWeakLearner(label_matrix, weights, values[:, feature_idx])
-                if err < best_error:
-                    best_error = err
-                    bestvals = (err, feature_idx, thresh, a, b)
-            err, column, thresh, a, b = bestvals
+            err, column, thresh, a, b = search.best(weights)
             # recompute weights
             delta = np.reshape(values[:, column] > thresh, (num_examples, 1))
             feature_thresh_mask = np.tile(delta, (1, num_classes))
@@ -282,10 +291,10 @@ class FastGentleBoosting(object):
         Labels should be 1 and -1, only.
         label_matrix and weights are NxC.
         values is N
+        Train uses WeakLearnerSearch, which gives the same results for all
+        the features at once.
         '''
 
-        global order, s_values, s_labels, s_weights, s_weights_times_labels, num_a, den_a, a, b, sless0, sgrtr0, w_below_neg, w_below_pos, w_above_neg, w_above_pos, J
-
         # Sort labels and weights by values (AKA possible thresholds).  By
         # default, argsort is not stable, so the results will vary
         # slightly with the number of workers.  Add kind="mergesort" to
@@ -333,6 +342,15 @@ class FastGentleBoosting(object):
         # return the threshold at that index
         return s_values[idx], J[idx], a[idx, :].copy(), b[idx, :].copy()
 
+    def UsedFeatures(self):
+        '''
+        Returns the names of the columns the rules use (the only columns
+        read when scoring objects), or None if there is no model.
+        '''
+        if not self.model:
+            return None
+        return StumpEvaluator(self.model).columns
+
     def UpdateBins(self, classBins):
         self.classBins = classBins
 
@@ -353,53 +371,45 @@ class FastGentleBoosting(object):
         print("Note that if one learner is sufficient, only one will be written.")
         exit(1)
 
-    def XValidate(self, colnames, num_learners, label_matrix, values, folds, group_labels, progress_callback, confusion=False):
-        # if everything's in the same group, ignore the labels
-        if all([g == group_labels[0] for g in group_labels]):
-            group_labels = range(len(group_labels))
-
-        # randomize the order of labels
-        unique_labels = list(set(group_labels))
-        np.random.shuffle(unique_labels)
+    def FoldPool(self, colnames, num_learners, label_matrix, values):
+        '''
+        Returns a crossvalidation.FoldPool of self.n_jobs processes for
+        cross-validating these examples with XValidate several times, with
+        each column of values sorted once for all of them.
+        '''
+        data = (colnames, num_learners, label_matrix, values, WeakLearnerSearch(label_matrix, values))
+        return crossvalidation.FoldPool(_train_fold, data, self.n_jobs)
 
-        fold_min_size = len(group_labels) / float(folds)
+    def XValidate(self, colnames, num_learners, label_matrix, values, folds, group_labels, progress_callback, confusion=False, pool=None):
+        '''
+        Trains on all but one fold of the examples and tests on that fold,
+        for each fold.  The folds are run in self.n_jobs processes (see
+        crossvalidation.run_folds), and each column of values is sorted
+        only once for all of them.  progress_callback is called with the
+        fraction of folds done and may raise an exception to cancel.
+        pool -- a FoldPool of the same examples to use (see FoldPool)
+        '''
+        holdouts = _holdout_folds(group_labels, folds)
         num_misclassifications = np.zeros(num_learners, int)
 
         np_holdout_results = np.array([])
         np_holdout_labels = np.array([])
 
-        # break into folds, randomly, but with all identical group_labels together
-        for f in range(folds):
-            current_holdout = [False] * len(group_labels)
-            while unique_labels and (sum(current_holdout) < fold_min_size):
-                to_add = unique_labels.pop()
-                current_holdout = [(a or b) for a, b in zip(current_holdout, [g == to_add for g in group_labels])]
-
-            if sum(current_holdout) == 0:
-                logging.error("no holdout")
-                break
-
-            holdout_idx = np.nonzero(current_holdout)[0]
-            current_holdin = ~ np.array(current_holdout)
-            holdin_idx = np.nonzero(current_holdin)[0]
-            holdin_labels = label_matrix[holdin_idx, :]
-            holdin_values = values[holdin_idx, :]
-            holdout_values = values[holdout_idx, :]
-            holdout_results = self.Train(colnames, num_learners, holdin_labels, holdin_values, test_values=holdout_values)
+        if pool is None:
+            data = (colnames, num_learners, label_matrix, values, WeakLearnerSearch(label_matrix, values))
+        else:
+            data = pool.data
+        for f, holdout_results in crossvalidation.run_folds(_train_fold, data, holdouts, self.n_jobs,
+                                                            progress_callback, pool=pool):
             if holdout_results is None:
                 return None
-            # pad the end of the holdout set with the last element
-            if len(holdout_results) < num_learners:
-                holdout_results += [holdout_results[-1]] * (num_learners - len(holdout_results))
-            holdout_labels = label_matrix[holdout_idx, :].argmax(axis=1)
+            holdout_labels = label_matrix[holdouts[f], :].argmax(axis=1)
 
             if confusion:
                 np_holdout_results = np.concatenate((np_holdout_results,np.array(holdout_results).flatten()))
                 np_holdout_labels = np.concatenate((np_holdout_labels,np.tile(holdout_labels,(num_learners,1)).flatten()))
                 
             num_misclassifications += [sum(hr != holdout_labels) for hr in holdout_results]
-            if progress_callback:
-                progress_callback(f / float(folds))
 
         if confusion:
             return np_holdout_results, np_holdout_labels
@@ -407,47 +417,7 @@ class FastGentleBoosting(object):
             return [num_misclassifications]
 
     def XValidatePredict(self, colnames, num_learners, label_matrix, values, folds, group_labels, progress_callback):
-        # if everything's in the same group, ignore the labels
-        if all([g == group_labels[0] for g in group_labels]):
-            group_labels = range(len(group_labels))
-
-        # randomize the order of labels
-        unique_labels = list(set(group_labels))
-        np.random.shuffle(unique_labels)
-
-        fold_min_size = len(group_labels) / float(folds)
-        num_misclassifications = np.zeros(num_learners, int)
-
-        # break into folds, randomly, but with all identical group_labels together
-        for f in range(folds):
-            current_holdout = [False] * len(group_labels)
-            while unique_labels and (sum(current_holdout) < fold_min_size):
-                to_add = unique_labels.pop()
-                current_holdout = [(a or b) for a, b in zip(current_holdout, [g == to_add for g in group_labels])]
-
-            if sum(current_holdout) == 0:
-                logging.error("no holdout")
-                break
-
-            holdout_idx = np.nonzero(current_holdout)[0]
-            current_holdin = ~ np.array(current_holdout)
-            holdin_idx = np.nonzero(current_holdin)[0]
-            holdin_labels = label_matrix[holdin_idx, :]
-            holdin_values = values[holdin_idx, :]
-            holdout_values = values[holdout_idx, :]
-            holdout_results = self.Train(colnames, num_learners, holdin_labels, holdin_values, test_values=holdout_values)
-            if holdout_results is None:
-                return None
-            # pad the end of the holdout set with the last element
-            if len(holdout_results) < num_learners:
-                holdout_results += [holdout_results[-1]] * (num_learners - len(holdout_results))
-            holdout_labels = label_matrix[holdout_idx, :].argmax(axis=1)
-
-            num_misclassifications += [sum(hr != holdout_labels) for hr in holdout_results]
-            if progress_callback:
-                progress_callback(f / float(folds))
-
-        return [num_misclassifications]
+        return self.XValidate(colnames, num_learners, label_matrix, values, folds, group_labels, progress_callback)
 
     # Confusion Matrix
     def plot_confusion_matrix(self, conf_arr, title='Confusion matrix', cmap=plt.cm.Blues):
@@ -540,6 +510,64 @@ class FastGentleBoosting(object):
         
         plt.show()
 
+
+def _holdout_folds(group_labels, folds):
+    '''
+    Splits the examples into folds at random, but with all the examples
+    with the same group label in the same fold.  Returns the indices of the
+    examples in each fold.
+    '''
+    # if everything's in the same group, ignore the labels
+    if all([g == group_labels[0] for g in group_labels]):
+        group_labels = range(len(group_labels))
+    members = {}
+    for i, g in enumerate(group_labels):
+        members.setdefault(g, []).append(i)
+
+    # randomize the order of labels
+    unique_labels = list(members.keys())
+    np.random.shuffle(unique_labels)
+
+    fold_min_size = len(group_labels) / float(folds)
+    holdouts = []
+    for f in range(folds):
+        current_holdout = []
+        while unique_labels and (len(current_holdout) < fold_min_size):
+            current_holdout += members[unique_labels.pop()]
+
+        if len(current_holdout) == 0:
+            logging.error("no holdout")
+            break
+        holdouts.append(np.array(sorted(current_holdout), int))
+    return holdouts
+
+_fold_learner = None
+
+def _train_fold(data, holdout_idx):
+    '''
+    Task for crossvalidation.run_folds: trains on the examples not in
+    holdout_idx and returns the classes predicted for the held out
+    examples after each weak learner, or None if nothing was trained.
+    data -- (colnames, num_learners, label_matrix, values, search), where
+        search is the WeakLearnerSearch of all the examples
+    '''
+    global _fold_learner
+    if _fold_learner is None:
+        _fold_learner = FastGentleBoosting()
+    colnames, num_learners, label_matrix, values, search = data
+    holdin = np.ones(len(values), bool)
+    holdin[holdout_idx] = False
+    holdin_idx = np.nonzero(holdin)[0]
+    holdout_results = _fold_learner.Train(colnames, num_learners, label_matrix[holdin_idx, :],
+                                          values[holdin_idx, :], test_values=values[holdout_idx, :],
+                                          search=search.subset(holdin_idx))
+    if holdout_results is None:
+        return None
+    # pad the end of the holdout set with the last element
+    if len(holdout_results) < num_learners:
+        holdout_results += [holdout_results[-1]] * (num_learners - len(holdout_results))
+    return holdout_results
+
 if __name__ == '__main__':
     fgb = FastGentleBoosting()
 
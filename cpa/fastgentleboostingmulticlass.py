@@ -1,7 +1,181 @@
 from __future__ import print_function
 from numpy import *
 import sys
-from fastgentleboostingworkermulticlass import train_weak_learner
+
+# Largest number of (example, feature, class) entries evaluated at once by
+# WeakLearnerSearch; features are processed in blocks of this size.
+BLOCK_ENTRIES = 1024 * 1024
+
+
+class WeakLearnerSearch(object):
+    '''
+    Finds the best weak learner (a threshold on one feature) for a training
+    set, for the example weights of each boosting round.
+
+    Each feature column is sorted once, when the search is created, and the
+    order is reused on every round; the error of every threshold of every
+    feature is then computed with cumulative sums over whole blocks of
+    features at a time.  This gives the same learners as calling
+    fastgentleboostingworkermulticlass.train_weak_learner on each column
+    (which sorts every column on every round), except that with tied
+    values the threshold with the least error is always found, whatever
+    order the ties are sorted in.  All state is kept on the object, so
+    searches may run in different threads.
+
+    label_matrix -- N x C array of +1 and -1 (N examples, C classes)
+    values -- N x J array of feature values
+    order -- the stable argsort of each column of values, if already known
+        (see subset)
+    '''
+    def __init__(self, label_matrix, values, block_entries=BLOCK_ENTRIES, order=None):
+        self.label_matrix = label_matrix
+        self.values = values
+        self.block_entries = block_entries
+        num_examples, num_features = values.shape
+        if order is None:
+            # A stable sort, so ties are always broken the same way
+            order = argsort(values, axis=0, kind='mergesort')
+        self.order = order
+        self.sorted_values = values[self.order, arange(num_features)]
+        # Thresholds must fall between distinct values, so only the last
+        # of each run of equal sorted values is a possible threshold.
+        self.inside_run = zeros(values.shape, bool)
+        self.inside_run[:-1] = self.sorted_values[1:] == self.sorted_values[:-1]
+        # (min and max are numpy's here)
+        block = (block_entries // ((num_examples * label_matrix.shape[1]) or 1)) or 1
+        self.blocks = [(j, minimum(j + block, num_features)) for j in range(0, num_features, block)]
+
+    def subset(self, rows):
+        '''
+        Returns the search for the examples in rows (in increasing order),
+        the same as WeakLearnerSearch(label_matrix[rows], values[rows]),
+        but taking the order of each column from this search's instead of
+        sorting again (eg: for the folds of a cross-validation).
+        '''
+        rows = asarray(rows)
+        num_examples, num_features = self.order.shape
+        keep = zeros(num_examples, bool)
+        keep[rows] = True
+        position = zeros(num_examples, int)
+        position[rows] = arange(len(rows))
+        # the kept examples of each column, still in sorted order
+        sorted_rows = self.order.T[keep[self.order.T]].reshape((num_features, len(rows))).T
+        return WeakLearnerSearch(self.label_matrix[rows], self.values[rows],
+                                 self.block_entries, position[sorted_rows])
+
+    def best(self, weights):
+        '''
+        weights -- N x C array of example weights
+        Returns (err, column, thresh, a, b) for the weak learner with the
+        least error, where column is the index of its feature.
+        '''
+        best = None
+        for start, stop in self.blocks:
+            err, column, idx, a, b = self._best_in_block(weights, start, stop)
+            if best is None or err < best[0]:
+                best = (err, column, idx, a, b)
+        err, column, idx, a, b = best
+        return err, column, self.sorted_values[idx, column], a, b
+
+    def _best_in_block(self, weights, start, stop):
+        # Equations 7, 9 and 10 of Torralba et al., as in train_weak_learner,
+        # with an extra axis for the features: arrays are N x features x C.
+        order = self.order[:, start:stop]
+        s_labels = self.label_matrix[order]
+        s_weights = weights[order]
+
+        s_weights_times_labels = s_weights * s_labels
+        cum_weights_times_labels = cumsum(s_weights_times_labels, axis=0)
+        cum_weights = cumsum(s_weights, axis=0)
+        num_a = s_weights_times_labels.sum(axis=0) - cum_weights_times_labels
+        den_a = s_weights.sum(axis=0) - cum_weights
+        den_a[den_a <= 0.0] = 1.0 # avoid div by zero
+        a = num_a / den_a
+        b = cum_weights_times_labels / cum_weights
+
+        sless0 = (s_labels < 0)
+        sgrtr0 = (s_labels > 0)
+        w_below_neg = cumsum(s_weights * sless0, axis=0)
+        w_below_pos = cumsum(s_weights * sgrtr0, axis=0)
+        w_above_neg = (s_weights * sless0).sum(axis=0) - w_below_neg
+        w_above_pos = (s_weights * sgrtr0).sum(axis=0) - w_below_pos
+
+        J = w_below_neg * ((-1 - b)**2) + w_below_pos * ((1 - b)**2) + w_above_neg * ((-1 - a)**2) + w_above_pos * ((1 - a)**2)
+        J = J.sum(axis=2)
+        J[isnan(J) | self.inside_run[:, start:stop]] = inf
+
+        # least error for each feature, then over the features
+        features = arange(stop - start)
+        idx = J.argmin(axis=0)
+        errors = J[idx, features]
+        f = errors.argmin()
+        return errors[f], start + f, idx[f], a[idx[f], f, :].copy(), b[idx[f], f, :].copy()
+
+
+# Number of rows scored at a time by StumpEvaluator
+EVALUATION_ROWS = 65536
+
+
+class StumpEvaluator(object):
+    '''
+    Scores objects with a model trained by train (a list of weak learners
+    (colname, thresh, a, b, margin)), many rows at a time.
+
+    The score of each class is the sum over the weak learners of a, where
+    the learner's feature is above its threshold, or b otherwise (including
+    where the feature is NaN, like NULL in SQL).  This is computed as the sum
+    of the b's plus a matrix product of the rows' threshold tests with the
+    differences a - b, which touches only the columns the model uses.
+
+    columns -- the distinct columns the model uses, in order of first use.
+        Values passed to the evaluator must have exactly these columns.
+    '''
+    def __init__(self, weaklearners, rows=EVALUATION_ROWS):
+        self.columns = []
+        for colname, thresh, a, b, margin in weaklearners:
+            if colname not in self.columns:
+                self.columns.append(colname)
+        self.column_index = array([self.columns.index(wl[0]) for wl in weaklearners], int)
+        self.thresholds = array([wl[1] for wl in weaklearners], float64)
+        a = array([wl[2] for wl in weaklearners], float64)
+        b = array([wl[3] for wl in weaklearners], float64)
+        self.num_classes = a.shape[1]
+        self.base = b.sum(axis=0)
+        self.delta = a - b
+        self.rows = rows
+
+    def scores(self, values):
+        '''
+        values -- N x len(self.columns) array of feature values
+        Returns the N x num_classes array of class scores.
+        '''
+        values = asarray(values)
+        result = empty((values.shape[0], self.num_classes), float64)
+        for start in range(0, values.shape[0], self.rows):
+            chunk = values[start:start + self.rows]
+            above = chunk[:, self.column_index] > self.thresholds
+            result[start:start + self.rows] = self.base + dot(above, self.delta)
+        return result
+
+    def classify(self, values):
+        '''Returns the 1-based class of each row of values.'''
+        return self.scores(values).argmax(axis=1) + 1
+
+    def classify_chunks(self, chunks):
+        '''
+        Yields the 1-based classes of each array of values produced by the
+        iterable chunks, so results can be streamed as they are read.
+        '''
+        for values in chunks:
+            yield self.classify(values)
+
+    # So an evaluator can stand in for a classifier in multiclasssql.score_objects
+    def Predict(self, values):
+        return self.classify(values)
+
+    def PredictProba(self, values):
+        # boosting scores aren't probabilities
+        return None
 
 
 def train(colnames, num_learners, label_matrix, values, fout=None, do_prof=False, test_values=None, callback=None):
@@ -32,15 +206,10 @@ def train(colnames, num_learners, label_matrix, values, fout=None, do_prof=False
         num_examples_class = sum(classmask)
         weights[tile(classmask, (1, num_classes))] /= num_examples_class
     balancing = weights.copy()
+    search = WeakLearnerSearch(label_matrix, values)
     
     def get_one_weak_learner(ctl=None, tlbi=None):
-        best_error = float(Infinity)
-        for feature_idx in range(values.shape[1]):
-            thresh, err, a, b = train_weak_learner(label_matrix, weights, values[:, feature_idx])
-            if err < best_error:
-                best_error = err
-                bestvals = (err, feature_idx, thresh, a, b)
-        err, column, thresh, a, b = bestvals
+        err, column, thresh, a, b = search.best(weights)
         # recompute weights
         delta = reshape(values[:, column] > thresh, (num_examples, 1))
         feature_thresh_mask = tile(delta, (1, num_classes))
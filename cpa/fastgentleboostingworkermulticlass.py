@@ -19,8 +19,6 @@ def train_weak_learner(labels, weights, values):
     label_matrix and weights are NxC.
     values is Nx1
     '''
-    
-    global order, s_values, s_labels, s_weights, s_weights_times_labels, num_a, den_a, a, b, sless0, sgrtr0, w_below_neg, w_below_pos, w_above_neg, w_above_pos, J
 
     # Sort labels and weights by values (AKA possible thresholds).  By
     # default, argsort is not stable, so the results will vary
@@ -0,0 +1,310 @@
+'''
+An on-disk copy of the classifier columns of the object table, for scoring
+objects without querying the database for their features every time.
+
+The store is a directory (Properties.feature_store_dir) holding, for the
+object table, a float32 matrix of the classifier columns and an integer
+matrix of the object keys, in object key order, saved as .npy files which
+are memory-mapped when read.  It is exported once, the first time it is
+needed, and again whenever the object table has changed since (see
+FeatureStore.is_valid).  NULL and non-numeric values are stored as NaN, and
+the rest are rounded to single precision.
+'''
+from __future__ import print_function
+import json
+import logging
+import os
+import threading
+import numpy as np
+import dbconnect
+from dbconnect import object_key_columns, image_key_columns, UniqueObjectClause
+from properties import Properties
+
+p = Properties.getInstance()
+db = dbconnect.DBConnect.getInstance()
+
+EXPORT_BATCH_SIZE = 100000  # rows fetched at a time while exporting
+
+
+def _codes(keys, radices):
+    '''
+    Encodes the rows of an integer key array as one integer per row,
+    preserving their lexicographic order.  radices must exceed the values
+    in each column (but the first).
+    '''
+    codes = keys[:, 0].astype('i8')
+    for col, radix in zip(range(1, keys.shape[1]), radices[1:]):
+        codes = codes * radix + keys[:, col]
+    return codes
+
+
+def table_source():
+    '''Identifies the object table, for stores of data read from it.'''
+    return {'db_type' : p.db_type, 'db_host' : p.db_host, 'db_name' : p.db_name,
+            'db_sqlite_file' : p.db_sqlite_file, 'object_table' : p.object_table,
+            'key_columns' : list(object_key_columns())}
+
+def table_summary():
+    '''
+    Returns the number of objects in the object table and its first and
+    last object keys.
+    '''
+    keys = UniqueObjectClause()
+    nrows = int(db.execute('SELECT COUNT(*) FROM %s'%(p.object_table))[0][0])
+    first = db.execute('SELECT %s FROM %s ORDER BY %s LIMIT 1'%(keys, p.object_table, keys))
+    last = db.execute('SELECT %s FROM %s ORDER BY %s LIMIT 1'%(
+        keys, p.object_table, ', '.join(['%s DESC'%(col) for col in object_key_columns()])))
+    return [nrows, [int(v) for v in first[0]] if first else None,
+            [int(v) for v in last[0]] if last else None]
+
+
+class FeatureStore(object):
+    '''
+    The exported classifier columns of the object table, in directory.
+    Call is_valid before open to check the export is up to date, and build
+    to export the table (again).  Once open, features can be read by row
+    range (rows), by image (image_rows) or by object key (lookup).
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.keys = None
+        self.values = None
+        self.columns = None
+        self.lock = threading.Lock()
+        self._image_codes = None
+        self._object_radices = None
+        self._object_codes = None
+
+    def path(self, suffix):
+        return os.path.join(self.directory, '%s.%s'%(p.object_table, suffix))
+
+    def read_metadata(self):
+        try:
+            with open(self.path('json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write_metadata(self, metadata):
+        with open(self.path('json.tmp'), 'w') as f:
+            json.dump(metadata, f)
+        os.rename(self.path('json.tmp'), self.path('json'))
+
+    def is_valid(self):
+        '''
+        Returns whether the store holds the current classifier columns of
+        the object table, as of its modify date (see
+        DBConnect.get_objects_modify_date).  SQLite only records when the
+        database file changed (eg: when a class table was written), so if
+        that has changed the store is still accepted if the table has the
+        same number of objects and the same first and last object keys.
+        The store is never valid if the modify date is unknown (eg: MySQL
+        doesn't record it for all table types).
+        '''
+        metadata = self.read_metadata()
+        if metadata is None or not os.path.exists(self.path('features.npy')):
+            return False
+        if (metadata['source'] != json.loads(json.dumps(table_source())) or
+            metadata['columns'] != list(db.GetColnamesForClassifier())):
+            return False
+        date = db.get_objects_modify_date()
+        if date is None:
+            return False
+        stamp = str(date)
+        if metadata['stamp'] == stamp:
+            return True
+        if p.db_type.lower() != 'sqlite' or metadata['summary'] != table_summary():
+            return False
+        metadata['stamp'] = stamp
+        self.write_metadata(metadata)
+        return True
+
+    def build(self, cb=None):
+        '''
+        Exports the classifier columns of the object table to the store.
+        cb -- callback function called with the fraction exported.  It may
+            raise an exception to cancel.
+        '''
+        self.close()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        columns = list(db.GetColnamesForClassifier())
+        stamp = str(db.get_objects_modify_date())
+        summary = table_summary()
+        nrows = summary[0]
+        nkeys = len(object_key_columns())
+        logging.info('Exporting %d columns of %d objects to %s'%(len(columns), nrows, self.directory))
+        keys = np.lib.format.open_memmap(self.path('keys.tmp.npy'), 'w+', 'i8', (nrows, nkeys))
+        values = np.lib.format.open_memmap(self.path('features.tmp.npy'), 'w+', 'f4', (nrows, len(columns)))
+        try:
+            row = 0
+            query = 'SELECT %s, %s FROM %s ORDER BY %s'%(UniqueObjectClause(), ', '.join(columns),
+                                                         p.object_table, UniqueObjectClause())
+            for key_columns, matrix in db.iter_query(query, batch_size=EXPORT_BATCH_SIZE,
+                                                     feature_start=nkeys, dtype='f4',
+                                                     nrows=nrows, cb=cb):
+                if row + len(matrix) > nrows:
+                    raise ValueError('%s changed while it was being exported'%(p.object_table))
+                keys[row:row + len(matrix)] = np.column_stack(key_columns)
+                values[row:row + len(matrix)] = matrix
+                row += len(matrix)
+            if row != nrows:
+                raise ValueError('%s changed while it was being exported'%(p.object_table))
+            keys.flush()
+            values.flush()
+        except:
+            del keys, values
+            for name in ['keys', 'features']:
+                if os.path.exists(self.path('%s.tmp.npy'%(name))):
+                    os.remove(self.path('%s.tmp.npy'%(name)))
+            raise
+        del keys, values
+        for name in ['keys', 'features']:
+            if os.path.exists(self.path('%s.npy'%(name))):
+                os.remove(self.path('%s.npy'%(name)))
+            os.rename(self.path('%s.tmp.npy'%(name)), self.path('%s.npy'%(name)))
+        self.write_metadata({'source' : table_source(), 'columns' : columns,
+                             'stamp' : stamp, 'summary' : summary})
+
+    def open(self):
+        '''Memory-maps the store for reading.'''
+        with self.lock:
+            if self.values is None:
+                self.columns = self.read_metadata()['columns']
+                self.column_index = dict([(col, i) for i, col in enumerate(self.columns)])
+                self.keys = np.load(self.path('keys.npy'), mmap_mode='r')
+                self.values = np.load(self.path('features.npy'), mmap_mode='r')
+
+    def close(self):
+        with self.lock:
+            self.keys = self.values = self.columns = None
+            self._image_codes = self._object_codes = self._object_radices = None
+
+    def has_columns(self, columns):
+        return all([col in self.column_index for col in columns])
+
+    def rows(self, start, stop, columns=None, fill=None):
+        '''
+        Returns (object_keys, values) for rows start to stop-1: the keys as
+        an integer array with a row per object, and the given columns (by
+        default all of them) as a float32 array.
+        fill -- value for NULL and non-numeric entries (NaN when None)
+        '''
+        return self.take(slice(start, stop), columns, fill)
+
+    def take(self, index, columns=None, fill=None):
+        '''Like rows, for the rows in index (a slice or an array of row numbers).'''
+        values = self.values[index]
+        if columns is not None:
+            values = values[:, [self.column_index[col] for col in columns]]
+        values = np.array(values)
+        if fill is not None:
+            values[np.isnan(values)] = fill
+        return np.array(self.keys[index]), values
+
+    def image_codes(self):
+        with self.lock:
+            if self._image_codes is None:
+                nimkeys = len(image_key_columns())
+                # one more than the largest value, so keys outside the store
+                # can be clipped to a value that doesn't occur
+                radices = [int(self.keys[:, i].max()) + 2 if len(self.keys) else 2
+                           for i in range(nimkeys)]
+                self._image_radices = radices
+                self._image_codes = _codes(np.asarray(self.keys[:, :nimkeys]), radices)
+            return self._image_codes
+
+    def image_rows(self, first, last):
+        '''
+        Returns (start, stop): the rows of the objects in the images with
+        keys from first to last (inclusive).
+        '''
+        codes = self.image_codes()
+        bounds = np.minimum(np.array([first, last], dtype='i8'), np.array(self._image_radices) - 1)
+        bounds[:, 0] = [first[0], last[0]]
+        lo, hi = _codes(bounds, self._image_radices)
+        return int(np.searchsorted(codes, lo, 'left')), int(np.searchsorted(codes, hi, 'right'))
+
+    def lookup(self, object_keys):
+        '''
+        Returns the row of each object key (rows of an integer array), or -1
+        where an object isn't in the store.
+        '''
+        object_keys = np.asarray(object_keys, dtype='i8').reshape((-1, self.keys.shape[1]))
+        with self.lock:
+            if self._object_codes is None:
+                radices = [int(self.keys[:, i].max()) + 1 if len(self.keys) else 1
+                           for i in range(self.keys.shape[1])]
+                self._object_radices = radices
+                self._object_codes = _codes(np.asarray(self.keys), radices)
+        if len(object_keys) == 0 or len(self._object_codes) == 0:
+            return -np.ones(len(object_keys), dtype='i8')
+        inside = ((object_keys >= 0) & (object_keys < self._object_radices)).all(axis=1)
+        codes = _codes(np.where(inside[:, None], object_keys, 0), self._object_radices)
+        index = np.minimum(np.searchsorted(self._object_codes, codes), len(self._object_codes) - 1)
+        found = inside & (self._object_codes[index] == codes)
+        return np.where(found, index, -1)
+
+    def object_data(self, keys, columns=None, fill=None):
+        '''
+        Returns (object_keys, values) for a list of image keys or object
+        keys (not both), as in rows.  Objects not in the store are left out.
+        '''
+        keys = [tuple(key) for key in keys]
+        if len(keys) > 0 and len(keys[0]) == len(image_key_columns()):
+            ranges = [self.image_rows(key, key) for key in keys]
+            index = np.concatenate([np.arange(start, stop) for start, stop in ranges] +
+                                   [np.zeros(0, dtype=int)])
+        else:
+            index = self.lookup(keys)
+            index = index[index >= 0]
+        return self.take(index, columns, fill)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_feature_store(cb=None, build=True):
+    '''
+    Returns the open FeatureStore of the object table if
+    Properties.feature_store_dir is set, exporting the table first if the
+    store is missing or out of date, or None if it isn't set, the export
+    fails, or the modify date of the object table is unknown (so the store
+    could never be known to be current).  cb is passed on to
+    FeatureStore.build.
+    build -- if false, only return a store that is already current, without
+        exporting the table or waiting for another thread that is, eg: when
+        fetching objects on the GUI thread.
+    '''
+    global _store
+    if not p.feature_store_dir:
+        return None
+    try:
+        date = db.get_objects_modify_date()
+    except dbconnect.DBException:
+        date = None
+    if date is None:
+        logging.info('Not using the feature store in %s: the modify date of %s is '
+                     'unknown'%(p.feature_store_dir, p.object_table))
+        return None
+    if not _store_lock.acquire(build):
+        # another thread is exporting the table
+        return None
+    try:
+        if _store is None or _store.directory != p.feature_store_dir:
+            _store = FeatureStore(p.feature_store_dir)
+        store = _store
+        try:
+            if not store.is_valid():
+                if not build:
+                    return None
+                store.build(cb)
+            store.open()
+        except (EnvironmentError, ValueError, dbconnect.DBException) as e:
+            logging.error('Could not use the feature store in %s, reading features '
+                          'from the database instead: %s'%(store.directory, e))
+            store.close()
+            return None
+    finally:
+        _store_lock.release()
+    return store
@@ -1,5 +1,6 @@
 from __future__ import print_function
 import re
+import crossvalidation
 import dbconnect
 import logging
 import multiclasssql
@@ -7,13 +8,96 @@ import numpy as np
 import matplotlib.pyplot as plt
 from sys import stdin, stdout, argv, exit
 from time import time
-from sklearn import ensemble, naive_bayes, svm, discriminant_analysis, tree, multiclass, linear_model, neighbors
+from sklearn import ensemble, naive_bayes, svm, discriminant_analysis, tree, multiclass, linear_model, neighbors, preprocessing
 from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn import metrics
 import cPickle, json
+import hashlib
 from sklearn.externals import joblib
 import seaborn as sns
-from sklearn.model_selection import LeaveOneOut, KFold, cross_val_predict, cross_val_score
+from sklearn.model_selection import LeaveOneOut, KFold, StratifiedKFold
+
+# Linear classifiers whose predict is the class with the greatest
+# decision_function, values . coef_.T + intercept_ (or, with a single row of
+# coefficients, the second class where that is positive)
+_LINEAR_CLASSIFIERS = (linear_model.LogisticRegression, linear_model.SGDClassifier,
+                       linear_model.RidgeClassifier, linear_model.Perceptron,
+                       svm.LinearSVC, discriminant_analysis.LinearDiscriminantAnalysis)
+
+def _affine_transform(transformer):
+    '''
+    Returns (scale, offset) such that a fitted scaler transforms values to
+    values * scale + offset, or None if it isn't such a scaler.
+    '''
+    if isinstance(transformer, preprocessing.StandardScaler):
+        # mean_ and scale_ may be set even when they aren't applied
+        scale = transformer.scale_ if transformer.with_std and transformer.scale_ is not None else 1.0
+        mean = transformer.mean_ if transformer.with_mean and transformer.mean_ is not None else 0.0
+        scale = 1.0 / np.asarray(scale, float)
+        return scale, -np.asarray(mean, float) * scale
+    if isinstance(transformer, preprocessing.MinMaxScaler) and not getattr(transformer, 'clip', False):
+        return np.asarray(transformer.scale_, float), np.asarray(transformer.min_, float)
+    if isinstance(transformer, preprocessing.MaxAbsScaler):
+        return 1.0 / np.asarray(transformer.scale_, float), 0.0
+    return None
+
+def _linear_model(estimator):
+    '''
+    Returns (coef, intercept, classes) for a fitted linear classifier, or a
+    pipeline of scalers ending in one, such that its predictions for
+    values are classes[argmax(values . coef.T + intercept)]: coef has a row
+    of weights for each of the classes.  Returns None for other estimators.
+    '''
+    scale, offset = 1.0, 0.0
+    if hasattr(estimator, 'steps'):
+        # a Pipeline: fold the scaling steps into the coefficients
+        for name, step in estimator.steps[:-1]:
+            transform = _affine_transform(step)
+            if transform is None:
+                return None
+            scale, offset = scale * transform[0], offset * transform[0] + transform[1]
+        estimator = estimator.steps[-1][1]
+    if not isinstance(estimator, _LINEAR_CLASSIFIERS):
+        return None
+    coef = np.atleast_2d(np.asarray(estimator.coef_, float))
+    intercept = np.atleast_1d(np.asarray(estimator.intercept_, float)) * np.ones(len(coef))
+    intercept = intercept + (coef * offset).sum(axis=1)
+    coef = coef * scale
+    if len(coef) == 1:
+        # the second class where the score is positive; ties go to the first
+        coef = np.vstack([np.zeros_like(coef), coef])
+        intercept = np.array([0.0, intercept[0]])
+    return coef, intercept, list(estimator.classes_)
+
+
+def _used_feature_indices(estimator):
+    '''
+    Returns the set of the indices of the features a fitted scikit-learn
+    estimator depends on, or None if it can't be told.  Linear classifiers
+    use the features with non-zero coefficients and trees (and ensembles of
+    trees) the features they split on.
+    '''
+    if hasattr(estimator, 'steps'):
+        model = _linear_model(estimator)
+        if model is None:
+            return None
+        return set(np.flatnonzero((model[0] != 0).any(axis=0)).tolist())
+    if isinstance(estimator, _LINEAR_CLASSIFIERS):
+        coef = np.atleast_2d(estimator.coef_)
+        return set(np.flatnonzero((coef != 0).any(axis=0)).tolist())
+    if hasattr(estimator, 'tree_'):
+        return set(estimator.tree_.feature[estimator.tree_.feature >= 0].tolist())
+    if isinstance(estimator, (ensemble.AdaBoostClassifier, ensemble.RandomForestClassifier,
+                              ensemble.ExtraTreesClassifier, ensemble.GradientBoostingClassifier)):
+        used = set()
+        for member in np.ravel(estimator.estimators_):
+            member_used = _used_feature_indices(member)
+            if member_used is None:
+                return None
+            used |= member_used
+        return used
+    return None
+
 
 class GeneralClassifier(BaseEstimator, ClassifierMixin):
     def __init__(self, classifier = "discriminant_analysis.LinearDiscriminantAnalysis()", env=None):
@@ -23,9 +107,17 @@ class GeneralClassifier(BaseEstimator, ClassifierMixin):
         self.env = env # Env is Classifier in Legacy Code -- maybe renaming ?
         self.name = self.name()
         self.features = []
+        self.n_jobs = crossvalidation.default_num_jobs() # processes to cross-validate in
 
         logging.info('Initialized New Classifier: ' + self.name)
 
+    def __getstate__(self):
+        # The classifier window can't be pickled (eg: to predict in other
+        # processes, see multiclasssql.PerImageCounts)
+        state = dict(super(GeneralClassifier, self).__getstate__())
+        state['env'] = None
+        return state
+
     # Set features
     def _set_features(self, features):
         self.features = features
@@ -50,12 +142,36 @@ class GeneralClassifier(BaseEstimator, ClassifierMixin):
         #dlg = wx.ProgressDialog('Nothing', '0% Complete', 100, self.classifier, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
         labels = self.env.trainingSet.label_array
         values = self.env.trainingSet.values
-        classificationReport = self.ClassificationReport(labels, self.XValidatePredict(labels, values, folds=5, stratified=True))
+        dlg, cb = self._progress_dialog('Computing cross validation accuracy...')
+        try:
+            predictions = self.XValidatePredict(labels, values, folds=5, stratified=True, cb=cb)
+        except crossvalidation.StopEvaluation:
+            self.env.PostMessage('Cross-validation canceled.')
+            return
+        finally:
+            dlg.Destroy()
+        classificationReport = self.ClassificationReport(labels, predictions)
         logging.info("Classification Report")
         logging.info(classificationReport)
         self.plot_classification_report(classificationReport)
 
 
+    def _progress_dialog(self, title):
+        '''
+        Returns (dlg, cb): a progress dialog for an evaluation, and a callback
+        for it that shows the fraction of folds done and raises
+        crossvalidation.StopEvaluation when cancel is pressed.
+        '''
+        import wx
+        dlg = wx.ProgressDialog(title, '0% Complete', 100, self.env,
+                                wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
+        def cb(frac):
+            pct = min(int(100 * frac), 100)
+            cont, skip = dlg.Update(pct, '%d%% Complete'%(pct))
+            if not cont:
+                raise crossvalidation.StopEvaluation()
+        return dlg, cb
+
     def ClassificationReport(self, true_labels, predicted_labels, confusion_matrix=False):
 
         return metrics.classification_report(true_labels, predicted_labels)
@@ -77,6 +193,10 @@ class GeneralClassifier(BaseEstimator, ClassifierMixin):
     def FilterObjectsFromClassN(self, obClass, obKeysToTry, uncertain=False):
         return multiclasssql.FilterObjectsFromClassN(obClass, self, obKeysToTry, uncertain)
 
+    def Fingerprint(self):
+        '''Returns a string identifying the trained model (see multiclasssql.model_fingerprint).'''
+        return hashlib.md5(cPickle.dumps(self.classifier, 2)).hexdigest()
+
     def IsTrained(self):
         return self.trained
 
@@ -91,30 +211,56 @@ class GeneralClassifier(BaseEstimator, ClassifierMixin):
             raise TypeError
 
 
-    def LOOCV(self, labels, values, details=False):
+    def LOOCV(self, labels, values, details=False, cb=None):
         '''
         Performs leave one out cross validation.
         Takes a subset of the input data label_array and values to do the cross validation.
+        A copy of the classifier is trained for each sample, in self.n_jobs
+        processes (see crossvalidation.run_folds), so the trained model is
+        left as it is.  cb is called with the fraction done and may raise
+        an exception to cancel.
         RETURNS: array of length folds of cross validation scores,
         detailedResults is an array of length # of samples containing the predicted classes
         '''
-        num_samples = values.shape[0]
-        scores = np.zeros(num_samples)
-        detailedResults = np.zeros(num_samples)
-        # get training and testing set, train on training set, score on test set
-        for train, test in LeaveOneOut(num_samples):
-            values_test = values[test]
-            label_test = labels[test]
-            self.Train(labels[train], values[train], fout=None)
-            scores[test] = self.classifier.score(values_test, label_test)
-            if details:
-                detailedResults[test] = self.Predict(values_test)
+        detailedResults = self._fold_predictions(labels, values, LeaveOneOut().split(values), cb)
+        # the score on a single sample is whether it was predicted correctly
+        scores = (detailedResults == labels).astype(float)
         if details:
             return scores, detailedResults
         return scores
 
-    def PerImageCounts(self, number_of_classes, filter_name=None, cb=None):
-        return multiclasssql.PerImageCounts(self, number_of_classes, filter_name, cb)
+    def PerImageCounts(self, number_of_classes, filter_name=None, cb=None, class_names=None):
+        return multiclasssql.PerImageCounts(self, number_of_classes, filter_name, cb,
+                                            class_names=class_names)
+
+    def BuildPredictionIndex(self, cb=None):
+        return multiclasssql.build_prediction_index(self, cb)
+
+    def UsedFeatures(self):
+        '''
+        Returns the names of the classifier columns (see
+        DBConnect.GetColnamesForClassifier) that the trained model depends
+        on, or None if it may depend on all of them.  Predict still needs
+        values for every column, but the others may be anything (eg: 0).
+        '''
+        if not self.trained:
+            return None
+        colnames = dbconnect.DBConnect.getInstance().GetColnamesForClassifier()
+        used = _used_feature_indices(self.classifier)
+        if used is None or (len(used) > 0 and max(used) >= len(colnames)):
+            return None
+        return [colnames[i] for i in sorted(used)]
+
+    def LinearModel(self):
+        '''
+        Returns (coef, intercept, classes) if the trained model is linear,
+        so that Predict(values) gives classes[argmax(values . coef.T +
+        intercept)] (see multiclasssql.linear_class_expression), or None.
+        The columns of coef are those of GetColnamesForClassifier.
+        '''
+        if not self.trained:
+            return None
+        return _linear_model(self.classifier)
 
     def Predict(self, test_values, fout=None):
         '''RETURNS: np array of predicted classes of input data test_values '''
@@ -178,22 +324,40 @@ class GeneralClassifier(BaseEstimator, ClassifierMixin):
         print("Class labels should be integers > 0.")
         exit(1)
 
-    def XValidate(self, labels, values, folds, stratified=True, scoring=None):
+    def _splits(self, labels, values, folds, stratified):
+        '''Returns the (train, test) index arrays of K fold cross validation.'''
+        if stratified:
+            CV = StratifiedKFold(n_splits=folds)
+        else:
+            CV = KFold(n_splits=folds)
+        return list(CV.split(values, labels))
+
+    def _fold_predictions(self, labels, values, splits, cb=None):
+        '''Returns the predictions for the test samples of each split, trained on the rest.'''
+        splits = list(splits)
+        predictions = np.zeros(len(labels), dtype=np.asarray(labels).dtype)
+        for i, predicted in crossvalidation.run_folds(crossvalidation.fit_and_predict,
+                                                      (self.classifier, values, labels),
+                                                      splits, self.n_jobs, cb):
+            predictions[splits[i][1]] = predicted
+        return predictions
+
+    def XValidate(self, labels, values, folds, stratified=True, scoring=None, cb=None):
         '''
         Performs K fold cross validation based on input folds.
         Takes a subset of the input data label_array and values to do the cross validation.
+        The folds are run in self.n_jobs processes (see
+        crossvalidation.run_folds).  cb is called with the fraction of
+        folds done and may raise an exception to cancel.
         RETURNS: array of length folds of cross validation scores
         '''
-
-        num_samples = values.shape[0]
-        if stratified:
-            CV = folds
-        else:
-            CV = KFold(num_samples, folds)
-        #scores = cross_validation.cross_val_score(self.classifier, scoring=scoring, X=values, y=labels, cv=CV, n_jobs=-1, verbose=1)
-        scores = cross_val_score(self.classifier, X=values, y=labels, cv=folds, n_jobs=1)
-
-        return np.array(scores)
+        scores = np.zeros(folds)
+        for i, score in crossvalidation.run_folds(crossvalidation.fit_and_score,
+                                                  (self.classifier, values, labels, scoring),
+                                                  self._splits(labels, values, folds, stratified),
+                                                  self.n_jobs, cb):
+            scores[i] = score
+        return scores
 
     def XValidateBalancedClasses(self, labels, values, folds):
         '''
@@ -222,22 +386,16 @@ class GeneralClassifier(BaseEstimator, ClassifierMixin):
         #do k fold cross validation on this newly balanced data
         return self.XValidate(labels_s, values_s, folds, stratified=True)
 
-    def XValidatePredict(self, labels, values, folds, stratified=True):
+    def XValidatePredict(self, labels, values, folds, stratified=True, cb=None):
         '''
         :param labels: class of each sample
         :param values: feature values for each sample
         :param folds: number of folds
         :param stratified: boolean whether to use stratified K fold
+        :param cb: called with the fraction of folds done; may raise an exception to cancel
         :return: cross-validated estimates for each input data point
         '''
-        num_samples = values.shape[0]
-        if stratified:
-            CV = folds
-        else:
-            CV = KFold(num_samples, folds)
-
-        predictions = cross_val_predict(self.classifier, X=values, y=labels, cv=CV, n_jobs=1)
-        return np.array(predictions)
+        return self._fold_predictions(labels, values, self._splits(labels, values, folds, stratified), cb)
 
     # Classification Report Start
 
@@ -405,7 +563,15 @@ class GeneralClassifier(BaseEstimator, ClassifierMixin):
         from sklearn.metrics import confusion_matrix
         # Compute confusion matrix
 
-        y_pred = self.XValidatePredict(self.env.trainingSet.label_array, self.env.trainingSet.values, folds, stratified=True)
+        dlg, cb = self._progress_dialog('Computing confusion matrix...')
+        try:
+            y_pred = self.XValidatePredict(self.env.trainingSet.label_array, self.env.trainingSet.values,
+                                           folds, stratified=True, cb=cb)
+        except crossvalidation.StopEvaluation:
+            self.env.PostMessage('Cross-validation canceled.')
+            return
+        finally:
+            dlg.Destroy()
         y_test = self.env.trainingSet.label_array
 
         cm = confusion_matrix(y_test, y_pred)
@@ -430,13 +596,19 @@ class GeneralClassifier(BaseEstimator, ClassifierMixin):
 
         plt.show()
 
-    # Get sklearn params dic
+    # Get sklearn params dic, with the number of cross-validation processes
     def get_params(self):
-        return self.classifier.get_params()
+        params = self.classifier.get_params()
+        params['evaluation_n_jobs'] = self.n_jobs
+        return params
 
     # Set sklearn params 
     def set_params(self, params):
-        self.classifier.set_params(**params)
+        params = dict(params)
+        if 'evaluation_n_jobs' in params:
+            self.n_jobs = max(int(params.pop('evaluation_n_jobs')), 1)
+        if params:
+            self.classifier.set_params(**params)
 
 
 if __name__ == '__main__':
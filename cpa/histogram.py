@@ -169,7 +169,7 @@ class DataSourcePanel(wx.Panel):
         if self.filter is not None:
             q.add_filter(self.filter)
             
-        return np.array(db.execute(str(q))).T[0]
+        return db.execute_columnar(str(q))[0]
 
     def save_settings(self):
         '''save_settings is called when saving a workspace to file.
@@ -1034,7 +1034,7 @@ class ImageGallery(wx.Frame):
             for tile in self.galleryBin.tiles:
                 pseudo_obKeys = tile.obKey
                 imKey = pseudo_obKeys[:-1] # Get image key
-                obKeys = db.GetObjectsFromImage(imKey)
+                obKeys = DataModel.getInstance().GetObjectsFromImage(imKey)
                 self.classBins[0].AddObjects(obKeys, self.chMap, pos='last', display_whole_image=False)
             
         wx.CallAfter(cb)
@@ -1061,7 +1061,7 @@ class ImageGallery(wx.Frame):
             for imKey in imKeys:
                 pseudo_obKeys = imKey
                 imKey = pseudo_obKeys[:-1] # Get image key
-                obKeys = db.GetObjectsFromImage(imKey)
+                obKeys = DataModel.getInstance().GetObjectsFromImage(imKey)
                 self.classBins[0].AddObjects(obKeys, self.chMap, pos='last', display_whole_image=False)
             
         wx.CallAfter(cb)
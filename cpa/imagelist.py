@@ -26,11 +26,12 @@ class ImageListCtrl(wx.ListCtrl):
             columns_of_interest = well_key_columns(p.image_table)
             if len(columns_of_interest) > 0:
                 columns_of_interest = ','+','.join(columns_of_interest)
-                self.data = db.execute('SELECT %s%s FROM %s WHERE %s'%(
-                            UniqueImageClause(), 
-                            columns_of_interest,
-                            p.image_table,
-                            GetWhereClauseForImages(imkeys)))
+                with KeySet(imkeys) as keys:
+                    self.data = db.execute('SELECT %s%s FROM %s WHERE %s'%(
+                                UniqueImageClause(), 
+                                columns_of_interest,
+                                p.image_table,
+                                keys.where_clause(p.image_table)))
                 self.cols = image_key_columns() + well_key_columns()
             else:
                 self.data = np.array(self.imkeys)
@@ -2,6 +2,7 @@
 A special image panel meant to be dragged and dropped.
 '''
 from dbconnect import DBConnect
+from datamodel import DataModel
 from imagepanel import ImagePanel
 from properties import Properties
 import imagetools
@@ -12,6 +13,7 @@ from trainingset import CellCache
 
 p = Properties.getInstance()
 db = DBConnect.getInstance()
+dm = DataModel.getInstance()
 
 
 class ImageTileDropTarget(wx.DropTarget):
@@ -139,7 +141,7 @@ class ImageTile(ImagePanel):
             def cb():
                 pseudo_obKeys = self.bin.SelectedKeys()
                 imKey = pseudo_obKeys[0][:-1] # Get image key
-                obKeys = db.GetObjectsFromImage(imKey)
+                obKeys = dm.GetObjectsFromImage(imKey)
                 self.classifier.classBins[0].AddObjects(obKeys, self.chMap, pos='last', display_whole_image=False)
             wx.CallAfter(cb)
         else:
@@ -153,12 +155,7 @@ class ImageTile(ImagePanel):
             if clf.trained:
                     # Get the probability scores and visualise them in a histogramm
                     #for k in self.bin.SelectedKeys():
-                    k = self.obKey
-                    def get_data(k):
-                        d = self.cache.get_object_data(k)
-                        return d
-
-                    values = [get_data(k)]
+                    values = self.cache.get_objects_data([self.obKey])
                     y_score = []
                     y_score = clf.PredictProba(values)        
 
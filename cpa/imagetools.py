@@ -18,9 +18,11 @@ db = dbconnect.DBConnect.getInstance()
 cache = {}
 cachedkeys = []
 
-def FetchTile(obKey, display_whole_image=False):
+def FetchTile(obKey, display_whole_image=False, pos=None):
     '''returns a list of image channel arrays cropped around the object
     coordinates
+    pos -- the object's (x, y) coordinates if they have already been looked
+           up (eg: with DBConnect.GetObjectCoordsBatch)
     '''
     imKey = obKey[:-1]
     # Could transform object coords here
@@ -33,7 +35,9 @@ def FetchTile(obKey, display_whole_image=False):
 
     else:
         size = (int(p.image_tile_size), int(p.image_tile_size))
-        pos = list(db.GetObjectCoords(obKey))
+        if pos is None:
+            pos = db.GetObjectCoords(obKey)
+        pos = list(pos)
         if None in pos:
             message = ('Failed to load coordinates for object key %s. This may '
                        'indicate a problem with your per-object table.\n'
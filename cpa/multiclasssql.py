@@ -3,12 +3,18 @@ from __future__ import print_function
 import numpy as np
 import sys
 import logging
+import re
+import threading
+import Queue
+import cPickle
+import hashlib
 
 sys.path.insert(1, '/home/vagrant/cpa-multiclass/CellProfiler-Analyst/cpa');
 sys.path.insert(1, '/home/vagrant/cpa-multiclass/CellProfiler-Analyst/')
 
 import cpa.sqltools
-from dbconnect import DBConnect, UniqueObjectClause, UniqueImageClause, image_key_columns, GetWhereClauseForImages, GetWhereClauseForObjects, object_key_defs
+import featurestore
+from dbconnect import DBConnect, DBException, UniqueObjectClause, UniqueImageClause, image_key_columns, object_key_columns, GetWhereClauseForImages, GetWhereClauseForObjects, object_key_defs, KeySet, to_float_array
 from properties import Properties
 from datamodel import DataModel
 from sklearn.ensemble import AdaBoostClassifier
@@ -22,105 +28,85 @@ temp_score_table = "_scores"
 temp_class_table = "_class"
 filter_table_prefix = '_filter_'
 
-def create_perobject_class_table(classifier, classNames):
+SCORING_CHUNK_SIZE = 100000  # objects read and classified at a time by score_objects
+SCORING_THREADS = 4          # threads reading chunks for score_objects
+CLASS_TABLE_BATCH_SIZE = 10000  # rows inserted at a time into the per-object tables
+
+def create_perobject_class_table(classifier, classNames, **kwargs):
     '''
     classifier: generalclassifier object
     classNames: list/array of class names
     RETURNS: Saves table with columns Table Number, Image Number, Object Number, class number, class name to a pre defined
-    table in the database (the class number is the predicted class)
+    table in the database (the class number is the predicted class).
+    If p.probability_table is set, the class probabilities are saved there too.
+    Keyword arguments are passed on to score_objects.  To get per-image
+    counts at the same time, use PerImageCounts with class_names instead.
     '''
-    nClasses = len(classNames)
-
-    if p.class_table is None:
-        raise ValueError('"class_table" in properties file is not set.')
-
-    index_cols = UniqueObjectClause()
-    class_cols = UniqueObjectClause() + ', class_number, class'
-    class_col_defs = object_key_defs() + ', class VARCHAR (%d)'%(3) + ', class_number INT'
-
-
-    # Drop must be explicitly asked for Classifier.ScoreAll
-    print('Drop table...')
-    db.execute('DROP TABLE IF EXISTS %s'%(p.class_table))
-    print('Create table...')
-    db.execute('CREATE TABLE %s (%s)'%(p.class_table, class_col_defs))
-    print('Create index...')
-    db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, index_cols))
-
-    print('Getting data...')
-    data = db.execute('SELECT %s, %s FROM %s %s'
-                          %(UniqueObjectClause(p.object_table),
-                            ",".join(db.GetColnamesForClassifier()), p.object_table,''))
-    #data.extend(result)
-    print('Getting predictions...')
-    cell_data, object_keys = processData(data)#, p.check_tables=='yes')
-    predicted_classes = classifier.Predict(cell_data)
-    print('Writing to database...')
-    if len(object_keys.shape) > 2:
-        expr = 'CASE '+ ''.join(["WHEN %s=%d AND %s=%d AND %s=%d THEN '%s'"%(p.table_id,
-            object_keys[ii][0], p.image_id, object_keys[ii][1], p.object_id, object_keys[ii][2], predicted_classes[ii] )
-            for ii in range(0, len(predicted_classes))])+ " END"
-        expr2 = 'CASE '+ ''.join(["WHEN %s=%d AND %s=%d AND %s=%d THEN '%s'"%(p.table_id,
-            object_keys[ii][0], p.image_id, object_keys[ii][1], p.object_id, object_keys[ii][2],
-            classNames[predicted_classes[ii] - 1]) for ii in range(0, len(predicted_classes))])+ " END"
-    elif len(object_keys.shape) == 2:
-        expr = 'CASE '+ ''.join(["WHEN %s=%d AND %s=%d THEN '%s'"%(p.image_id,
-            object_keys[ii][0], p.object_id, object_keys[ii][1], predicted_classes[ii] )
-            for ii in range(0, len(predicted_classes))])+ " END"
-        expr2 = 'CASE '+ ''.join(["WHEN %s=%d AND %s=%d THEN '%s'"%(p.image_id,
-            object_keys[ii][0], p.object_id, object_keys[ii][1], classNames[predicted_classes[ii] - 1])
-            for ii in range(0, len(predicted_classes))])+ " END"
-    else:
-        raise Exception('object keys have length ' + len(object_keys.shape) + ' but should have length >= 2')
-    db.execute('INSERT INTO %s (%s) SELECT %s, %s, %s FROM %s'%(p.class_table, class_cols, index_cols, expr, expr2, p.object_table),
-        silent=True)
-
-    db.Commit()
+    score_objects(classifier, _object_table_sinks(classNames), **kwargs)
 
 
-
-def FilterObjectsFromClassN(classNum, classifier, filterKeys, uncertain):
+def FilterObjectsFromClassN(classNum, classifier, filterKeys, uncertain, in_database=True):
     '''
     uncertain: allows to search for uncertain (regarding the probs assigned by the classifier) cell images
     classNum: 1-based index of the class to retrieve obKeys from
     classifier: trained classifier object
     filterKeys: (optional) A list of specific imKeys OR obKeys (NOT BOTH)
         to classify.
-        * WARNING: If this list is too long, you may exceed the size limit to
-          MySQL queries.
+        * Long lists are matched through a temporary key table (see
+          dbconnect.KeySet), so there is no limit on their length.
         * Useful when fetching N objects from a particular class. Use the
           DataModel to get batches of random objects, and sift through them
           here until N objects of the desired class have been accumulated.
         * Also useful for classifying a specific image or group of images.
-    RETURNS: A list of object keys that fall in the specified class (but not all objects?),
-        if Properties.area_scoring_column is specified, area sums are also
-        reported for each class
+    in_database: if the classifier is linear (see linear_scores), select
+        the objects of the class in the database rather than reading their
+        features.
+    Unless filterKeys is a where clause, the features are read from the
+    feature store if one is set up and current (see
+    featurestore.get_feature_store); it isn't exported here.
+    RETURNS: A list of object keys that fall in the specified class (but not all objects?)
     '''
 
-    if filterKeys != [] and filterKeys is not None:
+    if isinstance(filterKeys, str):
+        keys = KeySet([])
+    else:
+        keys = KeySet(filterKeys or [])
 
+    with keys:
         if isinstance(filterKeys, str):
             whereclause = filterKeys #+ " AND"
+        elif len(keys) > 0:
+            whereclause = keys.where_clause(p.object_table)
         else:
-            isImKey = len(filterKeys[0]) == len(image_key_columns())
-            if isImKey:
-                whereclause = GetWhereClauseForImages(filterKeys) #+ " AND"
-            else:
-                whereclause = GetWhereClauseForObjects(filterKeys) #+ " AND"
-    else:
-        whereclause = ""
+            whereclause = ""
 
-    if p.area_scoring_column:
-        data = db.execute('SELECT %s, %s FROM %s WHERE %s'%(UniqueObjectClause(p.object_table),
-        ",".join(db.GetColnamesForClassifier()),
-        _objectify(p, p.area_scoring_column), p.object_table, whereclause))
-        area_score = data[-1] #separate area from data
-        data = data[:-1]
-    else:
-        data = db.execute('SELECT %s, %s FROM %s WHERE %s'%(UniqueObjectClause(p.object_table),
-        ",".join(db.GetColnamesForClassifier()), p.object_table, whereclause))
+        if whereclause:
+            whereclause = 'WHERE %s'%(whereclause)
+        scores = in_database and not uncertain and linear_scores(classifier)
+        if scores:
+            try:
+                return db.execute('SELECT %s FROM (SELECT %s, %s FROM %s %s) AS _scores WHERE %s = %d'
+                                  %(UniqueObjectClause(), UniqueObjectClause(p.object_table),
+                                    scores[0], p.object_table, whereclause, scores[1], classNum))
+            except Exception as e:
+                logging.warning('Could not classify objects in the database, '
+                                'reading their features instead: %s'%(e))
+        classifier, feature_columns = pruned_classifier(classifier)
+        store = not isinstance(filterKeys, str) and featurestore.get_feature_store(build=False) or None
+        if store is not None and store.has_columns(feature_columns):
+            if filterKeys:
+                object_keys, cell_data = store.object_data(filterKeys, feature_columns, fill=0)
+            else:
+                object_keys, cell_data = store.rows(0, len(store.keys), feature_columns, fill=0)
+            cell_data = cell_data.astype('f8')
+        else:
+            cell_data, object_keys = fetch_object_data(
+                'SELECT %s, %s FROM %s %s'%(UniqueObjectClause(p.object_table),
+                                            ",".join(feature_columns),
+                                            p.object_table, whereclause))
 
-    cell_data, object_keys = processData(data)#, p.check_tables=='yes')
+    if len(object_keys) == 0:
+        return []
     res = [] # list
     if uncertain:
         # Our requirement: if the two largest scores are smaller than threshold
@@ -136,29 +122,36 @@ def FilterObjectsFromClassN(classNum, classifier, filterKeys, uncertain):
         res = object_keys[predicted_classes == classNum * np.ones(predicted_classes.shape)].tolist() #convert to list
     return map(tuple,res) # ... and then to tuples
 
-def processData(data):
-    #takes data from query and returns arrays for feature values and object keys
-    col_names = db.GetColnamesForClassifier()
-    number_of_features = len(col_names)
-    cell_data = []
-    object_keys = []
-    for row in data:
-        cell_data.append(row[-number_of_features:])#last number_of_features columns in row
-        object_keys.append(row[:-number_of_features])#all elements in row before last (number_of_features) elements
-    cell_data = np.array(cell_data)
-    object_keys = np.array(object_keys)
-    cell_data = np.where(cell_data == np.array(None), '0', cell_data).astype(str)
-
-    data_shape = cell_data.shape
-    # if numpy array is already floats, pass; if numpy array contains strings, convert
-    try:
-        cell_data = np.reshape(np.genfromtxt(cell_data.ravel(), delimiter=','), data_shape)
-        print('data type 1 ', cell_data.dtype)
-        cell_data = np.nan_to_num(cell_data)
-    except:
-        print('data type 2 ', cell_data.dtype)
-        cell_data = np.nan_to_num(cell_data)
-    logging.info('Any values that cannot be converted to float are set to 0')
+def object_key_array(key_columns):
+    '''
+    Stacks the key columns of a columnar fetch (see DBConnect.execute_columnar)
+    into an N x len(key_columns) integer array, one key per row.
+    '''
+    return np.column_stack([np.asarray(col, dtype='i8') for col in key_columns])
+
+def fetch_object_data(query, dtype='f8'):
+    '''
+    Executes a query selecting the object key columns followed by the
+    classifier features and returns (cell_data, object_keys): the features
+    as a 2-D array of dtype, with NULL and non-numeric values set to 0, and
+    the keys as an integer array with one row per object.
+    '''
+    key_columns, cell_data = db.execute_columnar(query, feature_start=len(object_key_columns()),
+                                                 dtype=dtype, fill=0)
+    return cell_data, object_key_array(key_columns)
+
+def processData(data, dtype='f8'):
+    '''
+    Takes rows of object key columns followed by the classifier features
+    (as returned by db.execute) and returns (cell_data, object_keys) as in
+    fetch_object_data.
+    '''
+    nfeatures = len(db.GetColnamesForClassifier())
+    nkeys = len(object_key_columns())
+    if len(data) == 0:
+        return np.zeros((0, nfeatures), dtype=dtype), np.zeros((0, nkeys), dtype='i8')
+    object_keys = np.array([row[:-nfeatures] for row in data], dtype='i8')
+    cell_data = to_float_array([row[-nfeatures:] for row in data], fill=0).astype(dtype)
     return cell_data, object_keys
 
 def _objectify(p, field):
@@ -196,11 +189,773 @@ def _where_clauses(p, dm, filter_name):
                  %(_objectify(p, p.image_id), lo[0], _objectify(p, p.image_id), hi[0])
                  for lo, hi in zip(key_thresholds[:-1], key_thresholds[1:])])
 
-def PerImageCounts(classifier, num_classes, filter_name=None, cb=None):
+def _image_chunks(object_counts, chunk_size):
+    '''
+    Splits a list of images into runs of consecutive images holding at most
+    chunk_size objects each (a run holds at least one image).
+    object_counts -- number of objects in each image
+    RETURNS: a list of (start, stop) index ranges
+    '''
+    chunks = []
+    start = 0
+    nobjects = 0
+    for i, count in enumerate(object_counts):
+        if i > start and nobjects + count > chunk_size:
+            chunks.append((start, i))
+            start = i
+            nobjects = 0
+        nobjects += count
+    if start < len(object_counts):
+        chunks.append((start, len(object_counts)))
+    return chunks
+
+def _key_range_clause(columns, lo, hi):
+    '''
+    Returns an SQL condition matching keys from lo to hi (inclusive) in
+    lexicographic order, where the key is made of one or two columns.
+    '''
+    if len(columns) == 1:
+        return '%s BETWEEN %d AND %d'%(columns[0], lo[0], hi[0])
+    (t, i), (lo_t, lo_i), (hi_t, hi_i) = columns, lo, hi
+    if lo_t == hi_t:
+        return '%s = %d AND %s BETWEEN %d AND %d'%(t, lo_t, i, lo_i, hi_i)
+    return ('(%s > %d OR (%s = %d AND %s >= %d)) AND (%s < %d OR (%s = %d AND %s <= %d))'
+            %(t, lo_t, t, lo_t, i, lo_i, t, hi_t, t, hi_t, i, hi_i))
+
+def _key_codes(keys, radix):
+    '''
+    Encodes an N x 1 or N x 2 integer array of image keys as one integer per
+    key, preserving their order.  radix must exceed every ImageNumber.
+    '''
+    if keys.shape[1] == 1:
+        return keys[:, 0]
+    return keys[:, 0] * radix + keys[:, 1]
+
+def _match_keys(keys, sorted_keys):
+    '''
+    Returns the index of each row of keys (an N x nkeys integer array) in
+    sorted_keys (in lexicographic order), or -1 where it isn't there.
+    '''
+    if len(keys) == 0 or len(sorted_keys) == 0:
+        return -np.ones(len(keys), dtype='i8')
+    radix = max(keys[:, -1].max(), sorted_keys[:, -1].max()) + 1
+    index = np.searchsorted(_key_codes(sorted_keys, radix), _key_codes(keys, radix))
+    index = np.minimum(index, len(sorted_keys) - 1)
+    found = (sorted_keys[index] == keys).all(axis=1)
+    return np.where(found, index, -1)
+
+
+def linear_scores(classifier):
+    '''
+    Returns (score_columns, class_expression) to classify objects in the
+    database with a linear classifier, or None if the classifier isn't
+    linear (its LinearModel method, if any, returns None).
+    score_columns selects the score of each class from the object table,
+    as _score0, _score1, ..., and class_expression gives the predicted
+    class from those scores, so it must be used in a query on a subquery
+    selecting score_columns.  NULL features count as 0, as in
+    fetch_object_data, and ties go to the first class, as with argmax.
+    '''
+    model = getattr(classifier, 'LinearModel', None)
+    model = model and model()
+    if model is None:
+        return None
+    coef, intercept, classes = model
+    colnames = db.GetColnamesForClassifier()
+    coef = np.asarray(coef, dtype='f8')
+    intercept = np.asarray(intercept, dtype='f8')
+    if (coef.shape[1] != len(colnames) or not np.isfinite(coef).all()
+        or not np.isfinite(intercept).all()
+        or not all([float(c) == int(c) for c in classes])):
+        logging.info('Cannot classify objects with this model in the database')
+        return None
+    scores = []
+    for k in range(len(coef)):
+        terms = [repr(float(intercept[k]))]
+        terms += ['%r*COALESCE(%s,0)'%(float(w), _objectify(p, col))
+                  for w, col in zip(coef[k], colnames) if w != 0]
+        scores += ['(%s) AS _score%d'%(' + '.join(terms), k)]
+    # the first class whose score is no less than any of the following ones
+    whens = ['WHEN %s THEN %d'%(' AND '.join(['_score%d >= _score%d'%(k, j)
+                                              for j in range(k + 1, len(coef))]), int(classes[k]))
+             for k in range(len(coef) - 1)]
+    return (', '.join(scores),
+            'CASE %s ELSE %d END'%(' '.join(whens), int(classes[-1])))
+
+def _image_counts_in_database(scores, num_classes, filter_name):
+    '''
+    Counts the objects in each class (and sums their areas) for each image
+    in a filter with a single query, classifying them with linear_scores.
+    Returns the rows of PerImageCounts.
+    '''
+    join_clause = ''
+    if filter_name is not None:
+        join_clause = ('JOIN (SELECT DISTINCT %s FROM (%s) AS _f) AS _filter USING (%s)'
+                       %(UniqueImageClause(), db.filter_sql(filter_name), UniqueImageClause()))
+    area_column = area_sum = ''
+    if p.area_scoring_column:
+        area_column = ', %s AS _area'%(_objectify(p, p.area_scoring_column))
+        area_sum = ', SUM(_area)'
+    results = db.execute('SELECT %s, %s AS _class, COUNT(*)%s FROM '
+                         '(SELECT %s%s, %s FROM %s %s) AS _scores GROUP BY %s, _class'
+                         %(UniqueImageClause(), scores[1], area_sum,
+                           UniqueImageClause(p.object_table), area_column, scores[0],
+                           p.object_table, join_clause, UniqueImageClause()))
+    nkeys = len(image_key_columns())
+    counts = {}
+    for row in results:
+        counts[tuple(row[:nkeys + 1])] = row[nkeys + 1:]
+    rows = []
+    for imkey, count in dm.GetImageKeysAndObjectCounts(filter_name):
+        found = [counts.get(tuple(imkey) + (cl,)) for cl in range(1, num_classes + 1)]
+        row = list(imkey) + [int(f[0]) if f else 0 for f in found]
+        if p.area_scoring_column:
+            row += [float(f[1] or 0) if f else 0.0 for f in found]
+        rows.append(row)
+    return rows
+
+
+class _ExpandedFeatures(object):
+    '''
+    Stands in for a classifier that needs every classifier column but only
+    depends on some of them, so only those need to be read: the values of
+    those columns are put back in place, with zeros for the others, before
+    calling the classifier.
+    '''
+    def __init__(self, classifier, indices, width):
+        self.classifier = classifier
+        self.indices = indices
+        self.width = width
+
+    def expand(self, cell_data):
+        values = np.zeros((cell_data.shape[0], self.width), dtype=cell_data.dtype)
+        values[:, self.indices] = cell_data
+        return values
+
+    def Predict(self, cell_data):
+        return self.classifier.Predict(self.expand(cell_data))
+
+    def PredictProba(self, cell_data):
+        return self.classifier.PredictProba(self.expand(cell_data))
+
+def pruned_classifier(classifier):
+    '''
+    Returns (classifier, feature_columns): the columns to read to score
+    objects with the given classifier, and a classifier to pass their
+    values to.  If the classifier's UsedFeatures method says it depends on
+    only some of db.GetColnamesForClassifier(), only those are read and the
+    classifier is wrapped to fill in the others.
+    '''
+    colnames = db.GetColnamesForClassifier()
+    used = getattr(classifier, 'UsedFeatures', None)
+    used = used and used()
+    if used is None:
+        return classifier, colnames
+    used = set(used)
+    indices = [i for i, col in enumerate(colnames) if col in used]
+    if len(indices) == len(colnames):
+        return classifier, colnames
+    # read one column even for a model that doesn't depend on any
+    indices = indices or [0]
+    logging.info('Reading %d of %d features to score objects'%(len(indices), len(colnames)))
+    return _ExpandedFeatures(classifier, indices, len(colnames)), [colnames[i] for i in indices]
+
+
+_process_classifier = None
+
+def _init_predict_process(classifier):
+    global _process_classifier
+    _process_classifier = classifier
+
+def _predict_in_process(cell_data, probabilities):
+    return _predict(_process_classifier, cell_data, probabilities)
+
+def _predict(classifier, cell_data, probabilities):
+    classes = np.asarray(classifier.Predict(cell_data)).astype('i8')
+    if probabilities:
+        probs = classifier.PredictProba(cell_data)
+        if probs is not None:
+            probs = np.asarray(probs, dtype='f8')
+        return classes, probs
+    return classes, None
+
+class _Predictor(object):
+    '''
+    Runs classifier.Predict (and PredictProba) in a pool of n_processes
+    worker processes, or in the calling thread if n_processes is 0 or the
+    classifier can't be pickled.  The classifier is sent to each process
+    once.
+    '''
+    def __init__(self, classifier, n_processes=0):
+        self.classifier = classifier
+        self.pool = None
+        if n_processes > 0:
+            try:
+                cPickle.dumps(classifier, cPickle.HIGHEST_PROTOCOL)
+                from multiprocessing import Pool
+                self.pool = Pool(n_processes, _init_predict_process, (classifier,))
+            except Exception as e:
+                logging.info('Could not start prediction processes, predicting '
+                             'in this process instead: %s'%(e))
+
+    def predict(self, cell_data, probabilities=False):
+        '''Returns the classes of the rows of cell_data, and their probabilities or None.'''
+        if self.pool is None:
+            return _predict(self.classifier, cell_data, probabilities)
+        return self.pool.apply(_predict_in_process, (cell_data, probabilities))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+def _map_chunks(fn, chunks, n_threads):
+    '''
+    Yields (chunk, fn(chunk)) for each chunk, in the order they are finished.
+    With more than one thread, the chunks are handed out to n_threads worker
+    threads, but no more than there are free connections in the pool, so
+    scoring doesn't wait on (or time out for) connections held elsewhere,
+    eg: by a prediction index being built.  Each worker returns its database
+    connection to the pool after every chunk so other threads needn't wait
+    for the whole run.  Exceptions raised by fn are re-raised here.  Closing the generator stops the workers once they
+    have finished their current chunk.
+    '''
+    if n_threads > 1:
+        n_threads = min(n_threads, db.connection_pool.free_slots())
+    if n_threads <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield chunk, fn(chunk)
+        return
+
+    tasks = Queue.Queue()
+    for chunk in chunks:
+        tasks.put(chunk)
+    results = Queue.Queue()
+    stopped = threading.Event()
+
+    def work():
+        while not stopped.isSet():
+            try:
+                chunk = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results.put((chunk, fn(chunk), None))
+            except Exception as e:
+                results.put((chunk, None, e))
+                return
+            finally:
+                # return the thread's connection to the pool
+                db.ReleaseConnection()
+
+    threads = []
+    for i in range(min(n_threads, len(chunks))):
+        thread = threading.Thread(target=work)
+        thread.setName('ScoreObjects_%s'%(thread.getName()))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    try:
+        for i in range(len(chunks)):
+            chunk, result, error = results.get()
+            if error is not None:
+                raise error
+            yield chunk, result
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+
+class ScoredChunk(object):
+    '''
+    The objects of a run of images, as classified by score_objects.
+
+    object_keys -- N x len(object_key_columns()) integer array
+    image_index -- index of each object's image in the image keys passed to
+        ScoringSink.start, or -1 if its image isn't one of them
+    classes -- predicted class of each object (1-based)
+    probabilities -- N x number of classes array of class probabilities, or
+        None if no sink asked for them or the classifier doesn't provide them
+    areas -- the area_scoring_column of each object, or None if it isn't set
+    '''
+    def __init__(self, object_keys, image_index, classes, probabilities=None, areas=None):
+        self.object_keys = object_keys
+        self.image_index = image_index
+        self.classes = classes
+        self.probabilities = probabilities
+        self.areas = areas
+
+
+class ScoringSink(object):
+    '''
+    Receives the results of score_objects, a chunk of objects at a time.
+    All methods are called from the thread that called score_objects.
+    '''
+    probabilities = False   # whether add needs the class probabilities
+    all_objects = False     # whether add needs the objects outside the filter
+
+    def start(self, image_keys):
+        '''Called first with the (sorted) keys of the images that will be scored.'''
+        pass
+
+    def add(self, chunk):
+        '''Called with each ScoredChunk.'''
+        pass
+
+    def finish(self):
+        '''Called once every object has been scored.'''
+        pass
+
+    def abort(self):
+        '''Called instead of finish if scoring fails or is canceled.'''
+        pass
+
+
+class ImageCountsSink(ScoringSink):
+    '''
+    Counts the objects in each class (and sums their areas if
+    p.area_scoring_column is set) for each image in a filter.
+    '''
+    def __init__(self, num_classes, filter_name=None):
+        self.num_classes = num_classes
+        self.imkeys = [imkey for imkey, count in dm.GetImageKeysAndObjectCounts(filter_name)]
+
+    def start(self, image_keys):
+        keys = np.array(self.imkeys, dtype='i8').reshape((len(self.imkeys), image_keys.shape[1]))
+        # row of each scored image in self.imkeys, or -1
+        self.rows = -np.ones(len(image_keys), dtype='i8')
+        index = _match_keys(keys, image_keys)
+        self.rows[index[index >= 0]] = np.flatnonzero(index >= 0)
+        self.counts = np.zeros((len(self.imkeys), self.num_classes), dtype='i8')
+        self.area_sums = np.zeros((len(self.imkeys), self.num_classes))
+
+    def add(self, chunk):
+        rows = np.where(chunk.image_index >= 0, self.rows[chunk.image_index], -1)
+        valid = (rows >= 0) & (chunk.classes >= 1) & (chunk.classes <= self.num_classes)
+        if not valid.any():
+            return
+        rows = rows[valid]
+        lo, hi = rows.min(), rows.max() + 1
+        bins = (rows - lo) * self.num_classes + chunk.classes[valid] - 1
+        size = (hi - lo) * self.num_classes
+        self.counts[lo:hi] += np.bincount(bins, minlength=size).reshape((hi - lo, self.num_classes))
+        if chunk.areas is not None:
+            self.area_sums[lo:hi] += np.bincount(bins, weights=chunk.areas[valid], 
+                                                 minlength=size).reshape((hi - lo, self.num_classes))
+
+    def results(self):
+        '''
+        Returns a list of [image key..., count of each class...] rows, plus
+        the area sums of each class if p.area_scoring_column is set, in the
+        order of the DataModel's image keys.
+        '''
+        rows = []
+        for i, imkey in enumerate(self.imkeys):
+            row = list(imkey) + self.counts[i].tolist()
+            if p.area_scoring_column:
+                row += self.area_sums[i].tolist()
+            rows.append(row)
+        return rows
+
+
+class ObjectTableSink(ScoringSink):
+    '''
+    Writes a row per object to a new table, replacing any table of the same
+    name.  The rows are inserted in batches of CLASS_TABLE_BATCH_SIZE with
+    executemany and the table is indexed on the object keys once loaded.
+    With append, the rows are added to the table if it already exists,
+    replacing any rows of the images being scored.
+    Subclasses define the columns.
+    '''
+    all_objects = True
+
+    def __init__(self, table, append=False):
+        self.table = table
+        self.append = append
+
+    def column_defs(self):
+        '''Returns the SQL definitions of the columns after the object keys.'''
+        raise NotImplementedError
+
+    def values(self, chunk):
+        '''Returns a list of columns (as lists) to write after the object keys.'''
+        raise NotImplementedError
+
+    def start(self, image_keys):
+        self.image_keys = [tuple(key) for key in image_keys.tolist()]
+        self.created = not (self.append and db.table_exists(self.table))
+        if self.created:
+            # Drop must be explicitly asked for Classifier.ScoreAll
+            db.execute('DROP TABLE IF EXISTS %s'%(self.table))
+            db.execute('CREATE TABLE %s (%s)'%(self.table, ', '.join(
+                [object_key_defs()] + ['%s %s'%(col, coltype) for col, coltype in self.column_defs()])))
+        else:
+            # rows left by an interrupted run
+            self.delete_images()
+        db.invalidate_cache()
+        self.columns = list(object_key_columns()) + [col for col, coltype in self.column_defs()]
+        self.nobjects = 0
+
+    def delete_images(self):
+        '''Deletes the rows of the objects in the images being scored.'''
+        with KeySet(self.image_keys) as keys:
+            db.execute('DELETE FROM %s WHERE %s'%(self.table, keys.where_clause(self.table)))
+
+    def add(self, chunk):
+        columns = [col.tolist() for col in chunk.object_keys.T] + self.values(chunk)
+        rows = list(zip(*columns))
+        for i in range(0, len(rows), CLASS_TABLE_BATCH_SIZE):
+            db.insert_rows(self.table, self.columns, rows[i:i + CLASS_TABLE_BATCH_SIZE])
+        self.nobjects += len(rows)
+        logging.debug('Wrote %d objects to %s'%(self.nobjects, self.table))
+
+    def finish(self):
+        if self.created:
+            db.execute('CREATE INDEX idx_%s ON %s (%s)'%(self.table, self.table, UniqueObjectClause()))
+        db.Commit()
+        db.invalidate_cache()
+
+    def abort(self):
+        if self.created:
+            db.execute('DROP TABLE IF EXISTS %s'%(self.table))
+        else:
+            self.delete_images()
+        db.Commit()
+        db.invalidate_cache()
+
+
+class ClassTableSink(ObjectTableSink):
+    '''
+    Writes the class of each object to a table (by default p.class_table),
+    and the fingerprint of the model (see model_fingerprint), if given.
+    '''
+    def __init__(self, class_names, table=None, fingerprint=None, append=False):
+        ObjectTableSink.__init__(self, table or p.class_table, append)
+        if self.table is None:
+            raise ValueError('"class_table" in properties file is not set.')
+        # classes without a name (shouldn't happen) get an empty one
+        self.class_names = np.array([str(name) for name in class_names] + [''], dtype=object)
+        self.fingerprint = fingerprint
+
+    def column_defs(self):
+        class_len = max([len(name) for name in self.class_names] + [3])
+        defs = [('class', 'VARCHAR (%d)'%(class_len)), ('class_number', 'INT')]
+        if self.fingerprint:
+            defs += [('model_fingerprint', 'VARCHAR (32)')]
+        return defs
+
+    def values(self, chunk):
+        nclasses = len(self.class_names) - 1
+        names = self.class_names[np.where((chunk.classes >= 1) & (chunk.classes <= nclasses),
+                                          chunk.classes - 1, nclasses)]
+        values = [names.tolist(), chunk.classes.tolist()]
+        if self.fingerprint:
+            values += [[self.fingerprint] * len(chunk.classes)]
+        return values
+
+
+class ProbabilityTableSink(ObjectTableSink):
+    '''
+    Writes the probability of each class for each object to a table (by
+    default p.probability_table), with a column p_<class name> per class.
+    '''
+    probabilities = True
+
+    def __init__(self, class_names, table=None, append=False):
+        ObjectTableSink.__init__(self, table or p.probability_table, append)
+        if self.table is None:
+            raise ValueError('"probability_table" in properties file is not set.')
+        self.probability_columns = ['p_%s'%(re.sub(r'\W', '_', str(name))) for name in class_names]
+
+    def column_defs(self):
+        return [(col, 'FLOAT') for col in self.probability_columns]
+
+    def add(self, chunk):
+        if chunk.probabilities is None:
+            if self.nobjects == 0:
+                logging.warn('The classifier does not provide class probabilities, '
+                             'so %s will be empty.'%(self.table))
+            return
+        ObjectTableSink.add(self, chunk)
+
+    def values(self, chunk):
+        probabilities = chunk.probabilities[:, :len(self.probability_columns)]
+        return [col.tolist() for col in probabilities.T]
+
+
+def _object_table_sinks(class_names, fingerprint=None, append=False):
+    '''Returns sinks for p.class_table and, if it is set, p.probability_table.'''
+    sinks = [ClassTableSink(class_names, fingerprint=fingerprint, append=append)]
+    if p.probability_table:
+        sinks += [ProbabilityTableSink(class_names, append=append)]
+    return sinks
+
+
+class ImageCountsTableSink(ImageCountsSink):
+    '''
+    Adds the number of objects in each class (and the sums of their areas)
+    in each scored image to a table, by default p.class_counts_table (see
+    IncrementalPerImageCounts), with the fingerprint of the model.  The
+    rows are written once every object has been scored.
+    '''
+    def __init__(self, class_names, fingerprint, table=None):
+        self.num_classes = len(class_names)
+        self.table = table or counts_table_name()
+        self.fingerprint = fingerprint
+        self.count_columns, self.area_columns = _counts_columns(class_names)
+
+    def start(self, image_keys):
+        self.imkeys = [tuple(key) for key in image_keys.tolist()]
+        ImageCountsSink.start(self, image_keys)
+
+    def finish(self):
+        if not db.table_exists(self.table):
+            db.execute('CREATE TABLE %s (%s, model_fingerprint VARCHAR (32), %s)'%(
+                self.table, ', '.join(['%s INT'%(col) for col in image_key_columns()]),
+                ', '.join(['%s INT'%(col) for col in self.count_columns] +
+                          ['%s FLOAT'%(col) for col in self.area_columns])))
+        columns = list(image_key_columns()) + ['model_fingerprint'] + self.count_columns + self.area_columns
+        rows = [tuple(imkey) + (self.fingerprint,) + tuple(self.counts[i].tolist()) +
+                tuple(self.area_sums[i].tolist()) for i, imkey in enumerate(self.imkeys)]
+        for i in range(0, len(rows), CLASS_TABLE_BATCH_SIZE):
+            db.insert_rows(self.table, columns, rows[i:i + CLASS_TABLE_BATCH_SIZE])
+        db.Commit()
+        db.invalidate_cache()
+
+class PredictionIndexSink(ScoringSink):
+    '''
+    Collects the class of every object (and the probability of that class,
+    if probabilities is true and the classifier provides them) into a
+    PredictionIndex, self.index.
+    '''
+    all_objects = True
+
+    def __init__(self, probabilities=True):
+        self.probabilities = probabilities
+        self.index = None
+
+    def start(self, image_keys):
+        self.nkeys = image_keys.shape[1]
+        self.keys, self.classes, self.probs = [], [], []
+
+    def add(self, chunk):
+        self.keys.append(chunk.object_keys)
+        self.classes.append(chunk.classes.astype('i2'))
+        if chunk.probabilities is not None:
+            self.probs.append(chunk.probabilities.max(axis=1).astype('f4'))
+
+    def finish(self):
+        nobkeys = len(object_key_columns())
+        keys = np.concatenate(self.keys + [np.zeros((0, nobkeys), dtype='i8')])
+        classes = np.concatenate(self.classes + [np.zeros(0, dtype='i2')])
+        probs = None
+        if self.probs and len(self.probs) == len(self.classes):
+            probs = np.concatenate(self.probs)
+        self.index = PredictionIndex(keys, classes, probs, self.nkeys)
+
+
+class PredictionIndex(object):
+    '''
+    The predicted class (and its probability, if known) of every object,
+    for fetching objects of a class, or the least certain objects, without
+    classifying random objects until enough are found.  Objects can be
+    drawn from the whole experiment or from a list of images.  Built by
+    build_prediction_index.
+    '''
+    def __init__(self, object_keys, classes, probabilities=None, nkeys=None):
+        order = np.lexsort(object_keys.T[::-1])
+        self.object_keys = object_keys[order]
+        self.classes = classes[order]
+        self.probabilities = probabilities[order] if probabilities is not None else None
+        self.nkeys = nkeys or len(image_key_columns())
+
+    def __len__(self):
+        return len(self.classes)
+
+    def has_probabilities(self):
+        return self.probabilities is not None
+
+    def _in_images(self, image_keys):
+        '''Returns a mask of the objects in the images, or of all objects if image_keys is None.'''
+        if image_keys is None:
+            return np.ones(len(self.classes), dtype=bool)
+        keys = np.array([tuple(key) for key in image_keys], dtype='i8').reshape((-1, self.nkeys))
+        keys = keys[np.lexsort(keys.T[::-1])]
+        return _match_keys(self.object_keys[:, :self.nkeys], keys) >= 0
+
+    def _key_list(self, rows):
+        return [tuple(key) for key in self.object_keys[rows].tolist()]
+
+    def sample(self, class_num, n, image_keys=None):
+        '''
+        Returns the keys of n random objects of class class_num (1-based),
+        or of all of them if there are fewer, from the given images (default:
+        from the whole experiment).
+        '''
+        rows = np.flatnonzero((self.classes == class_num) & self._in_images(image_keys))
+        if len(rows) > n:
+            rows = np.random.choice(rows, n, replace=False)
+        return self._key_list(rows)
+
+    def most_uncertain(self, n, image_keys=None):
+        '''
+        Returns the keys of the n objects (from the given images) whose
+        predicted class is the least probable, least probable first, with
+        ties broken by key.
+        '''
+        if self.probabilities is None:
+            raise ValueError('The prediction index has no class probabilities')
+        rows = np.flatnonzero(self._in_images(image_keys))
+        # rows are in key order, which a stable sort keeps for ties
+        order = np.argsort(self.probabilities[rows], kind='mergesort')
+        return self._key_list(rows[order[:n]])
+
+
+def score_objects(classifier, sinks, filter_name=None, cb=None,
+                  n_threads=SCORING_THREADS, n_processes=0,
+                  chunk_size=SCORING_CHUNK_SIZE, feature_columns=None, fill=0,
+                  image_keys=None):
+    '''
+    Classifies the objects in the images of a filter (or every object, if
+    any of the sinks needs them all), reading and classifying each object
+    once, and hands the results to each of the sinks a chunk at a time.
+
+    classifier: trained classifier object
+    sinks: list of ScoringSink objects
+    filter_name: name of filter, or None.
+    cb: callback function to update with the fraction complete.  It may
+        raise an exception (eg: StopCalculating) to cancel.
+    n_threads: number of threads reading chunks of images from the database
+    n_processes: number of processes to run classifier.Predict in, or 0 to
+        predict in the reading threads
+    chunk_size: number of objects to read and classify at a time
+    feature_columns: the columns of the object table to pass to the
+        classifier (default: those it uses, see pruned_classifier)
+    fill: value the classifier gets for NULL and non-numeric features
+        (None for NaN)
+    image_keys: if given, only the objects in these images are scored
+    Features are read from the feature store rather than the database if
+    one is set up (see featurestore.get_feature_store) and has the columns.
+    '''
+    # The images are split into runs of consecutive image keys, which are
+    # read and classified in parallel.  The area column, if any, is read as
+    # the first "feature".
+    if any([sink.all_objects for sink in sinks]):
+        filter_name = None
+    probabilities = any([sink.probabilities for sink in sinks])
+    imkeys_counts = list(dm.GetImageKeysAndObjectCounts(filter_name))
+    # reading a range of images can include ones that aren't to be scored
+    # (left out by a filter, or not in image_keys), whose objects are dropped
+    # once they're matched to the image keys
+    drop_unmatched = image_keys is not None
+    if image_keys is not None:
+        wanted = set([tuple(key) for key in image_keys])
+        imkeys_counts = [(imkey, count) for imkey, count in imkeys_counts if tuple(imkey) in wanted]
+    nkeys = len(image_key_columns())
+    image_keys = np.array([imkey for imkey, count in imkeys_counts], dtype='i8').reshape((len(imkeys_counts), nkeys))
+    object_counts = np.array([count for imkey, count in imkeys_counts], dtype='i8')
+    order = np.lexsort(image_keys.T[::-1])
+    image_keys = image_keys[order]
+    object_counts = object_counts[order]
+
+    key_columns = [_objectify(p, col) for col in image_key_columns()]
+    columns = list(object_key_columns(p.object_table))
+    if p.area_scoring_column:
+        columns += [_objectify(p, p.area_scoring_column)]
+    if feature_columns is None:
+        classifier, feature_columns = pruned_classifier(classifier)
+    columns += [_objectify(p, col) for col in feature_columns]
+    join_clause = ''
+    if filter_name is not None:
+        join_clause = ('JOIN (SELECT DISTINCT %s FROM (%s) AS _f) AS _filter USING (%s)'
+                       %(UniqueImageClause(), db.filter_sql(filter_name), UniqueImageClause()))
+    predictor = _Predictor(classifier, n_processes)
+    store = featurestore.get_feature_store(cb)
+    store_columns = ([p.area_scoring_column] if p.area_scoring_column else []) + list(feature_columns)
+    if store is not None and not store.has_columns(store_columns):
+        store = None
+    drop_unmatched = drop_unmatched or store is not None
+
+    def read_chunk(start, stop):
+        if store is not None:
+            a, b = store.image_rows(image_keys[start], image_keys[stop - 1])
+            object_keys, cell_data = store.rows(a, b, store_columns, fill)
+            return object_keys, cell_data.astype('f8')
+        query = 'SELECT %s FROM %s %s WHERE %s'%(
+            ', '.join(columns), p.object_table, join_clause,
+            _key_range_clause(key_columns, image_keys[start], image_keys[stop - 1]))
+        keys, cell_data = db.execute_columnar(query, feature_start=len(object_key_columns()),
+                                              fill=fill, nrows=int(object_counts[start:stop].sum()),
+                                              silent=True)
+        return object_key_array(keys), cell_data
+
+    def score_chunk(chunk):
+        start, stop = chunk
+        object_keys, cell_data = read_chunk(start, stop)
+        image_index = _match_keys(object_keys[:, :nkeys], image_keys[start:stop])
+        if drop_unmatched:
+            object_keys = object_keys[image_index >= 0]
+            cell_data = cell_data[image_index >= 0]
+            image_index = image_index[image_index >= 0]
+        image_index[image_index >= 0] += start
+        areas = None
+        if p.area_scoring_column:
+            # NULL areas add nothing to the sums, as with SQL's SUM
+            areas = np.nan_to_num(cell_data[:, 0])
+            cell_data = cell_data[:, 1:]
+        if len(object_keys) == 0:
+            return None
+        classes, probs = predictor.predict(cell_data, probabilities)
+        return ScoredChunk(object_keys, image_index, classes, probs, areas)
+
+    started = []
+    nobjects = float(max(object_counts.sum(), 1))
+    ndone = 0
+    results = _map_chunks(score_chunk, _image_chunks(object_counts, chunk_size), n_threads)
+    try:
+        for sink in sinks:
+            sink.start(image_keys)
+            started.append(sink)
+        for (start, stop), scored in results:
+            if scored is not None:
+                for sink in sinks:
+                    sink.add(scored)
+            ndone += object_counts[start:stop].sum()
+            if cb:
+                cb(min(1.0, ndone / nobjects))
+        for sink in sinks:
+            sink.finish()
+    except:
+        # stop the readers before cleaning up
+        results.close()
+        for sink in started:
+            try:
+                sink.abort()
+            except Exception as e:
+                logging.error('Failed to clean up after scoring: %s'%(e))
+        raise
+    finally:
+        results.close()
+        predictor.close()
+
+def PerImageCounts(classifier, num_classes, filter_name=None, cb=None,
+                   class_names=None, in_database=True, **kwargs):
     '''
     classifier: trained classifier object
     filter: name of filter, or None.
-    cb: callback function to update with the fraction complete
+    cb: callback function to update with the fraction complete.  It may
+        raise an exception (eg: StopCalculating) to cancel.
+    class_names: if given, the class of every object is also written to
+        p.class_table (and the class probabilities to p.probability_table,
+        if set) while the objects are scored, rather than in another pass
+        with create_perobject_class_table.
+    in_database: if the classifier is linear (see linear_scores) and
+        class_names isn't given, count the objects of each class in the
+        database, with a single query, rather than reading their features.
+    Other keyword arguments are passed on to score_objects.
     RETURNS: A list of lists of imKeys and respective object counts for each class:
         Note that the imKeys are exploded so each row is of the form:
         [TableNumber, ImageNumber, Class1_ObjectCount, Class2_ObjectCount,...]
@@ -208,91 +963,130 @@ def PerImageCounts(classifier, num_classes, filter_name=None, cb=None):
         If p.area_scoring_column is set, then area scores will be appended to
         the object scores.
     '''
+    counts = ImageCountsSink(num_classes, filter_name)
+    if len(counts.imkeys) == 0:
+        return []
+    scores = in_database and class_names is None and linear_scores(classifier)
+    if scores:
+        try:
+            rows = _image_counts_in_database(scores, num_classes, filter_name)
+            if cb:
+                cb(1.0)
+            return rows
+        except Exception as e:
+            logging.warning('Could not count the objects in the database, '
+                            'reading their features instead: %s'%(e))
+    sinks = [counts]
+    if class_names is not None:
+        sinks += _object_table_sinks(class_names)
+    score_objects(classifier, sinks, filter_name, cb, **kwargs)
+    return counts.results()
 
-    # I'm pretty sure this would be even faster if we were to run two
-    # or more parallel threads and split the work between them.
-    # For each image clause, classify the cells using the model
-    # then for each image key, count the number in each class (and maybe area)
-    def do_by_steps(tables, filter_name, area_score=False):
-        filter_clause = '1 = 1'
-        join_clause = ''
-        if filter_name is not None:
-            filter = p._filters[filter_name]
-            if isinstance(filter, cpa.sqltools.OldFilter):
-                join_table = '(%s) as filter' % str(filter)
-            else:
-                if p.object_table in tables:
-                    join_table = None
-                else:
-                    join_table = p.object_table
-                    filter_clause = str(filter)
-            if join_table:
-                join_clause = 'JOIN %s USING (%s)' % (join_table, ','.join(image_key_columns()))
-
-        wheres = _where_clauses(p, dm, filter_name)
-        num_clauses = len(wheres)
-        counts = {}
-
-        # iterate over where clauses to go through whole set
-        for idx, where_clause in enumerate(wheres):
-            if filter_clause is not None:
-                where_clause += ' AND ' + filter_clause
-            if area_score:
-                data = db.execute('SELECT %s, %s, %s FROM %s '
-                                  '%s WHERE %s'
-                                  %(UniqueImageClause(p.object_table),
-                                    ",".join(db.GetColnamesForClassifier()),
-                                    _objectify(p, p.area_scoring_column), tables,
-                                    join_clause, where_clause),
-                                  silent=(idx > 10))
-                area_score = data[-1] #separate area from data
-                data = data[:-1]
-            else:
-                data = db.execute('SELECT %s, %s FROM %s '
-                              '%s WHERE %s'
-                              %(UniqueObjectClause(p.object_table),
-                                ",".join(db.GetColnamesForClassifier()), tables,
-                                join_clause, where_clause),
-                              silent=(idx > 10))
-
-            cell_data, image_keys = processData(data)
-            for i in range(cell_data.shape[0]):
-                for j in range(cell_data.shape[1]):
-                    try:
-                        float(cell_data[i,j])
-                    except:
-                        print(i,j, cell_data[i,j], type(cell_data[i,j]))
-            predicted_classes = classifier.Predict(cell_data)
-            for i in range(0, len(predicted_classes)):
-                row_cls = tuple(np.append(image_keys[i][0], predicted_classes[i]))
-                oneCount = np.array([1])
-                if area_score:
-                    oneCount = np.append(oneCount, area_score[i])
-                if row_cls in counts:
-                    counts[row_cls] += oneCount
-                else:
-                    counts[row_cls] = oneCount
 
-            if cb:
-                cb(min(1, idx/float(num_clauses))) #progress
-        return counts
-    print('area scoring column ', p.area_scoring_column)
-    counts = do_by_steps(p.object_table, filter_name, p.area_scoring_column)
-    def get_count(im_key, classnum):
-        return counts.get(im_key + (classnum, ), np.array([0]))[0]
-
-    def get_area(im_key, classnum):
-        return counts.get(im_key + (classnum, ), np.array([0, 0]))[1]
-
-    def get_results():
-        for imkey in dm.GetImageKeysAndObjectCounts(filter_name):
-            if p.area_scoring_column is None:
-                yield list(imkey[0]) + [get_count(imkey[0], cl) for cl in range(1, num_classes+1)]
-            else:
-                yield list(imkey[0]) + [get_count(imkey[0], cl) for cl in range(1, num_classes+1)] + [get_area(imkey[0], cl) for cl in range(1, num_classes+1)]
+def counts_table_name():
+    '''The table IncrementalPerImageCounts keeps the per-image counts in.'''
+    return p.class_counts_table or '%s_counts'%(p.class_table)
+
+def _counts_columns(class_names):
+    '''Returns the names of the count and area columns of the counts table.'''
+    names = [re.sub(r'\W', '_', str(name)) for name in class_names]
+    return ['count_%s'%(name) for name in names], ['area_%s'%(name) for name in names]
+
+def model_fingerprint(classifier, class_names):
+    '''
+    Returns a hex digest identifying a trained model, its classes and the
+    features it is given, so results saved by it can be recognized later.
+    The model is identified by its Fingerprint method or, without one, by
+    pickling the classifier.
+    '''
+    if hasattr(classifier, 'Fingerprint'):
+        model = classifier.Fingerprint()
+    else:
+        model = cPickle.dumps(classifier, 2)
+    return hashlib.md5(cPickle.dumps((model, [str(name) for name in class_names],
+                                      list(db.GetColnamesForClassifier())), 2)).hexdigest()
 
-    return list(get_results())
+def scored_images(fingerprint):
+    '''
+    Returns the set of the keys of the images whose objects are in
+    p.class_table, classified by the model with the given fingerprint, or
+    None if the class table or counts table is missing or was written by
+    another model (or not by IncrementalPerImageCounts).
+    '''
+    table = counts_table_name()
+    if not (p.class_table and db.table_exists(p.class_table) and db.table_exists(table)):
+        return None
+    try:
+        db.execute('SELECT model_fingerprint FROM %s LIMIT 1'%(p.class_table), silent=True)
+    except DBException:
+        return None
+    fingerprints = db.execute('SELECT DISTINCT model_fingerprint FROM %s'%(table))
+    if any([row[0] != fingerprint for row in fingerprints]):
+        return None
+    return set([tuple(row) for row in db.execute('SELECT %s FROM %s'%(UniqueImageClause(), table))])
 
+def IncrementalPerImageCounts(classifier, class_names, filter_name=None, cb=None,
+                              rescore=False, **kwargs):
+    '''
+    Like PerImageCounts with class_names, but only the images that haven't
+    been scored by this model yet are scored: their objects are added to
+    p.class_table (and p.probability_table, if set) and their per-image
+    counts to counts_table_name(), and the counts of the images in the
+    filter are then read from there.  If the tables were written by a
+    different model, or rescore is true, every image is scored again.
+    Other keyword arguments are passed on to score_objects.
+    RETURNS: The rows of PerImageCounts.
+    '''
+    if not p.class_table:
+        raise ValueError('"class_table" in properties file is not set.')
+    fingerprint = model_fingerprint(classifier, class_names)
+    table = counts_table_name()
+    scored = None if rescore else scored_images(fingerprint)
+    if scored is None:
+        logging.info('Scoring every image into %s'%(p.class_table))
+        for name in [p.class_table, p.probability_table, table]:
+            if name:
+                db.execute('DROP TABLE IF EXISTS %s'%(name))
+        db.invalidate_cache()
+        scored = set()
+    new_keys = [imkey for imkey, count in dm.GetImageKeysAndObjectCounts()
+                if tuple(imkey) not in scored]
+    logging.info('Scoring %d images not yet scored by this model'%(len(new_keys)))
+    if new_keys:
+        sinks = (_object_table_sinks(class_names, fingerprint, append=True) +
+                 [ImageCountsTableSink(class_names, fingerprint)])
+        score_objects(classifier, sinks, cb=cb, image_keys=new_keys, **kwargs)
+    elif cb:
+        cb(1.0)
+
+    count_columns, area_columns = _counts_columns(class_names)
+    nkeys = len(image_key_columns())
+    counts = {}
+    for row in db.execute('SELECT %s, %s FROM %s'%(UniqueImageClause(),
+                                                    ', '.join(count_columns + area_columns), table)):
+        counts[tuple(row[:nkeys])] = row[nkeys:]
+    rows = []
+    zeros = [0] * (len(count_columns) + len(area_columns))
+    for imkey, count in dm.GetImageKeysAndObjectCounts(filter_name):
+        values = counts.get(tuple(imkey), zeros)
+        row = list(imkey) + [int(v) for v in values[:len(count_columns)]]
+        if p.area_scoring_column:
+            row += [float(v or 0) for v in values[len(count_columns):]]
+        rows.append(row)
+    return rows
+
+def build_prediction_index(classifier, cb=None, probabilities=True, **kwargs):
+    '''
+    Scores every object and returns a PredictionIndex of the results.
+    cb: callback function to update with the fraction complete.  It may
+        raise an exception (eg: StopCalculating) to cancel.
+    probabilities: whether to keep the probability of each predicted class
+        (needed by PredictionIndex.most_uncertain)
+    Other keyword arguments are passed on to score_objects.
+    '''
+    sink = PredictionIndexSink(probabilities)
+    score_objects(classifier, [sink], cb=cb, **kwargs)
+    return sink.index
 
 if __name__ == "__main__":
     from trainingset import TrainingSet
@@ -1,10 +1,12 @@
 from __future__ import print_function
 import numpy
 import sys
-import cpa.sqltools
 from dbconnect import *
 from properties import Properties
 from datamodel import DataModel
+from fastgentleboostingmulticlass import StumpEvaluator
+import multiclasssql
+import featurestore
 
 db = DBConnect.getInstance()
 p = Properties.getInstance()
@@ -56,32 +58,51 @@ def FilterObjectsFromClassN(clNum, weaklearners, filterKeys):
     weaklearners: Weak learners from fastgentleboostingmulticlass.train
     filterKeys: (optional) A specific list of imKeys OR obKeys (NOT BOTH)
         to classify.
-        * WARNING: If this list is too long, you may exceed the size limit to
-          MySQL queries. 
+        * Long lists are matched through a temporary key table (see
+          dbconnect.KeySet), so there is no limit on their length.
         * Useful when fetching N objects from a particular class. Use the
           DataModel to get batches of random objects, and sift through them
           here until N objects of the desired class have been accumulated.
         * Also useful for classifying a specific image or group of images.
-    RETURNS: A list of object keys that fall in the specified class,
-        if Properties.area_scoring_column is specified, area sums are also
-        reported for each class
+    RETURNS: A list of object keys that fall in the specified class.
+    Only the columns the weak learners use are read (from the feature store
+    if one is set up and current, unless filterKeys is a where clause), and
+    the objects are classified by a StumpEvaluator.
     '''
+    evaluator = StumpEvaluator(weaklearners)
 
-    class_query = translate(weaklearners)
+    store = not isinstance(filterKeys, str) and featurestore.get_feature_store(build=False) or None
+    if store is not None and store.has_columns(evaluator.columns):
+        if filterKeys:
+            object_keys, values = store.object_data(filterKeys, evaluator.columns)
+        else:
+            object_keys, values = store.rows(0, len(store.keys), evaluator.columns)
+        selected = numpy.flatnonzero(evaluator.classify(values) == clNum)
+        return [tuple(key) for key in object_keys[selected].tolist()]
+
+    if isinstance(filterKeys, str):
+        keys = KeySet([])
+    else:
+        keys = KeySet(filterKeys)
 
-    if filterKeys != []:
+    with keys:
         if isinstance(filterKeys, str):
-            whereclause = filterKeys + " AND"
+            whereclause = "WHERE " + filterKeys
+        elif len(keys) > 0:
+            whereclause = "WHERE " + keys.where_clause(p.object_table)
         else:
-            isImKey = len(filterKeys[0]) == len(image_key_columns())
-            if isImKey:
-                whereclause = GetWhereClauseForImages(filterKeys) + " AND"
-            else:
-                whereclause = GetWhereClauseForObjects(filterKeys) + " AND"
-    else:
-        whereclause = ""
-    
-    return db.execute('SELECT '+UniqueObjectClause()+' FROM %s WHERE %s %s=%d '%(p.object_table, whereclause, class_query, clNum))
+            whereclause = ""
+        # NULL features are NaN, which are never above the thresholds
+        key_columns, values = db.execute_columnar(
+            'SELECT %s, %s FROM %s %s'%(UniqueObjectClause(p.object_table),
+                                        ','.join([_objectify(p, col) for col in evaluator.columns]),
+                                        p.object_table, whereclause),
+            feature_start=len(object_key_columns()))
+
+    if len(values) == 0:
+        return []
+    selected = numpy.flatnonzero(evaluator.classify(values) == clNum)
+    return zip(*[col[selected].tolist() for col in key_columns])
 
 
 def object_scores(weaklearners):
@@ -121,6 +142,7 @@ def create_perobject_class_table(classnames, rules):
     case_expr2 = 'CASE %s'%(translate(rules)) + ''.join([" WHEN %d THEN '%s'"%(n+1, n+1) for n in range(nClasses)]) + " END"
     db.execute('INSERT INTO %s (%s) SELECT %s, %s, %s FROM %s'%(p.class_table, class_cols, index_cols, case_expr, case_expr2, p.object_table))
     db.Commit()
+    db.invalidate_cache()
 
 def _objectify(p, field):
     return "%s.%s"%(p.object_table, field)
@@ -157,11 +179,14 @@ def _where_clauses(p, dm, filter_name):
                  %(_objectify(p, p.image_id), lo[0], _objectify(p, p.image_id), hi[0])
                  for lo, hi in zip(key_thresholds[:-1], key_thresholds[1:])])
     
-def PerImageCounts(weaklearners, filter_name=None, cb=None):
+def PerImageCounts(weaklearners, filter_name=None, cb=None, **kwargs):
     '''
     weaklearners: Weak learners from fastgentleboostingmulticlass.train
     filter: name of filter, or None.
     cb: callback function to update with the fraction complete
+    Other keyword arguments are passed on to multiclasssql.score_objects,
+    which reads the objects (only the columns the weak learners use) and
+    classifies them with a StumpEvaluator.
     RETURNS: A list of lists of imKeys and respective object counts for each class:
         Note that the imKeys are exploded so each row is of the form:
         [TableNumber, ImageNumber, Class1_ObjectCount, Class2_ObjectCount,...]
@@ -169,76 +194,22 @@ def PerImageCounts(weaklearners, filter_name=None, cb=None):
         If p.area_scoring_column is set, then area scores will be appended to
         the object scores.
     '''
+    evaluator = StumpEvaluator(weaklearners)
+    # NULL features are NaN, which are never above the thresholds
+    return multiclasssql.PerImageCounts(evaluator, evaluator.num_classes, filter_name, cb,
+                                        feature_columns=evaluator.columns, fill=None,
+                                        **kwargs)
 
-    # I'm pretty sure this would be even faster if we were to run two
-    # or more parallel threads and split the work between them.
-    def do_by_steps(class_query, tables, filter_name, result_clauses):
-        filter_clause = '1 = 1'
-        join_clause = ''
-        if filter_name is not None:
-            filter = p._filters[filter_name]
-            if isinstance(filter, cpa.sqltools.OldFilter):
-                join_table = '(%s) as filter' % str(filter)
-            else:
-                if p.object_table in tables:
-                    join_table = None
-                else:
-                    join_table = p.object_table
-                    filter_clause = str(filter)
-            if join_table:
-                join_clause = 'JOIN %s USING (%s)' % (join_table, ','.join(image_key_columns()))
-        if cb:
-            result =  []
-            wheres = _where_clauses(p, dm, filter_name)
-            num_clauses = len(wheres)
-            
-            for idx, where_clause in enumerate(wheres):
-                if filter_clause is not None:
-                    where_clause += ' AND ' + filter_clause
-                result += [db.execute('SELECT %s, %s as class, %s FROM %s '
-                                      '%s WHERE %s GROUP BY %s, class'
-                                      %(UniqueImageClause(p.object_table), 
-                                        class_query, result_clauses, tables, 
-                                        join_clause, where_clause, 
-                                        UniqueImageClause(p.object_table)),
-                                      silent=(idx > 10))]
-                cb(min(1, idx/float(num_clauses)))
-            return sum(result, [])
-        else:
-            return db.execute('SELECT %s, %s as class, %s FROM %s %s WHERE %s GROUP BY %s, class'%
-                              (imkeys, class_query, result_clauses, tables, join_clause, filter_clause, imkeys))
-    
-    if p.area_scoring_column is None:
-        result_clauses = 'COUNT(*)'
-    else:
-        result_clauses = 'COUNT(*), SUM(%s)'%(_objectify(p, p.area_scoring_column))
-
-    class_query = translate(weaklearners)
-    results = do_by_steps(class_query, p.object_table, filter_name, result_clauses)
-
-    # convert to dictionary
-    counts = {}
-    keylen = 1 + len(image_key_columns()) # includes class
-
-    for r in results:
-        counts[r[:keylen]] = r[keylen:]
-
-    num_classes = len(weaklearners[0][2])
-    # this is clearer than the one-line version
-    def get_count(im_key, classnum):
-        return counts.get(tuple(list(im_key) + [classnum]), [0])[0]
-
-    def get_area(im_key, classnum):
-        return counts.get(tuple(list(im_key) + [classnum]), [0, 0])[1]
-
-    def get_results():
-        for imkey in dm.GetImageKeysAndObjectCounts(filter_name):
-            if p.area_scoring_column is None:
-                yield list(imkey[0]) + [get_count(imkey[0], cl) for cl in range(1, num_classes+1)]
-            else:
-                yield list(imkey[0]) + [get_count(imkey[0], cl) for cl in range(1, num_classes+1)] + [get_area(imkey[0], cl) for cl in range(1, num_classes+1)]
-
-    return list(get_results())
+def BuildPredictionIndex(weaklearners, cb=None, **kwargs):
+    '''
+    Classifies every object with the weak learners and returns a
+    multiclasssql.PredictionIndex of the results, without probabilities.
+    cb: callback function to update with the fraction complete
+    '''
+    evaluator = StumpEvaluator(weaklearners)
+    return multiclasssql.build_prediction_index(evaluator, cb, probabilities=False,
+                                                feature_columns=evaluator.columns, fill=None,
+                                                **kwargs)
 
 
 if __name__ == "__main__":
@@ -42,11 +42,13 @@ def np_load(filename):
         f.close()
     return x
 
-def make_progress_bar(text=None):
+def make_progress_bar(text=None, maxval=None):
     widgets = (['%s: ' % text] if text else []) + [progressbar.Percentage(), ' ', 
                                                    progressbar.Bar(), ' ', 
                                                    progressbar.ETA()]
-    return progressbar.ProgressBar(widgets=widgets)
+    if maxval is None:
+        return progressbar.ProgressBar(widgets=widgets)
+    return progressbar.ProgressBar(widgets=widgets, maxval=maxval)
 
 def invert_dict(d):
     inverted = {}
@@ -220,25 +222,77 @@ class Cache(object):
         cpa.util.pickle(self._plate_map_filename, self._cached_plate_map)
 
     def _create_cache_features(self, resume):
-        nimages = len(self._plate_map)
-        for plate, image_keys in make_progress_bar('Features')(invert_dict(self._plate_map).items()):
+        """
+        Create the per-image feature files.  The object table is read in a
+        single streaming query ordered by image, so memory use is bounded by
+        the largest image rather than by the size of the table.  When
+        resuming, only the images whose files are missing are read (or the
+        whole table, if there are more than INLINE_KEY_LIMIT of them).
+        """
+        for plate, image_keys in invert_dict(self._plate_map).items():
             plate_dir = os.path.dirname(self._image_filename(plate, image_keys[0]))
             if not os.path.exists(plate_dir):
                 os.mkdir(plate_dir)
-            for image_key in image_keys:
-                self._create_cache_image(plate, image_key, resume)
-                
-    def _create_cache_image(self, plate, image_key, resume=False):
-        filename = self._image_filename(plate, image_key)
+
+        where = ''
+        if resume:
+            missing = [image_key for image_key in sorted(self._plate_map)
+                       if not os.path.exists(self._image_filename(
+                               self._plate_map[image_key], image_key))]
+            if len(missing) == 0:
+                return
+            if (len(missing) < len(self._plate_map) and
+                len(missing) <= cpa.dbconnect.INLINE_KEY_LIMIT):
+                where = ' where %s' % cpa.dbconnect.GetWhereClauseForImages(missing)
+
+        nkeys = len(cpa.dbconnect.image_key_columns())
+        nobjects = cpa.db.execute('select count(*) from %s%s' % 
+                                  (cpa.properties.object_table, where))[0][0]
+        progress = make_progress_bar('Features', maxval=max(nobjects, 1))
+        progress.start()
+        query = 'select %s, %s, %s from %s%s order by %s' % (
+            cpa.dbconnect.UniqueImageClause(), cpa.properties.object_id,
+            ','.join(self.colnames), cpa.properties.object_table, where,
+            cpa.dbconnect.UniqueImageClause())
+        written = set()
+        current, cellids, features = None, [], []
+        for keys, matrix in cpa.db.iter_query(
+                query, feature_start=nkeys + 1, nrows=nobjects,
+                cb=lambda frac: progress.update(int(frac * progress.maxval))):
+            image_keys = list(zip(*[col.tolist() for col in keys[:nkeys]]))
+            # split the batch where the image key changes
+            bounds = ([0] + [i for i in range(1, len(image_keys))
+                             if image_keys[i] != image_keys[i - 1]] + 
+                      [len(image_keys)])
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                if image_keys[lo] != current:
+                    self._create_cache_image(current, cellids, features, resume)
+                    written.add(current)
+                    current, cellids, features = image_keys[lo], [], []
+                cellids.append(keys[nkeys][lo:hi])
+                features.append(matrix[lo:hi])
+        self._create_cache_image(current, cellids, features, resume)
+        written.add(current)
+        # images without objects get empty feature files
+        for image_key in self._plate_map:
+            if image_key not in written:
+                self._create_cache_image(image_key, [], [], resume)
+        progress.finish()
+
+    def _create_cache_image(self, image_key, cellids, features, resume=False):
+        """Write the features of one image, given as lists of blocks of rows."""
+        if image_key is None or image_key not in self._plate_map:
+            return
+        filename = self._image_filename(self._plate_map[image_key], image_key)
         if resume and os.path.exists(filename):
             return
-        features = cpa.db.execute("""select %s from %s where %s""" % (
-                ','.join(self.colnames), cpa.properties.object_table, 
-                cpa.dbconnect.GetWhereClauseForImages([image_key])))
-        cellids  = cpa.db.execute("""select %s from %s where %s""" % (
-                cpa.properties.object_id, cpa.properties.object_table, 
-                cpa.dbconnect.GetWhereClauseForImages([image_key])))
-        np.savez(filename, features=np.array(features, dtype=float), cellids=np.squeeze(np.array(cellids)))
+        if len(features) > 0:
+            features = np.vstack(features)
+            cellids = np.concatenate(cellids)
+        else:
+            features = np.zeros((0, len(self.colnames)))
+            cellids = np.zeros(0, dtype=int)
+        np.savez(filename, features=features, cellids=cellids)
 
     def _create_cache_counts(self, resume):
         """
@@ -269,18 +269,75 @@ class CacheTestCase(unittest.TestCase):
                                         (3, 14): 'p1'})
 
     @patch('cpa.profiling.cache.make_progress_bar')
+    @patch.object(cache.Cache, 'colnames')
     @patch.object(cache.Cache, '_plate_map')
-    def test_create_cache_features(self, plate_map, make_progress_bar):
+    @patch('cpa.db.iter_query')
+    @patch('cpa.db.execute')
+    @patch('cpa.dbconnect.UniqueImageClause')
+    @patch('cpa.dbconnect.image_key_columns')
+    def test_create_cache_features(self, image_key_columns, unique_image_clause,
+                                   execute, iter_query, plate_map, colnames,
+                                   make_progress_bar):
         cache_dir = tempfile.mkdtemp()
         c = cache.Cache(cache_dir)
-        plate_map.__get__ = Mock(return_value={(0L, 42L): 'p1', (1L, 23L): 'p2'})
-        make_progress_bar.return_value = lambda x: x
-        c._create_cache_image = Mock()
+        plate_map.__get__ = Mock(return_value={(0L, 42L): 'p1', (1L, 23L): 'p2',
+                                               (1L, 24L): 'p2'})
+        colnames.__get__ = Mock(return_value=['f1', 'f2'])
+        image_key_columns.return_value = ('TableNumber', 'ImageNumber')
+        unique_image_clause.return_value = 'TableNumber,ImageNumber'
+        execute.return_value = [(3,)]
+        # image (1, 23) spans two batches; (1, 24) has no objects
+        iter_query.return_value = iter([
+            ([np.array([0, 1]), np.array([42, 23]), np.array([1, 1])],
+             np.array([[1., 2.], [3., 4.]])),
+            ([np.array([1]), np.array([23]), np.array([2])],
+             np.array([[5., 6.]]))])
         c._create_cache_features(False)
-        calls = c._create_cache_image.call_args_list
-        assert len(calls) == 2
-        assert call('p1', (0L, 42L), False) in calls
-        assert call('p2', (1L, 23L), False) in calls
+        self.assertEqual(iter_query.call_count, 1)
+        raw = np.load(c._image_filename('p1', (0L, 42L)))
+        np.testing.assert_array_equal(raw['features'], [[1., 2.]])
+        np.testing.assert_array_equal(raw['cellids'], [1])
+        raw = np.load(c._image_filename('p2', (1L, 23L)))
+        np.testing.assert_array_equal(raw['features'], [[3., 4.], [5., 6.]])
+        np.testing.assert_array_equal(raw['cellids'], [1, 2])
+        raw = np.load(c._image_filename('p2', (1L, 24L)))
+        self.assertEqual(raw['features'].shape, (0, 2))
+
+    @patch('cpa.profiling.cache.make_progress_bar')
+    @patch.object(cache.Cache, 'colnames')
+    @patch.object(cache.Cache, '_plate_map')
+    @patch('cpa.db.iter_query')
+    @patch('cpa.db.execute')
+    @patch('cpa.dbconnect.GetWhereClauseForImages')
+    @patch('cpa.dbconnect.UniqueImageClause')
+    @patch('cpa.dbconnect.image_key_columns')
+    def test_create_cache_features_resume(self, image_key_columns, unique_image_clause,
+                                          where_clause, execute, iter_query, plate_map,
+                                          colnames, make_progress_bar):
+        import os
+        cache_dir = tempfile.mkdtemp()
+        c = cache.Cache(cache_dir)
+        plate_map.__get__ = Mock(return_value={(0L, 42L): 'p1', (1L, 23L): 'p2'})
+        colnames.__get__ = Mock(return_value=['f1', 'f2'])
+        image_key_columns.return_value = ('TableNumber', 'ImageNumber')
+        unique_image_clause.return_value = 'TableNumber,ImageNumber'
+        where_clause.return_value = 'ImageNumber IN (23)'
+        execute.return_value = [(1,)]
+        os.mkdir(os.path.join(cache_dir, 'p1'))
+        np.savez(c._image_filename('p1', (0L, 42L)), features=np.zeros((0, 2)),
+                 cellids=np.zeros(0, dtype=int))
+        # only the image whose file is missing is read
+        iter_query.return_value = iter([
+            ([np.array([1]), np.array([23]), np.array([1])], np.array([[3., 4.]]))])
+        c._create_cache_features(True)
+        where_clause.assert_called_once_with([(1L, 23L)])
+        self.assertTrue('where ImageNumber IN (23) order by' in iter_query.call_args[0][0])
+        raw = np.load(c._image_filename('p2', (1L, 23L)))
+        np.testing.assert_array_equal(raw['features'], [[3., 4.]])
+        # nothing is read once every image has its file
+        iter_query.reset_mock()
+        c._create_cache_features(True)
+        self.assertEqual(iter_query.call_count, 0)
 
     # TODO: test_create_image
 
@@ -30,6 +30,12 @@ string_vars = ['db_type',
                'db_name', 
                'db_user', 
                'db_passwd',
+               'db_pool_size',
+               'db_import_workers',
+               'db_cache_size',
+               'object_index_dir',
+               'feature_store_dir',
+               'cell_cache_dir',
                'image_table', 
                'object_table',
                'image_csv_file', 
@@ -48,6 +54,8 @@ string_vars = ['db_type',
                'area_scoring_column',
                'training_set',
                'class_table',
+               'probability_table',
+               'class_counts_table',
                'plate_type',
                'check_tables',
                'db_sql_file',
@@ -85,6 +93,12 @@ optional_vars = ['db_port',
                  'db_name', 
                  'db_user', 
                  'db_passwd',
+                 'db_pool_size',
+                 'db_import_workers',
+                 'db_cache_size',
+                 'object_index_dir',
+                 'feature_store_dir',
+                 'cell_cache_dir',
                  'table_id', 
                  'image_url_prepend', 
                  'image_csv_file',
@@ -96,6 +110,8 @@ optional_vars = ['db_port',
                  'area_scoring_column', 
                  'training_set',
                  'class_table',
+                 'probability_table',
+                 'class_counts_table',
                  'image_buffer_size', 
                  'tile_buffer_size',
                  'plate_id', 
@@ -620,6 +636,15 @@ class Properties(Singleton):
             assert self.class_table != self.image_table, 'PROPERTIES ERROR (class_table): class_table cannot be the same as image_table!'
             assert self.class_table != self.object_table, 'PROPERTIES ERROR (class_table): class_table cannot be the same as object_table!'
             logging.info('PROPERTIES: Per-Object classes will be written to table "%s"'%(self.class_table))
+
+        if self.field_defined('probability_table'):
+            assert self.probability_table != self.image_table, 'PROPERTIES ERROR (probability_table): probability_table cannot be the same as image_table!'
+            assert self.probability_table != self.object_table, 'PROPERTIES ERROR (probability_table): probability_table cannot be the same as object_table!'
+            assert self.probability_table != self.class_table, 'PROPERTIES ERROR (probability_table): probability_table cannot be the same as class_table!'
+            logging.info('PROPERTIES: Per-Object class probabilities will be written to table "%s"'%(self.probability_table))
+
+        if self.field_defined('class_counts_table'):
+            assert self.class_counts_table not in (self.image_table, self.object_table, self.class_table), 'PROPERTIES ERROR (class_counts_table): class_counts_table cannot be the same as image_table, object_table or class_table!'
             
         if not self.field_defined('plate_id'):
             logging.warn('PROPERTIES WARNING (plate_id): Field is required for plate map viewer.')
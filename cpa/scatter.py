@@ -301,7 +301,7 @@ class ScatterControlPanel(wx.Panel):
             q.add_filter(self.filter)
         q.add_where(sql.Expression(self.x_column, 'IS NOT NULL'))
         q.add_where(sql.Expression(self.y_column, 'IS NOT NULL'))
-        return db.execute(str(q))
+        return db.execute_cached(str(q))
     
     def get_selected_column_types(self):
         ''' Returns a tuple containing the x and y column types. '''
@@ -27,7 +27,8 @@ python scoreall.py <propertiesfile> <trainingset>
 '''
 
 def score(properties, ts, nRules, filter_name=None, group='Image',
-          show_results=False, results_table=None, overwrite=False):
+          show_results=False, results_table=None, overwrite=False,
+          incremental=False):
     '''
     Trains a Classifier on a training set and scores the experiment
     returns the table of scores as a numpy array.
@@ -39,6 +40,10 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
     group         -- name of a group to use from the properties file
     show_results  -- whether or not to show the results in TableViewer
     results_table -- table name to save results to or None.
+    incremental   -- whether to also write the per-object classes to
+                     p.class_table, scoring only the images that this model
+                     hasn't scored yet (see
+                     multiclasssql.IncrementalPerImageCounts)
     '''
     
     p = properties
@@ -62,6 +67,7 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
     print('show results:  ', show_results)
     print('results table: ', results_table)
     print('overwrite:     ', overwrite)
+    print('incremental:   ', incremental)
     print('')
             
     nClasses = len(ts.labels)
@@ -83,7 +89,16 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
     t0 = time()
     def update(frac): 
         logging.info('%d%% '%(frac*100.,))
-    keysAndCounts = multiclasssql.PerImageCounts(weaklearners, filter_name=(filter_name or None), cb=update)
+    evaluator = fastgentleboostingmulticlass.StumpEvaluator(weaklearners)
+    # only the columns the rules use are read, with NULLs never above a threshold
+    if incremental:
+        keysAndCounts = multiclasssql.IncrementalPerImageCounts(
+            evaluator, ts.labels, filter_name or None, update,
+            feature_columns=evaluator.columns, fill=None)
+    else:
+        keysAndCounts = multiclasssql.PerImageCounts(
+            evaluator, nClasses, filter_name or None, update,
+            feature_columns=evaluator.columns, fill=None)
     keysAndCounts.sort()
     logging.info('Counts found in %f seconds'%(time()-t0))
         
@@ -228,6 +243,8 @@ if __name__ == "__main__":
         
     results_table = raw_input('Results table name (return for none): ')
 
+    incremental = raw_input('Save classes, scoring only new images? (y/N): ').lower().startswith('y')
+
     logging.info('Loading properties file...')
     p = Properties.getInstance()
     p.LoadFile(props_file)
@@ -236,7 +253,7 @@ if __name__ == "__main__":
     ts.Load(ts_file)
 
     score(p, ts, nRules, filter_name, group, show_results=True,
-          results_table=results_table, overwrite=False)
+          results_table=results_table, overwrite=False, incremental=incremental)
     
     app.MainLoop()
     
@@ -0,0 +1,270 @@
+'''
+Bulk import of CSV files into SQLite tables.
+
+The CSV files are cut into blocks of whole records which are parsed and
+converted to the column types of their target table by a pool of worker
+processes.  Meanwhile the calling thread inserts the parsed blocks, in file
+order, with import-time pragmas set on its connection.  Indexes are left to
+the caller so they can be built once the data is loaded.
+'''
+from __future__ import print_function
+import csv
+import logging
+import os
+import re
+import time
+from collections import deque
+from cStringIO import StringIO
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = 4 * 1024 * 1024      # size of the blocks handed to the workers
+IMPORT_CACHE_KB = 256 * 1024       # page cache used while importing
+
+# Pragmas set on the connection for the duration of the import: the
+# database is deleted if the import fails (see
+# DBConnect._remove_failed_sqlite_db), so there is nothing to protect.
+IMPORT_PRAGMAS = [('journal_mode', 'OFF'),
+                  ('synchronous', 'OFF'),
+                  ('cache_size', '-%d'%(IMPORT_CACHE_KB)),
+                  ('temp_store', 'MEMORY'),
+                  ('locking_mode', 'EXCLUSIVE')]
+
+
+def default_num_workers():
+    '''
+    Number of parsing processes to use: one per CPU but one, which is left
+    for the writer.  On a single CPU the CSVs are parsed by the writer.
+    '''
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count() - 1
+    except (ImportError, NotImplementedError):
+        return 0
+
+
+def column_kind(sqltype):
+    '''
+    Returns 'int', 'float' or None (keep the value as text) for an SQL column
+    type, following SQLite's type affinity rules.  'int' values that aren't
+    integers fall back to floats, like NUMERIC affinity.
+    '''
+    t = (sqltype or '').upper()
+    if 'INT' in t:
+        return 'int'
+    if 'CHAR' in t or 'CLOB' in t or 'TEXT' in t or 'BLOB' in t or t == '':
+        return None
+    if 'REAL' in t or 'FLOA' in t or 'DOUB' in t:
+        return 'float'
+    return 'int'
+
+
+def _to_float(value):
+    try:
+        x = float(value)
+    except ValueError:
+        return value
+    if x != x:
+        # SQLite would store NaN as NULL; keep the text as it always has
+        return value
+    return x
+
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return _to_float(value)
+
+_CONVERTERS = {'int' : _to_int, 'float' : _to_float}
+
+
+def parse_chunk(args):
+    '''
+    Parses a block of CSV text into a list of row tuples, converting each
+    value to the kind of its column (see column_kind).  Values that can't
+    be converted are left as text, just as SQLite would store them.
+    args -- (text, kinds) tuple so this can be used with Pool.map
+    '''
+    text, kinds = args
+    convert = [_CONVERTERS.get(kind) for kind in kinds]
+    rows = []
+    for row in csv.reader(StringIO(text)):
+        if len(row) == 0:
+            continue
+        rows.append(tuple([(c(v) if c is not None else v)
+                           for c, v in zip(convert, row)] + row[len(convert):]))
+    return rows
+
+
+def read_chunks(f, chunk_bytes=CHUNK_BYTES):
+    '''
+    Reads an open CSV file in blocks of roughly chunk_bytes, each ending on
+    a record boundary (quoted fields spanning lines are kept whole).
+    Yields (text, position) where position is the file offset after the
+    block.
+    '''
+    while True:
+        text = f.read(chunk_bytes)
+        if not text:
+            break
+        text += f.readline()
+        # an odd number of quotes means we stopped inside a quoted field
+        while text.count('"') % 2:
+            line = f.readline()
+            if not line:
+                break
+            text += line
+        yield text, f.tell()
+
+
+class _Parsed(object):
+    '''Stands in for an AsyncResult when parsing in this process.'''
+    def __init__(self, rows):
+        self.rows = rows
+    def get(self):
+        return self.rows
+
+
+class SQLiteImporter(object):
+    '''
+    Loads CSV files into existing SQLite tables.
+
+    conn -- sqlite3 connection to load into
+    n_workers -- number of parsing processes (default: default_num_workers).
+        With 0 the CSVs are parsed in this process.
+    cb -- callback function called with the fraction of bytes loaded after
+        each block is inserted.  It may raise an exception to cancel.
+    '''
+    def __init__(self, conn, n_workers=None, cb=None, chunk_bytes=CHUNK_BYTES):
+        self.conn = conn
+        self.n_workers = default_num_workers() if n_workers is None else n_workers
+        self.cb = cb
+        self.chunk_bytes = chunk_bytes
+        self.total_bytes = 0
+        self.bytes_done = 0
+        self.rows_done = 0
+        self.pct_logged = 0
+        self.start_time = None
+
+    def table_columns(self, table):
+        '''Returns [(name, type), ...] for the columns of a table.'''
+        return [(row[1], row[2]) for row in
+                self.conn.execute('PRAGMA table_info(%s)'%(table)).fetchall()]
+
+    def load(self, jobs):
+        '''
+        jobs -- list of (table, filename, skip_header) tuples, loaded in order.
+        Returns the number of rows inserted.
+        '''
+        self.total_bytes = float(sum([os.path.getsize(filename)
+                                      for table, filename, skip in jobs]) or 1)
+        self.bytes_done = 0
+        self.rows_done = 0
+        self.pct_logged = 0
+        self.start_time = time.time()
+        self.conn.commit()
+        saved = self._set_pragmas(IMPORT_PRAGMAS)
+        pool = self._make_pool()
+        try:
+            self._pipeline(pool, jobs)
+            self.conn.commit()
+        except:
+            if pool is not None:
+                pool.terminate()
+            # Without a journal the partial data stays, but the caller
+            # deletes the database anyway.
+            self.conn.rollback()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            self._set_pragmas(saved)
+            # Accessing the database releases the exclusive lock
+            self.conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchall()
+        logger.info('Loaded %d rows in %.1f seconds'%(self.rows_done, time.time() - self.start_time))
+        return self.rows_done
+
+    def _pipeline(self, pool, jobs):
+        # Keep a few blocks parsing ahead of the writer, but no more, so
+        # memory use doesn't depend on the size of the files.
+        max_pending = 2 * max(self.n_workers, 1)
+        pending = deque()
+        for table, filename, skip_header in jobs:
+            columns = self.table_columns(table)
+            kinds = [column_kind(coltype) for name, coltype in columns]
+            insert = 'INSERT INTO %s VALUES (%s)'%(table, ','.join(['?'] * len(columns)))
+            logger.info('Populating %s with data from %s'%(table, filename))
+            f = open(filename, 'rU')
+            try:
+                if skip_header:
+                    f.readline()
+                position = 0
+                for text, end in read_chunks(f, self.chunk_bytes):
+                    if pool is None:
+                        result = _Parsed(parse_chunk((text, kinds)))
+                    else:
+                        result = pool.apply_async(parse_chunk, ((text, kinds),))
+                    pending.append((insert, result, end - position))
+                    position = end
+                    if len(pending) >= max_pending:
+                        self._write(*pending.popleft())
+            finally:
+                f.close()
+        while pending:
+            self._write(*pending.popleft())
+
+    def _write(self, insert, result, nbytes):
+        rows = result.get()
+        if rows:
+            self.conn.executemany(insert, rows)
+        self.rows_done += len(rows)
+        self.bytes_done += nbytes
+        fraction = min(1.0, self.bytes_done / self.total_bytes)
+        if int(100 * fraction) > self.pct_logged:
+            self.pct_logged = int(100 * fraction)
+            elapsed = time.time() - self.start_time
+            logger.info('... loaded %d%% of CSV data (about %d s remaining)'%(
+                self.pct_logged, elapsed * (1 - fraction) / fraction))
+        if self.cb:
+            self.cb(fraction)
+
+    def _make_pool(self):
+        if self.n_workers <= 0:
+            return None
+        try:
+            from multiprocessing import Pool
+            return Pool(self.n_workers)
+        except Exception as e:
+            logger.warning('Could not start CSV parsing processes, parsing in '
+                           'this process instead: %s'%(e))
+            return None
+
+    def _set_pragmas(self, pragmas):
+        '''Sets pragmas and returns their previous values.'''
+        saved = []
+        for name, value in pragmas:
+            old = self.conn.execute('PRAGMA %s'%(name)).fetchone()
+            if old is not None:
+                saved.append((name, old[0]))
+            self.conn.execute('PRAGMA %s = %s'%(name, value)).fetchall()
+        return saved
+
+
+def defer_primary_key(create_stmt):
+    '''
+    Removes the PRIMARY KEY table constraint from a CREATE TABLE statement
+    so the table can be loaded without maintaining the index.
+    Returns (statement, index_statement) where index_statement builds an
+    equivalent unique index once the table is loaded, or is None if the
+    statement has no such constraint.
+    '''
+    m_table = re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[`"]?(\w+)[`"]?',
+                        create_stmt, re.I)
+    m_key = re.search(r',\s*PRIMARY\s+KEY\s*\(([^)]*)\)', create_stmt, re.I)
+    if m_table is None or m_key is None:
+        return create_stmt, None
+    table = m_table.group(1)
+    stmt = create_stmt[:m_key.start()] + create_stmt[m_key.end():]
+    index = 'CREATE UNIQUE INDEX IF NOT EXISTS pk_%s ON %s (%s)'%(table, table, m_key.group(1).strip())
+    return stmt, index
@@ -0,0 +1,254 @@
+'''
+Block-cached, keyset-paginated access to the rows of a database table in a
+given order, for showing big tables a screenful at a time.
+
+Rows are read in blocks of BLOCK_SIZE.  Instead of skipping rows with
+LIMIT offset,n (which reads and discards all the skipped rows), a block is
+read by seeking past the sort values of a row whose position is already
+known -- the last row of the block before it, the first row of the block
+after it, or either end of the table -- so reading any block near one that
+was read before, or near either end, costs the same.  The blocks on either
+side of the last block read are fetched by a background thread, and the
+least recently used blocks are dropped once there are more than MAX_BLOCKS.
+'''
+from __future__ import print_function
+import bisect
+import collections
+import logging
+import re
+import threading
+import dbconnect
+from properties import Properties
+
+p = Properties.getInstance()
+db = dbconnect.DBConnect.getInstance()
+
+BLOCK_SIZE = 100    # rows read per query
+MAX_BLOCKS = 200    # blocks kept in memory
+
+
+def sql_literal(value):
+    '''Returns value as an SQL literal.'''
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    value = str(value).replace("'", "''")
+    if p.db_type and p.db_type.lower() == 'mysql':
+        value = value.replace('\\', '\\\\')
+    return "'%s'"%(value)
+
+def seek_clause(columns, values, direction):
+    '''
+    Returns an SQL condition matching the rows that come after a row with
+    the given values when sorting by columns in direction ('ASC' or 'DESC').
+    NULLs sort first in ascending order (as in MySQL and SQLite), so they
+    come after every value in descending order.  values may not be NULL.
+    '''
+    op = (direction == 'ASC') and '>' or '<'
+    terms = []
+    for i, (col, value) in enumerate(zip(columns, values)):
+        after = '%s %s %s'%(col, op, sql_literal(value))
+        if direction != 'ASC':
+            after = '(%s OR %s IS NULL)'%(after, col)
+        equal = ['%s = %s'%(c, sql_literal(v)) for c, v in zip(columns[:i], values[:i])]
+        terms += ['(%s)'%(' AND '.join(equal + [after]))]
+    return '(%s)'%(' OR '.join(terms))
+
+
+class TablePager(object):
+    '''
+    Reads the rows of a table in order, a block at a time.
+
+    table -- the table to read
+    columns -- the columns to return for each row
+    order_by -- the columns to sort by
+    direction -- 'ASC' or 'DESC'
+    where -- condition restricting the rows (with or without "WHERE")
+    key_columns -- columns that together identify a row uniquely.  They are
+        used to break ties in the sort order, which seeking needs.  Without
+        them blocks are read with LIMIT offset,n.
+    row_count -- the number of rows, if already known
+    prefetch -- whether to read the neighbouring blocks in the background
+    '''
+    def __init__(self, table, columns, order_by, direction='ASC', where='',
+                 key_columns=None, row_count=None, block_size=BLOCK_SIZE,
+                 max_blocks=MAX_BLOCKS, prefetch=True):
+        self.table = table
+        self.columns = list(columns)
+        self.direction = direction
+        self.where = re.sub(r'^\s*WHERE\s', '', where or '', flags=re.I).strip()
+        self.sort_columns = list(order_by) + [col for col in (key_columns or [])
+                                              if col not in order_by]
+        self.seekable = key_columns is not None
+        # MySQL FLOAT columns hold single precision values, which don't
+        # compare equal to the double read back, so rows with float sort
+        # values can't be sought past there.  Those blocks use OFFSET.
+        self.float_anchors = not (p.db_type and p.db_type.lower() == 'mysql')
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.row_count = row_count
+        self.blocks = collections.OrderedDict()   # {block index : rows}
+        self.anchors = {}       # {row index : sort values of that row}
+        self.anchor_rows = []   # sorted row indices of self.anchors
+        self.lock = threading.RLock()
+        self.prefetcher = prefetch and _Prefetcher(self) or None
+
+    def close(self):
+        '''Stops prefetching.  The pager must not be used afterwards.'''
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+    def get_row_count(self):
+        if self.row_count is None:
+            where = self.where and ' WHERE %s'%(self.where) or ''
+            self.row_count = int(db.execute('SELECT COUNT(*) FROM %s%s'%(self.table, where))[0][0])
+        return self.row_count
+
+    def get_row(self, row):
+        '''Returns the values of the columns in the given row.'''
+        return self._get_row(row)[:len(self.columns)]
+
+    def get_values(self, row, columns):
+        '''Returns the values of the given columns (from columns or the sort columns) in a row.'''
+        values = self._get_row(row)
+        names = self.columns + self.sort_columns
+        return tuple([values[names.index(col)] for col in columns])
+
+    def _get_row(self, row):
+        if not 0 <= row < self.get_row_count():
+            raise IndexError('Row %s is out of range'%(row))
+        b = row // self.block_size
+        return self.get_block(b)[row - b * self.block_size]
+
+    def get_block(self, b):
+        '''Returns the rows of block b, reading it if necessary.'''
+        rows = self._load_block(b)
+        if self.prefetcher is not None:
+            self.prefetcher.request([b + 1, b - 1])
+        return rows
+
+    def cached(self, b):
+        with self.lock:
+            return b in self.blocks
+
+    def _load_block(self, b):
+        with self.lock:
+            if b in self.blocks:
+                rows = self.blocks.pop(b)
+                self.blocks[b] = rows   # most recently used go last
+                return rows
+        lo = b * self.block_size
+        hi = min(lo + self.block_size, self.get_row_count())
+        rows = self._read(lo, hi)
+        with self.lock:
+            self.blocks[b] = rows
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+            if rows:
+                self._add_anchor(lo, rows[0])
+                self._add_anchor(hi - 1, rows[-1])
+        return rows
+
+    def _add_anchor(self, row, values):
+        sort_values = tuple(values[len(self.columns):])
+        if not self.seekable or None in sort_values or row in self.anchors:
+            return
+        if not self.float_anchors and any([isinstance(v, float) for v in sort_values]):
+            return
+        self.anchors[row] = sort_values
+        bisect.insort(self.anchor_rows, row)
+
+    def _plan(self, lo, hi):
+        '''
+        Returns (skip, anchor, reverse) for reading rows lo..hi-1 with the
+        fewest skipped rows: start after the anchor row (or at the start of
+        the table if anchor is None) and skip rows, either forwards or, if
+        reverse is true, backwards from the anchor row (or the end).
+        '''
+        if not self.seekable:
+            # without a unique order, reading backwards may not give the same rows
+            return lo, None, False
+        plans = [(lo, None, False), (self.get_row_count() - hi, None, True)]
+        with self.lock:
+            i = bisect.bisect_left(self.anchor_rows, lo)
+            if i > 0:
+                a = self.anchor_rows[i - 1]
+                plans += [(lo - a - 1, a, False)]
+            j = bisect.bisect_left(self.anchor_rows, hi)
+            if j < len(self.anchor_rows):
+                a = self.anchor_rows[j]
+                plans += [(a - hi, a, True)]
+        return min(plans, key=lambda plan: plan[0])
+
+    def _read(self, lo, hi):
+        if hi <= lo:
+            return []
+        skip, anchor, reverse = self._plan(lo, hi)
+        direction = self.direction
+        if reverse:
+            direction = (direction == 'ASC') and 'DESC' or 'ASC'
+        conditions = self.where and ['(%s)'%(self.where)] or []
+        if anchor is not None:
+            conditions += [seek_clause(self.sort_columns, self.anchors[anchor], direction)]
+        query = 'SELECT %s FROM %s%s ORDER BY %s LIMIT %d OFFSET %d'%(
+            ','.join(self.columns + self.sort_columns), self.table,
+            conditions and ' WHERE ' + ' AND '.join(conditions) or '',
+            ','.join(['%s %s'%(col, direction) for col in self.sort_columns]),
+            hi - lo, skip)
+        rows = db.execute(query, silent=True)
+        if reverse:
+            rows.reverse()
+        return rows
+
+
+class _Prefetcher(object):
+    '''
+    Reads blocks requested by a TablePager in a background thread, which
+    runs while there are blocks to read.
+    '''
+    def __init__(self, pager):
+        self.pager = pager
+        self.pending = collections.deque()
+        self.cv = threading.Condition()
+        self.running = False
+        self.stopped = False
+
+    def request(self, blocks):
+        nblocks = (self.pager.get_row_count() + self.pager.block_size - 1) // self.pager.block_size
+        with self.cv:
+            if self.stopped:
+                return
+            for b in blocks:
+                if 0 <= b < nblocks and b not in self.pending and not self.pager.cached(b):
+                    self.pending.append(b)
+            if self.pending and not self.running:
+                self.running = True
+                thread = threading.Thread(target=self.run)
+                thread.setName('TablePager_%s'%(thread.getName()))
+                thread.setDaemon(True)
+                thread.start()
+
+    def stop(self):
+        with self.cv:
+            self.stopped = True
+            self.pending.clear()
+
+    def run(self):
+        try:
+            while True:
+                with self.cv:
+                    if not self.pending:
+                        self.running = False
+                        return
+                    b = self.pending.popleft()
+                try:
+                    self.pager._load_block(b)
+                except Exception as e:
+                    logging.debug('Failed to prefetch table rows: %s'%(e))
+        finally:
+            # return the thread's connection to the pool
+            db.ReleaseConnection()
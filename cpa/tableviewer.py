@@ -21,6 +21,7 @@ import cpa.helpmenu
 from properties import Properties
 import dbconnect
 from datamodel import DataModel
+from tablepager import TablePager
 import imagetools
 
 p = Properties.getInstance()
@@ -333,8 +334,9 @@ class DBTable(TableData):
     '''
     def __init__(self, table_name, rmin=None, rmax=None):
         self.grouping = None
-        self.set_table(table_name)
+        self.pager = None
         self.filter = '' #'WHERE Image_Intensity_Actin_Total_intensity > 17000'
+        self.set_table(table_name)
         self.set_row_interval(rmin, rmax)
         #XXX: should filter be defined at a higher level? Just UI?
         TableData.__init__(self)
@@ -347,7 +349,8 @@ class DBTable(TableData):
         else:
             self.grouping = None
         self.table_name = table_name
-        self.cache = odict()
+        self.row_counts = {}     # number of rows keyed by filter
+        self.reset_pager()
         self.col_labels = np.array(db.GetColumnNames(self.table_name))
         self.shown_columns = np.arange(len(self.col_labels))
         self.order_by = [self.col_labels[0]]
@@ -357,6 +360,29 @@ class DBTable(TableData):
             self.key_indices = [self.col_labels.tolist().index(v) for v in dbconnect.image_key_columns()]
         if self.table_name == p.object_table:
             self.key_indices = [self.col_labels.tolist().index(v) for v in dbconnect.object_key_columns()]
+
+    def reset_pager(self):
+        '''Drops the cached rows, eg: after the columns or sort order changed.'''
+        if self.pager is not None:
+            self.pager.close()
+        self.pager = None
+
+    def get_pager(self):
+        '''Returns the TablePager reading rows with the current settings.'''
+        if self.pager is None:
+            key_cols = None
+            if self.key_indices is not None:
+                key_cols = self.col_labels[self.key_indices].tolist()
+            self.pager = TablePager(self.table_name, 
+                                    self.col_labels[self.shown_columns].tolist(),
+                                    self.order_by, self.order_direction, 
+                                    where=self.filter, key_columns=key_cols,
+                                    row_count=self.get_total_number_of_rows())
+        return self.pager
+
+    def set_filter(self, filter):
+        TableData.set_filter(self, filter)
+        self.reset_pager()
             
     def set_shown_columns(self, col_indices):
         '''sets which column should be shown from the db table
@@ -365,7 +391,7 @@ class DBTable(TableData):
                        hidden)
         '''
         self.shown_columns = col_indices
-        self.cache.clear()
+        self.reset_pager()
     
     def set_sort_col(self, col_index, add=False):
         col = self.col_labels[col_index]
@@ -384,10 +410,9 @@ class DBTable(TableData):
                     self.order_direction = 'ASC'
             else:
                 self.order_by = [col]
-        self.cache.clear()
+        self.reset_pager()
     
     def set_row_interval(self, rmin, rmax):
-        self.cache.clear()
         if rmin == None: 
             rmin = 0
         if rmax == None: 
@@ -403,12 +428,8 @@ class DBTable(TableData):
     def get_row_key(self, row):
         if self.key_indices is None:
             return None
-        cols = ','.join(self.col_labels[self.key_indices])
-        key = db.execute('SELECT %s FROM %s %s ORDER BY %s LIMIT %s,%s'%
-                          (cols, self.table_name, self.filter, 
-                           ','.join([c+' '+self.order_direction for c in self.order_by]),
-                           row, 1))[0]
-        return key
+        return self.get_pager().get_values(row + self.rmin, 
+                                           self.col_labels[self.key_indices].tolist())
     
     def get_image_keys_at_row(self, row):
         # XXX: needs to be updated to work for per_well data
@@ -464,7 +485,10 @@ class DBTable(TableData):
     def get_total_number_of_rows(self):
         '''Returns the total number of rows in the database
         '''
-        return int(db.execute('SELECT COUNT(*) FROM %s %s' % (self.table_name, self.filter))[0][0])
+        # wx asks for the number of rows on every repaint, so remember it
+        if self.filter not in self.row_counts:
+            self.row_counts[self.filter] = int(db.execute('SELECT COUNT(*) FROM %s %s' % (self.table_name, self.filter))[0][0])
+        return self.row_counts[self.filter]
     
     def GetNumberRows(self):
         '''Returns the number of rows on the current page (between rmin,rmax)
@@ -507,22 +531,7 @@ class DBTable(TableData):
             return None
 
     def GetValue(self, row, col):
-        row += self.rmin
-        if not row in self.cache:
-            lo = max(row - 25, 0)
-            hi = row + 25
-            cols = ','.join(self.col_labels[self.shown_columns])
-            vals = db.execute('SELECT %s FROM %s %s ORDER BY %s LIMIT %s,%s'%
-                              (cols, self.table_name, self.filter, 
-                               ','.join([c+' '+self.order_direction for c in self.order_by]),
-                               lo, hi-lo), 
-                              silent=False)
-            self.cache.update((lo+i, v) for i,v in enumerate(vals))
-            # if cache exceeds 1000 entries, clip to last 500
-            if len(self.cache) > 5000:
-                for key in self.cache.keys()[:-500]:
-                    del self.cache[key]
-        return self.cache[row][col]
+        return self.get_pager().get_row(row + self.rmin)[col]
 
     def SetValue(self, row, col, value):
         print('SetValue(%d, %d, "%s") ignored.\n' % (row, col, value))
@@ -0,0 +1,79 @@
+import os
+import numpy as np
+from unittest import TestCase
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.model_selection import StratifiedKFold
+from cpa.crossvalidation import run_folds, FoldPool, fit_and_predict, fit_and_score, learning_curve
+
+
+def square(data, fold):
+    return data * fold * fold
+
+def square_and_pid(data, fold):
+    return square(data, fold), os.getpid()
+
+
+class RunFoldsTestCase(TestCase):
+    def test_in_process(self):
+        fractions = []
+        results = dict(run_folds(square, 2, [1, 2, 3], cb=fractions.append))
+        self.assertEqual(results, {0: 2, 1: 8, 2: 18})
+        self.assertEqual(fractions, [1 / 3., 2 / 3., 1.0])
+
+    def test_processes(self):
+        results = dict(run_folds(square, 2, range(10), n_jobs=2))
+        self.assertEqual(results, dict([(i, 2 * i * i) for i in range(10)]))
+
+    def test_cancel(self):
+        class Cancel(Exception):
+            pass
+        def cb(fraction):
+            if fraction >= 0.5:
+                raise Cancel()
+        done = []
+        def run():
+            for i, result in run_folds(square, 1, range(10), n_jobs=2, cb=cb):
+                done.append(i)
+        self.assertRaises(Cancel, run)
+        self.assertEqual(len(done), 5)
+
+    def test_pool(self):
+        # the same processes evaluate the folds of every run
+        pids = set()
+        with FoldPool(square_and_pid, 2, 2) as pool:
+            for run in range(3):
+                results = dict(run_folds(square_and_pid, 2, range(10), pool=pool))
+                self.assertEqual(dict([(i, r[0]) for i, r in results.items()]),
+                                 dict([(i, 2 * i * i) for i in range(10)]))
+                pids.update([r[1] for r in results.values()])
+        self.assertTrue(0 < len(pids) <= 2)
+        self.assertTrue(os.getpid() not in pids)
+        self.assertEqual(pool.pool, None)
+
+
+class EvaluationTestCase(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.labels = np.repeat([1, 2], 30)
+        self.values = rng.randn(60, 3) + self.labels[:, np.newaxis]
+        self.estimator = LinearDiscriminantAnalysis()
+        self.splits = list(StratifiedKFold(n_splits=3).split(self.values, self.labels))
+
+    def test_folds(self):
+        data = (self.estimator, self.values, self.labels, None)
+        for train, test in self.splits:
+            fitted = LinearDiscriminantAnalysis().fit(self.values[train], self.labels[train])
+            np.testing.assert_array_equal(fit_and_predict(data, (train, test)),
+                                          fitted.predict(self.values[test]))
+            self.assertEqual(fit_and_score(data, (train, test)),
+                             fitted.score(self.values[test], self.labels[test]))
+
+    def test_learning_curve(self):
+        sizes, train_scores, test_scores = learning_curve(
+            self.estimator, self.values, self.labels, StratifiedKFold(n_splits=3),
+            [0.5, 1.0], n_jobs=2)
+        np.testing.assert_array_equal(sizes, [20, 40])
+        self.assertEqual(train_scores.shape, (2, 3))
+        train, test = self.splits[1]
+        data = (self.estimator, self.values, self.labels, None)
+        self.assertEqual(test_scores[1, 1], fit_and_score(data, (train, test)))
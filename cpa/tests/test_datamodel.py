@@ -78,3 +78,141 @@ class GetWellPositionFromName(unittest.TestCase):
 
     def test_reverse_absent(self):
         self.assertRaises(KeyError, lambda: self.dm.get_well_name_from_position((1, 0)))
+
+
+class ObjectIDIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = cpa.datamodel.p
+        self.p.image_id = 'ImageNumber'
+        self.p.table_id = None
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.p.db_type = 'mysql'
+
+    def build(self, db, modify_date='d1'):
+        db.get_objects_modify_date.return_value = modify_date
+        # image 2 spans two batches
+        db.iter_query.return_value = iter([[(1, 2), (1, 5), (2, 1)],
+                                           [(2, 4), (4, 3)]])
+        index = cpa.datamodel.ObjectIDIndex()
+        index.build()
+        return index
+
+    @patch('cpa.datamodel.db')
+    def test_build(self, db):
+        index = self.build(db)
+        self.assertEqual(index.spans, {(1,): (0, 2), (2,): (2, 2), (4,): (4, 1)})
+        self.assertEqual(index.get_object_ids((2,)).tolist(), [1, 4])
+        self.assertEqual(index.get_object_ids((3,)).tolist(), [])
+        self.assertEqual(index.get_object_key((1,), 2), (1, 5))
+        self.assertRaises(IndexError, index.get_object_key, (4,), 2)
+
+    @patch('cpa.datamodel.db')
+    def test_is_current(self, db):
+        index = self.build(db)
+        index.last_checked = 0
+        self.assertTrue(index.is_current())
+        db.get_objects_modify_date.return_value = 'd2'
+        index.last_checked = 0
+        self.assertFalse(index.is_current())
+
+    @patch('cpa.datamodel.db')
+    def test_save_load(self, db):
+        import os
+        import tempfile
+        index = self.build(db)
+        filename = os.path.join(tempfile.mkdtemp(), 'index.npz')
+        index.save(filename)
+        loaded = cpa.datamodel.ObjectIDIndex()
+        self.assertTrue(loaded.load(filename))
+        self.assertEqual(loaded.spans, index.spans)
+        self.assertEqual(loaded.ids.tolist(), index.ids.tolist())
+        db.get_objects_modify_date.return_value = 'd2'
+        self.assertFalse(loaded.load(filename))
+        self.assertTrue(loaded.IsEmpty())
+
+    @patch('cpa.datamodel.db')
+    def test_unknown_modify_date(self, db):
+        import os
+        import tempfile
+        index = self.build(db)
+        filename = os.path.join(tempfile.mkdtemp(), 'index.npz')
+        index.save(filename)
+        db.get_objects_modify_date.return_value = None
+        self.assertFalse(cpa.datamodel.ObjectIDIndex().load(filename))
+        index = self.build(db, modify_date=None)
+        index.last_checked = 0
+        self.assertFalse(index.is_current())
+
+    @patch('cpa.datamodel.table_summary')
+    @patch('cpa.datamodel.db')
+    def test_sqlite_summary(self, db, table_summary):
+        import os
+        import tempfile
+        self.p.db_type = 'sqlite'
+        table_summary.return_value = [5, [1, 2], [4, 3]]
+        index = self.build(db)
+        filename = os.path.join(tempfile.mkdtemp(), 'index.npz')
+        index.save(filename)
+        # writing another table changes the modify date of the database file
+        db.get_objects_modify_date.return_value = 'd2'
+        index.last_checked = 0
+        self.assertTrue(index.is_current())
+        self.assertTrue(cpa.datamodel.ObjectIDIndex().load(filename))
+        db.get_objects_modify_date.return_value = 'd3'
+        table_summary.return_value = [6, [1, 2], [5, 1]]
+        index.last_checked = 0
+        self.assertFalse(index.is_current())
+        self.assertFalse(cpa.datamodel.ObjectIDIndex().load(filename))
+
+
+class SampleObjectsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = cpa.datamodel.p
+        self.p.image_id = 'ImageNumber'
+        self.p.table_id = None
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.dm = cpa.datamodel.DataModel.getInstance()
+        self.dm.DeleteModel()
+        # image 2 has no objects, object IDs aren't consecutive
+        obIds = {(1,): [1, 2, 3], (2,): [], (3,): [4, 7], (4,): [1, 2, 3, 4, 5]}
+        self.dm.data = dict([(k, len(v)) for k, v in obIds.items()])
+        self.dm.keylist = sorted(self.dm.data.keys())
+        self.dm.counts = cpa.datamodel.np.array([self.dm.data[k] for k in self.dm.keylist])
+        self.dm.obCount = 10
+        self.dm.object_index.ids = cpa.datamodel.np.array([1, 2, 3, 4, 7, 1, 2, 3, 4, 5])
+        self.dm.object_index.spans = {(1,): (0, 3), (2,): (3, 0), (3,): (3, 2), (4,): (5, 5)}
+        self.dm.object_index.last_checked = cpa.datamodel.time.time() + 3600
+        self.all_keys = set([k + (i,) for k, ids in obIds.items() for i in ids])
+
+    def tearDown(self):
+        self.dm.DeleteModel()
+
+    def test_whole_experiment(self):
+        obKeys = self.dm.SampleObjects(100)
+        self.assertEqual(len(obKeys), 10)
+        self.assertEqual(set(obKeys), self.all_keys)
+        self.assertEqual(len(self.dm.GetRandomObject(4)), 4)
+
+    def test_images(self):
+        obKeys = self.dm.GetRandomObjects(5, [(2,), (3,)])
+        self.assertEqual(sorted(obKeys), [(3, 4), (3, 7)])
+        self.assertEqual(self.dm.GetRandomObjects(5, []), [])
+
+    def test_stratify_by_image(self):
+        obKeys = self.dm.SampleObjects(6, stratify='image')
+        self.assertEqual(sorted([k[0] for k in obKeys]), [1, 1, 3, 3, 4, 4])
+
+    @patch('cpa.datamodel.db')
+    def test_without_index(self, db):
+        self.dm.object_index.clear()
+        db.execute.return_value = [(4,), (7,)]
+        obKeys = self.dm.GetRandomObjects(2, [(3,)])
+        self.assertEqual(sorted(obKeys), [(3, 4), (3, 7)])
+        self.assertEqual(db.execute.call_count, 1)
+
+    def test_allocate_evenly(self):
+        self.assertEqual(cpa.datamodel.allocate_evenly(6, [3, 0, 2, 5]), [2, 0, 2, 2])
+        self.assertEqual(cpa.datamodel.allocate_evenly(9, [3, 1, 10]), [3, 1, 5])
+        self.assertEqual(cpa.datamodel.allocate_evenly(50, [3, 1]), [3, 1])
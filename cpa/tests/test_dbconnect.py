@@ -1,5 +1,6 @@
 import threading
-from mock import patch, Mock
+import numpy as np
+from mock import patch, Mock, sentinel
 import unittest
 import cpa.dbconnect
 
@@ -92,3 +93,400 @@ class UpdateWellsTestCase(unittest.TestCase):
 
 
 
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = cpa.dbconnect.ConnectionPool(max_size=2, timeout=0.1)
+
+    def test_new_connection_reserves_slot(self):
+        self.assertEqual(self.pool.checkout(), None)
+        self.pool.created()
+        self.assertEqual(self.pool.size, 1)
+        self.assertEqual(self.pool.statistics()['created'], 1)
+
+    def test_reuse_idle(self):
+        self.pool.checkout()
+        conn = Mock()
+        self.pool.checkin(conn, 'info')
+        self.assertEqual(self.pool.checkout(), (conn, 'info'))
+        self.assertEqual(self.pool.size, 1)
+        self.assertEqual(self.pool.statistics()['reused'], 1)
+
+    def test_unhealthy_idle_is_discarded(self):
+        self.pool.checkout()
+        conn = Mock()
+        self.pool.checkin(conn, 'info')
+        self.assertEqual(self.pool.checkout(is_healthy=lambda c: False), None)
+        conn.close.assert_called_with()
+        self.assertEqual(self.pool.size, 1)
+        self.assertEqual(self.pool.statistics()['discarded'], 1)
+
+    def test_free_slots(self):
+        self.assertEqual(self.pool.free_slots(), 2)
+        self.pool.checkout()
+        self.pool.checkout()
+        self.assertEqual(self.pool.free_slots(), 0)
+        self.pool.checkin(Mock(), 'info')
+        self.assertEqual(self.pool.free_slots(), 1)
+
+    def test_full_pool_times_out(self):
+        self.pool.checkout()
+        self.pool.checkout()
+        self.assertRaises(cpa.dbconnect.DBException, self.pool.checkout)
+
+    def test_full_pool_reclaims(self):
+        self.pool.checkout()
+        self.pool.checkout()
+        conn = Mock()
+        reclaim = lambda: self.pool.checkin(conn, 'info')
+        self.assertEqual(self.pool.checkout(reclaim=reclaim), (conn, 'info'))
+
+
+class ReleaseConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.connID = threading.currentThread().getName()
+        self.saved = (dict(self.db.connections), dict(self.db.cursors),
+                      dict(self.db.connectionInfo))
+        self.conn = Mock()
+        self.db.connections[self.connID] = self.conn
+        self.db.cursors[self.connID] = Mock()
+        self.db.connectionInfo[self.connID] = ('sqlite', 'cpa_user', '', 'CPA_DB')
+
+    def tearDown(self):
+        self.db.connections, self.db.cursors, self.db.connectionInfo = self.saved
+
+    def test_release_returns_to_pool(self):
+        self.db.connection_pool.idle = []
+        self.db.ReleaseConnection()
+        self.assertTrue(self.connID not in self.db.connections)
+        self.assertEqual(self.db.connection_pool.idle[-1][0], self.conn)
+        self.db.connection_pool.idle = []
+
+    def test_reclaim_dead_thread(self):
+        self.db.connection_pool.idle = []
+        self.db.connections['dead-thread'] = self.db.connections.pop(self.connID)
+        self.db.cursors['dead-thread'] = self.db.cursors.pop(self.connID)
+        self.db.connectionInfo['dead-thread'] = self.db.connectionInfo.pop(self.connID)
+        self.db._reclaim_dead_connections()
+        self.assertTrue('dead-thread' not in self.db.connections)
+        self.assertEqual(self.db.connection_pool.idle[-1][0], self.conn)
+        self.db.connection_pool.idle = []
+
+    def test_concurrent_reclaim(self):
+        self.db.connection_pool.idle = []
+        self.db.connections['dead-thread'] = self.db.connections.pop(self.connID)
+        self.db.cursors['dead-thread'] = self.db.cursors.pop(self.connID)
+        self.db.connectionInfo['dead-thread'] = self.db.connectionInfo.pop(self.connID)
+        reclaimed = self.db.connection_pool.stats['reclaimed']
+        threads = [threading.Thread(target=self.db._reclaim_dead_connections)
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([conn for conn, info in self.db.connection_pool.idle], [self.conn])
+        self.assertEqual(self.db.connection_pool.stats['reclaimed'], reclaimed + 1)
+        self.db.connection_pool.idle = []
+
+
+class FailedImportTestCase(unittest.TestCase):
+    def setUp(self):
+        import shutil, tempfile
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.p = cpa.dbconnect.p
+        saved = dict(self.p.__dict__)
+        self.addCleanup(self.p.__dict__.update, saved)
+        self.addCleanup(self.p.__dict__.clear)
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.p.db_type = 'sqlite'
+        self.p.db_sqlite_file = self.dir + '/CPA_DB.db'
+        self.p.db_sql_file = None
+        self.p.image_csv_file = 'per_image.csv'
+        self.p.object_csv_file = 'per_object.csv'
+        self.p.image_table = 'Per_Image'
+        self.p.image_id = 'ImageNumber'
+        self.p.table_id = None
+        saved = (self.db.connection_pool, self.db.connections, self.db.cursors,
+                 self.db.connectionInfo)
+        def restore():
+            (self.db.connection_pool, self.db.connections, self.db.cursors,
+             self.db.connectionInfo) = saved
+        self.addCleanup(restore)
+        self.db.connection_pool = cpa.dbconnect.ConnectionPool(max_size=1)
+        self.db.connections, self.db.cursors, self.db.connectionInfo = {}, {}, {}
+
+    def test_csv_import_removes_database(self):
+        def fail():
+            self.db.execute('CREATE TABLE Per_Image (ImageNumber INTEGER)')
+            raise cpa.dbconnect.DBException('bad CSV')
+        with patch.object(self.db, 'CreateSQLiteDB', side_effect=fail):
+            self.assertRaises(cpa.dbconnect.DBException, self.db.connect)
+        import os
+        self.assertFalse(os.path.exists(self.p.db_sqlite_file))
+        self.assertTrue(threading.currentThread().getName() not in self.db.connections)
+        self.assertEqual(self.db.connection_pool.size, 0)
+
+
+class ToFloatArrayTestCase(unittest.TestCase):
+    def test_nulls_and_strings(self):
+        res = cpa.dbconnect.to_float_array([[1, None], ['2.5', 'abc']])
+        self.assertEqual(res[0, 0], 1.0)
+        self.assertTrue(np.isnan(res[0, 1]))
+        self.assertEqual(res[1, 0], 2.5)
+        self.assertTrue(np.isnan(res[1, 1]))
+
+    def test_fill(self):
+        res = cpa.dbconnect.to_float_array([None, 'abc', 3], fill=0)
+        self.assertEqual(res.tolist(), [0.0, 0.0, 3.0])
+
+
+class InferDtypesTestCase(unittest.TestCase):
+    def test_infer(self):
+        rows = [(1, None, 'a', None), (2, 1.5, 'b', None)]
+        self.assertEqual(cpa.dbconnect.infer_dtypes_from_rows(4, rows),
+                         ['i8', 'f8', 'O', 'f8'])
+
+    def test_int_promoted_to_float(self):
+        rows = [(1,), (2.5,)]
+        self.assertEqual(cpa.dbconnect.infer_dtypes_from_rows(1, rows), ['f8'])
+
+
+class FetchColumnarTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        connID = threading.currentThread().getName()
+        self.saved = self.db.cursors.get(connID)
+        self.cursor = Mock(spec=['description', 'fetchmany'])
+        self.cursor.description = [('ImageNumber',), ('ObjectNumber',), ('x',), ('y',)]
+        batches = [[(1, 1, 0.5, None), (1, 2, 1.5, 'abc')], [(2, 1, 2.5, 3)], []]
+        self.cursor.fetchmany.side_effect = lambda n: batches.pop(0)
+        self.db.cursors[connID] = self.cursor
+
+    def tearDown(self):
+        self.db.cursors[threading.currentThread().getName()] = self.saved
+
+    def test_columns(self):
+        cols = self.db._fetch_columnar(batch_size=2)
+        self.assertEqual(cols[0].tolist(), [1, 1, 2])
+        self.assertEqual(cols[0].dtype.kind, 'i')
+        self.assertEqual(cols[2].tolist(), [0.5, 1.5, 2.5])
+
+    def test_matrix(self):
+        keys, matrix = self.db._fetch_columnar(feature_start=2, fill=0, batch_size=2)
+        self.assertEqual(keys[1].tolist(), [1, 2, 1])
+        self.assertEqual(matrix.tolist(), [[0.5, 0], [1.5, 0], [2.5, 3]])
+
+
+class IterQueryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        connID = threading.currentThread().getName()
+        self.saved = (dict(self.db.connections), dict(self.db.cursors))
+        self.db.connections[connID] = Mock()
+        self.db.cursors[connID] = Mock()
+        self.cursor = Mock(spec=['description', 'execute', 'fetchmany'])
+        self.cursor.description = [('ImageNumber',), ('x',)]
+        batches = [[(1, 0.5), (1, None)], [(2, 2.5)], []]
+        self.cursor.fetchmany.side_effect = lambda n: batches.pop(0)
+        self.conn = Mock()
+        self.db._checkout_private_connection = Mock(return_value=(self.conn, sentinel.info))
+        self.db._checkin_private_connection = Mock()
+        self.db._new_cursor = Mock(return_value=self.cursor)
+
+    def tearDown(self):
+        del self.db._checkout_private_connection
+        del self.db._checkin_private_connection
+        del self.db._new_cursor
+        self.db.connections, self.db.cursors = self.saved
+
+    def test_rows(self):
+        batches = list(self.db.iter_query('query', batch_size=2))
+        self.assertEqual(batches, [[(1, 0.5), (1, None)], [(2, 2.5)]])
+        self.cursor.execute.assert_called_once_with('query')
+        self.db._checkin_private_connection.assert_called_once_with(
+            self.conn, sentinel.info, self.cursor, True)
+
+    def test_chunks(self):
+        chunks = list(self.db.iter_query('query', batch_size=2, feature_start=1, fill=0))
+        self.assertEqual(len(chunks), 2)
+        keys, matrix = chunks[0]
+        self.assertEqual(keys[0].tolist(), [1, 1])
+        self.assertEqual(matrix.tolist(), [[0.5], [0]])
+
+    def test_progress_and_cancel(self):
+        class Cancelled(Exception):
+            pass
+        fractions = []
+        def cb(frac):
+            fractions.append(frac)
+            raise Cancelled()
+        gen = self.db.iter_query('query', batch_size=2, nrows=3, cb=cb)
+        next(gen)
+        self.assertRaises(Cancelled, next, gen)
+        self.assertEqual(fractions, [2 / 3.])
+        self.db._checkin_private_connection.assert_called_once_with(
+            self.conn, sentinel.info, self.cursor, False)
+
+    def test_pool_exhausted_uses_thread_cursor(self):
+        self.db._checkout_private_connection.side_effect = \
+            cpa.dbconnect.ConnectionPoolExhausted('full')
+        cursor = self.db.cursors[threading.currentThread().getName()]
+        cursor.fetchmany.side_effect = [[(1,)], []]
+        self.assertEqual(list(self.db.iter_query('query')), [[(1,)]])
+        cursor.execute.assert_called_once_with('query')
+        self.assertFalse(self.db._checkin_private_connection.called)
+
+
+
+class SQLiteObjectTableTestCase(unittest.TestCase):
+    '''Runs against a small in-memory SQLite object table.'''
+    def setUp(self):
+        import sqlite3
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.p.cell_x_loc = 'x'
+        self.p.cell_y_loc = 'y'
+        connID = threading.currentThread().getName()
+        self.saved = (dict(self.db.connections), dict(self.db.cursors))
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE Per_Object (ImageNumber INTEGER, '
+                          'ObjectNumber INTEGER, x FLOAT, y FLOAT, s TEXT)')
+        self.conn.executemany('INSERT INTO Per_Object VALUES (?, ?, ?, ?, ?)',
+                              [(1, 1, 10.0, 20.0, 'a'), (1, 2, 11.0, None, 'b'),
+                               (2, 1, 12.0, 22.0, 'c')])
+        self.db.connections[connID] = self.conn
+        self.db.cursors[connID] = self.conn.cursor()
+
+    def tearDown(self):
+        self.db.connections, self.db.cursors = self.saved
+        self.conn.close()
+
+
+class BatchLookupTestCase(SQLiteObjectTableTestCase):
+    def test_cell_data(self):
+        data = self.db.GetCellDataBatch([(2, 1), (1, 1), (3, 1)])
+        self.assertEqual(data[:2].tolist(), [[2, 1, 12, 22, 0], [1, 1, 10, 20, 0]])
+        self.assertTrue(np.isnan(data[2]).all())
+        data = self.db.GetCellDataBatch([(1, 2)], columns=['x', 'y'])
+        self.assertEqual(data.tolist(), [[11, 0]])
+
+    def test_coords(self):
+        coords = self.db.GetObjectCoordsBatch([(2, 1), (1, 1), (2, 1)])
+        self.assertEqual(coords.tolist(), [[12, 22], [10, 20], [12, 22]])
+        self.assertRaises(Exception, self.db.GetObjectCoordsBatch, [(1, 1), (1, 2)])
+        coords = self.db.GetObjectCoordsBatch([(1, 2), (1, 1)], none_ok=True)
+        self.assertTrue(np.isnan(coords[0, 1]))
+        # the key table is dropped after each lookup
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM sqlite_temp_master "
+                                           "WHERE type='table'").fetchone()[0], 0)
+
+
+class KeySetTestCase(SQLiteObjectTableTestCase):
+    def select(self, keys, inline_limit):
+        with cpa.dbconnect.KeySet(keys, inline_limit=inline_limit) as keyset:
+            clause = keyset.where_clause('Per_Object')
+            rows = self.db.execute('SELECT ImageNumber, ObjectNumber FROM Per_Object '
+                                   'WHERE %s ORDER BY ImageNumber, ObjectNumber'%(clause))
+        return clause, rows
+
+    def test_inline(self):
+        clause, rows = self.select([(1, 2), (2, 1)], 10)
+        self.assertTrue('_cpa_keyset' not in clause)
+        self.assertEqual(rows, [(1, 2), (2, 1)])
+
+    def test_object_key_table(self):
+        clause, rows = self.select([(2, 1), (1, 2), (5, 5)], 1)
+        self.assertTrue(clause.startswith('EXISTS'))
+        self.assertEqual(rows, [(1, 2), (2, 1)])
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM sqlite_temp_master "
+                                           "WHERE type='table'").fetchone()[0], 0)
+
+    def test_image_key_table(self):
+        clause, rows = self.select([(1,)], 0)
+        self.assertTrue(' IN (SELECT ' in clause)
+        self.assertEqual(rows, [(1, 1), (1, 2)])
+
+    def test_empty(self):
+        clause, rows = self.select([], 0)
+        self.assertEqual(rows, [])
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        cache = cpa.dbconnect.QueryCache(max_bytes=10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        self.assertEqual(cache.get('a'), (True, 1))
+        cache.put('c', 3, 4)   # evicts b, the least recently used
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('c'), (True, 3))
+        cache.put('d', 4, 11)
+        self.assertEqual(cache.get('d'), (False, None))
+        stats = cache.statistics()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['too_big']),
+                         (2, 2, 1, 1))
+        self.assertEqual((stats['entries'], stats['bytes']), (2, 8))
+        cache.clear()
+        self.assertEqual(cache.get('a'), (False, None))
+
+    def test_normalize_sql(self):
+        self.assertEqual(cpa.dbconnect.normalize_sql(' SELECT a,\n  b FROM t  WHERE s="x  y" '),
+                         'SELECT a, b FROM t WHERE s="x  y"')
+
+
+class ExecuteCachedTestCase(SQLiteObjectTableTestCase):
+    def setUp(self):
+        SQLiteObjectTableTestCase.setUp(self)
+        self.db.get_objects_modify_date = Mock(return_value=1.0)
+        self.db.invalidate_cache()
+
+    def tearDown(self):
+        del self.db.get_objects_modify_date
+        self.db.invalidate_cache()
+        SQLiteObjectTableTestCase.tearDown(self)
+
+    def test_hit(self):
+        query = 'SELECT ImageNumber, ObjectNumber FROM Per_Object WHERE x > 10.5'
+        self.assertEqual(self.db.execute_cached(query), [(1, 2), (2, 1)])
+        self.conn.execute('DELETE FROM Per_Object')
+        self.assertEqual(self.db.execute_cached(query.replace(' ', '  ')), [(1, 2), (2, 1)])
+        self.db.invalidate_cache()
+        self.assertEqual(self.db.execute_cached(query), [])
+
+    def test_column_names(self):
+        self.assertEqual(self.db.GetColumnNames('Per_Object'),
+                         ['ImageNumber', 'ObjectNumber', 'x', 'y', 's'])
+        self.conn.execute('ALTER TABLE Per_Object ADD User_z INTEGER')
+        self.assertEqual(len(self.db.GetColumnNames('Per_Object')), 5)
+        self.db.invalidate_cache()
+        self.assertEqual(len(self.db.GetColumnNames('Per_Object')), 6)
+
+    def test_unknown_modify_date(self):
+        self.db.get_objects_modify_date.return_value = None
+        self.db.invalidate_cache()
+        self.db.execute_cached('SELECT * FROM Per_Object')
+        self.assertEqual(self.db.query_cache.statistics()['entries'], 0)
+
+
+class InferColTypesFromCSVTestCase(unittest.TestCase):
+    def test_sample(self):
+        import tempfile
+        db = cpa.dbconnect.DBConnect.getInstance()
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv') as f:
+            f.write(' ImageNumber,x,Well\n1,0.5,A01\n2,1,A02\n3,abc,A03\n')
+            f.flush()
+            labels, types = db.InferColTypesFromCSV(f.name, sample_rows=2)
+        self.assertEqual(labels, ['ImageNumber', 'x', 'Well'])
+        self.assertEqual(types, ['INT', 'FLOAT', 'VARCHAR(3)'])
@@ -0,0 +1,113 @@
+import numpy as np
+from unittest import TestCase
+from cpa.fastgentleboostingmulticlass import WeakLearnerSearch, StumpEvaluator, train
+from cpa.fastgentleboostingworkermulticlass import train_weak_learner
+
+
+def label_matrix(labels, num_classes):
+    '''Returns the N x C matrix of +1 and -1 for 0-based class labels.'''
+    matrix = -np.ones((len(labels), num_classes), np.int32)
+    matrix[np.arange(len(labels)), labels] = 1
+    return matrix
+
+
+class WeakLearnerSearchTestCase(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.values = rng.randn(60, 7).astype(np.float32)
+        # ties, which must be thresholded at the top of the run
+        self.values[:, 3] = np.round(self.values[:, 3])
+        self.labels = label_matrix(rng.randint(0, 3, 60), 3)
+        self.weights = rng.rand(60, 3).astype(np.float32)
+
+    def check(self, search):
+        best = None
+        for column in range(self.values.shape[1]):
+            thresh, err, a, b = train_weak_learner(self.labels, self.weights, self.values[:, column])
+            if best is None or err < best[0]:
+                best = (err, column, thresh, a, b)
+        err, column, thresh, a, b = search.best(self.weights)
+        self.assertAlmostEqual(err, best[0], places=5)
+        self.assertEqual(column, best[1])
+        self.assertEqual(thresh, best[2])
+        np.testing.assert_allclose(a, best[3], rtol=1e-5)
+        np.testing.assert_allclose(b, best[4], rtol=1e-5)
+
+    def test_best(self):
+        self.check(WeakLearnerSearch(self.labels, self.values))
+
+    def test_blocks(self):
+        search = WeakLearnerSearch(self.labels, self.values, block_entries=60 * 3 * 2)
+        self.assertEqual(len(search.blocks), 4)
+        self.check(search)
+
+    def test_subset(self):
+        search = WeakLearnerSearch(self.labels, self.values)
+        rows = np.flatnonzero(np.arange(60) % 3 != 1)
+        subset = search.subset(rows)
+        fresh = WeakLearnerSearch(self.labels[rows], self.values[rows])
+        np.testing.assert_array_equal(subset.order, fresh.order)
+        np.testing.assert_array_equal(subset.inside_run, fresh.inside_run)
+        weights = self.weights[rows]
+        self.assertEqual(subset.best(weights)[:3], fresh.best(weights)[:3])
+
+    def test_tied_column(self):
+        column = self.values[:, 3]
+        err, col, thresh, a, b = WeakLearnerSearch(self.labels, self.values[:, 3:4]).best(self.weights)
+        # the best of the thresholds between distinct values
+        errors = []
+        for t in np.unique(column):
+            above = (column > t).reshape((-1, 1))
+            errors += [((self.labels - np.where(above, *self.stump(column, t))) ** 2 * self.weights).sum()]
+        self.assertEqual(thresh, np.unique(column)[np.argmin(errors)])
+        self.assertAlmostEqual(err, min(errors), places=4)
+
+    def stump(self, column, t):
+        '''Returns the weighted mean labels (a, b) above and below threshold t.'''
+        above = (column > t).reshape((-1, 1))
+        w = self.weights
+        a = (w * self.labels * above).sum(axis=0) / np.maximum((w * above).sum(axis=0), 1e-30)
+        b = (w * self.labels * ~above).sum(axis=0) / (w * ~above).sum(axis=0)
+        return a, b
+
+    def test_train(self):
+        learners = train(['f%d'%(i) for i in range(7)], 5, self.labels, self.values)
+        self.assertTrue(0 < len(learners) <= 5)
+        for colname, thresh, a, b, margin in learners:
+            self.assertTrue(colname.startswith('f'))
+            self.assertEqual(len(a), 3)
+            self.assertEqual(len(b), 3)
+
+
+class StumpEvaluatorTestCase(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.model = [('x', 0.5, [1.0, -1.0, 0.2], [-0.5, 0.5, 0.1], 0.1),
+                      ('y', -0.2, [0.3, 0.6, -0.9], [0.0, -0.2, 0.4], 0.2),
+                      ('x', -0.5, [-0.7, 0.1, 0.8], [0.2, 0.0, -0.3], 0.3)]
+        self.values = rng.randn(1000, 2)
+        self.values[::7, 1] = np.nan
+
+    def expected(self):
+        # one row at a time, like the SQLite classifier function
+        classes = []
+        for row in self.values:
+            scores = np.zeros(3)
+            for colname, thresh, a, b, margin in self.model:
+                value = row[['x', 'y'].index(colname)]
+                scores += np.array(a if value > thresh else b)
+            classes.append(scores.argmax() + 1)
+        return np.array(classes)
+
+    def test_columns(self):
+        self.assertEqual(StumpEvaluator(self.model).columns, ['x', 'y'])
+
+    def test_classify(self):
+        evaluator = StumpEvaluator(self.model, rows=64)
+        np.testing.assert_array_equal(evaluator.classify(self.values), self.expected())
+        self.assertEqual(evaluator.scores(self.values).shape, (1000, 3))
+
+    def test_classify_chunks(self):
+        evaluator = StumpEvaluator(self.model)
+        classes = list(evaluator.classify_chunks([self.values[:300], self.values[300:]]))
+        np.testing.assert_array_equal(np.concatenate(classes), self.expected())
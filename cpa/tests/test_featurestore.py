@@ -0,0 +1,125 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+from mock import patch
+import cpa.featurestore
+from cpa.featurestore import FeatureStore
+
+
+class FeatureStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE obj (TableNumber INT, ImageNumber INT, ObjectNumber INT, '
+                          'a FLOAT, b FLOAT, c TEXT)')
+        # images (0,1), (0,3) and (1,2); (0,2) has no objects
+        self.rows = [(t, i, o, float(t * 100 + i * 10 + o), None if o == 2 else -o, 'x')
+                     for t, i, n in [(1, 2, 2), (0, 3, 3), (0, 1, 4)]
+                     for o in range(1, n + 1)]
+        self.conn.executemany('INSERT INTO obj VALUES (?, ?, ?, ?, ?, ?)', self.rows)
+        self.stamp = 1.0
+
+        patchers = [patch('cpa.featurestore.db'), patch('cpa.featurestore.p'),
+                    patch('cpa.featurestore.object_key_columns'),
+                    patch('cpa.featurestore.image_key_columns'),
+                    patch('cpa.featurestore.UniqueObjectClause')]
+        db, p, object_key_columns, image_key_columns, UniqueObjectClause = [
+            patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        p.object_table = 'obj'
+        p.db_type = 'sqlite'
+        p.db_host = p.db_name = p.db_sqlite_file = ''
+        self.p = p
+        object_key_columns.return_value = ('TableNumber', 'ImageNumber', 'ObjectNumber')
+        image_key_columns.return_value = ('TableNumber', 'ImageNumber')
+        UniqueObjectClause.return_value = 'TableNumber,ImageNumber,ObjectNumber'
+        db.GetColnamesForClassifier.return_value = ['a', 'b']
+        db.get_objects_modify_date.side_effect = lambda: self.stamp
+        db.execute.side_effect = lambda query: self.conn.execute(query).fetchall()
+        def iter_query(query, batch_size, feature_start, dtype, nrows, cb):
+            rows = self.conn.execute(query).fetchall()
+            for i in range(0, len(rows), 2):
+                batch = np.array(rows[i:i + 2], dtype='f8')
+                yield list(batch[:, :feature_start].T), batch[:, feature_start:].astype(dtype)
+        db.iter_query.side_effect = iter_query
+
+    def build(self):
+        store = FeatureStore(self.dir)
+        self.assertFalse(store.is_valid())
+        store.build()
+        self.assertTrue(store.is_valid())
+        store.open()
+        return store
+
+    def test_rows(self):
+        store = self.build()
+        keys, values = store.rows(0, len(store.keys))
+        expected = sorted(self.rows)
+        np.testing.assert_array_equal(keys, [row[:3] for row in expected])
+        np.testing.assert_array_equal(values[:, 0], [row[3] for row in expected])
+        self.assertTrue(np.isnan(values[1, 1]))
+        keys, values = store.rows(1, 3, ['b'], fill=0)
+        np.testing.assert_array_equal(values, [[0], [-3]])
+
+    def test_image_rows(self):
+        store = self.build()
+        self.assertEqual(store.image_rows((0, 1), (0, 1)), (0, 4))
+        self.assertEqual(store.image_rows((0, 2), (0, 3)), (4, 7))
+        self.assertEqual(store.image_rows((0, 2), (0, 2)), (4, 4))
+        self.assertEqual(store.image_rows((0, 3), (1, 2)), (4, 9))
+        # keys beyond those in the store
+        self.assertEqual(store.image_rows((0, 4), (0, 99)), (7, 7))
+        self.assertEqual(store.image_rows((0, 1), (5, 0)), (0, 9))
+
+    def test_lookup(self):
+        store = self.build()
+        np.testing.assert_array_equal(store.lookup([(0, 3, 2), (1, 2, 2), (0, 1, 9), (0, 9, 1)]),
+                                      [5, 8, -1, -1])
+        keys, values = store.object_data([(1, 2), (0, 1)], ['a'])
+        np.testing.assert_array_equal(values[:, 0], [121, 122, 11, 12, 13, 14])
+        keys, values = store.object_data([(0, 3, 1), (0, 2, 1)], ['a'])
+        np.testing.assert_array_equal(keys, [(0, 3, 1)])
+
+    def test_is_valid(self):
+        store = self.build()
+        # SQLite modify dates are the file's, so the table is compared instead
+        self.stamp = 2.0
+        self.assertTrue(store.is_valid())
+        self.conn.execute('DELETE FROM obj WHERE ObjectNumber = 4')
+        self.stamp = 3.0
+        self.assertFalse(store.is_valid())
+        store.build()
+        cpa.featurestore.db.GetColnamesForClassifier.return_value = ['a']
+        self.assertFalse(store.is_valid())
+
+    def test_is_valid_mysql(self):
+        self.p.db_type = 'mysql'
+        store = self.build()
+        self.stamp = 2.0
+        self.assertFalse(store.is_valid())
+
+    def test_unknown_modify_date(self):
+        self.p.db_type = 'mysql'
+        self.p.feature_store_dir = self.dir
+        store = self.build()
+        self.stamp = None
+        self.assertFalse(store.is_valid())
+        self.assertEqual(cpa.featurestore.get_feature_store(), None)
+        self.stamp = 1.0
+        self.assertTrue(cpa.featurestore.get_feature_store() is not None)
+
+    def test_get_without_build(self):
+        self.p.db_type = 'mysql'
+        self.p.feature_store_dir = self.dir
+        self.assertEqual(cpa.featurestore.get_feature_store(build=False), None)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'features.npy')))
+        self.assertTrue(cpa.featurestore.get_feature_store() is not None)
+        self.assertTrue(cpa.featurestore.get_feature_store(build=False) is not None)
+        # the store is busy being exported by another thread
+        with cpa.featurestore._store_lock:
+            self.assertEqual(cpa.featurestore.get_feature_store(build=False), None)
@@ -23,3 +23,408 @@ class WhereClausesTestCase(TestCase):
         eq_(result, ['(Per_Object.ImageNumber <= 5)'])
 
 
+
+
+class ProcessDataTestCase(TestCase):
+    def setUp(self):
+        self.patches = [mock.patch.object(cpa.multiclasssql, 'object_key_columns',
+                                          lambda: ('ImageNumber', 'ObjectNumber')),
+                        mock.patch.object(cpa.multiclasssql.db, 'GetColnamesForClassifier',
+                                          lambda: ['a', 'b'])]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def test_convert(self):
+        cell_data, object_keys = cpa.multiclasssql.processData(
+            [(1, 1, 0.5, None), (1, 2, '2.5', 'nan?'), (2, 1, 3, 4.0)])
+        eq_(object_keys.dtype.kind, 'i')
+        eq_(object_keys.tolist(), [[1, 1], [1, 2], [2, 1]])
+        eq_(cell_data.dtype, 'f8')
+        eq_(cell_data.tolist(), [[0.5, 0], [2.5, 0], [3, 4]])
+
+    def test_float32(self):
+        cell_data, object_keys = cpa.multiclasssql.processData([(1, 1, 0.5, 1.5)], dtype='f4')
+        eq_(cell_data.dtype, 'f4')
+
+    def test_empty(self):
+        cell_data, object_keys = cpa.multiclasssql.processData([])
+        eq_(cell_data.shape, (0, 2))
+        eq_(object_keys.shape, (0, 2))
+
+    def test_object_key_array(self):
+        import numpy as np
+        keys = cpa.multiclasssql.object_key_array([np.array([1., 2.]), np.array([3, 4])])
+        eq_(keys.dtype.kind, 'i')
+        eq_(keys.tolist(), [[1, 3], [2, 4]])
+
+
+class PrunedClassifierTestCase(TestCase):
+    def setUp(self):
+        self.patch = mock.patch.object(cpa.multiclasssql.db, 'GetColnamesForClassifier',
+                                       lambda: ['a', 'b', 'c', 'd'])
+        self.patch.start()
+        self.classifier = mock.Mock()
+        self.classifier.Predict = lambda values: values
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_all(self):
+        self.classifier.UsedFeatures = lambda: None
+        classifier, columns = cpa.multiclasssql.pruned_classifier(self.classifier)
+        assert classifier is self.classifier
+        eq_(columns, ['a', 'b', 'c', 'd'])
+
+    def test_pruned(self):
+        import numpy as np
+        self.classifier.UsedFeatures = lambda: ['d', 'b']
+        classifier, columns = cpa.multiclasssql.pruned_classifier(self.classifier)
+        eq_(columns, ['b', 'd'])
+        eq_(classifier.Predict(np.array([[1., 2.], [3., 4.]])).tolist(),
+            [[0, 1, 0, 2], [0, 3, 0, 4]])
+
+    def test_none_used(self):
+        self.classifier.UsedFeatures = lambda: []
+        classifier, columns = cpa.multiclasssql.pruned_classifier(self.classifier)
+        eq_(columns, ['a'])
+
+
+class ImageChunksTestCase(TestCase):
+    def test_chunks(self):
+        eq_(cpa.multiclasssql._image_chunks([3, 3, 3, 10, 1, 1], 5),
+            [(0, 1), (1, 2), (2, 3), (3, 4), (4, 6)])
+
+    def test_empty(self):
+        eq_(cpa.multiclasssql._image_chunks([], 5), [])
+
+    def test_key_range(self):
+        eq_(cpa.multiclasssql._key_range_clause(['i'], (2,), (5,)), 'i BETWEEN 2 AND 5')
+        eq_(cpa.multiclasssql._key_range_clause(['t', 'i'], (1, 2), (1, 5)),
+            't = 1 AND i BETWEEN 2 AND 5')
+        eq_(cpa.multiclasssql._key_range_clause(['t', 'i'], (1, 2), (3, 5)),
+            '(t > 1 OR (t = 1 AND i >= 2)) AND (t < 3 OR (t = 3 AND i <= 5))')
+
+
+class PerImageCountsTestCase(TestCase):
+    '''Scores a fake table of objects with one feature, x, and class x.'''
+    objects = [(1, 1.0, 1), (1, 2.0, 2), (1, 2.0, 3), (2, 1.0, 5), (3, 2.0, 4), (3, 2.0, 6)]
+
+    def setUp(self):
+        import numpy as np
+        import re
+        def execute_columnar(query, feature_start, fill, nrows, silent):
+            lo, hi = map(int, re.search(r'BETWEEN (\d+) AND (\d+)', query).groups())
+            rows = [(im, x, area) for im, x, area in self.objects if lo <= im <= hi]
+            if cpa.multiclasssql.p.area_scoring_column:
+                features = [(area, x) for im, x, area in rows]
+            else:
+                features = [(x,) for im, x, area in rows]
+            nfeatures = cpa.multiclasssql.p.area_scoring_column and 2 or 1
+            return ([np.array([im for im, x, area in rows], dtype='i8'),
+                     np.arange(1, len(rows) + 1)],
+                    np.array(features, dtype=float).reshape((len(rows), nfeatures)))
+        self.classifier = mock.Mock()
+        self.classifier.UsedFeatures = lambda: None
+        self.classifier.LinearModel = lambda: None
+        self.classifier.Predict = lambda cell_data: cell_data[:, 0]
+        mc = cpa.multiclasssql
+        self.patches = [mock.patch.object(mc, 'image_key_columns', lambda: ('ImageNumber',)),
+                        mock.patch.object(mc, 'object_key_columns',
+                                          lambda table_name='': ('ImageNumber', 'ObjectNumber')),
+                        mock.patch.object(mc, 'p'),
+                        mock.patch.object(mc, 'dm'),
+                        mock.patch.object(mc.db, 'GetColnamesForClassifier', lambda: ['x']),
+                        mock.patch.object(mc.db, 'execute_columnar', execute_columnar)]
+        for patch in self.patches:
+            patch.start()
+        mc.p.object_table = 'Per_Object'
+        mc.p.area_scoring_column = None
+        mc.dm.GetImageKeysAndObjectCounts = lambda filter_name: [((3,), 2), ((1,), 3), ((2,), 1), ((4,), 0)]
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def test_counts(self):
+        fractions = []
+        for n_threads in [1, 3]:
+            result = cpa.multiclasssql.PerImageCounts(self.classifier, 2, cb=fractions.append,
+                                                      n_threads=n_threads, chunk_size=2)
+            eq_(result, [[3, 0, 2], [1, 1, 2], [2, 1, 0], [4, 0, 0]])
+            eq_(fractions[-1], 1.0)
+
+    def test_area(self):
+        cpa.multiclasssql.p.area_scoring_column = 'area'
+        result = cpa.multiclasssql.PerImageCounts(self.classifier, 2, n_threads=1)
+        eq_(result, [[3, 0, 2, 0.0, 10.0], [1, 1, 2, 1.0, 5.0], [2, 1, 0, 5.0, 0.0], [4, 0, 0, 0.0, 0.0]])
+
+    def test_cancel(self):
+        class Cancel(Exception):
+            pass
+        def cb(fraction):
+            raise Cancel()
+        self.assertRaises(Cancel, cpa.multiclasssql.PerImageCounts, self.classifier, 2,
+                          cb=cb, n_threads=3, chunk_size=1)
+
+
+class ClassTableTestCase(TestCase):
+    '''Writes the class table of a small SQLite object table.'''
+    def setUp(self):
+        import os
+        import sqlite3
+        import tempfile
+        import threading
+        import numpy as np
+        mc = cpa.multiclasssql
+        self.dir = tempfile.mkdtemp()
+        self.patches = [mock.patch.multiple(mc.p, db_type='sqlite', table_id=None,
+                                            image_id='ImageNumber', object_id='ObjectNumber',
+                                            object_table='Per_Object', class_table='Per_Class',
+                                            class_counts_table=None,
+                                            db_sqlite_file=os.path.join(self.dir, 'test.db'),
+                                            create=True),
+                        mock.patch.object(mc.db, 'GetColnamesForClassifier', lambda: ['x']),
+                        mock.patch.object(mc, 'dm'),
+                        mock.patch.object(mc, 'CLASS_TABLE_BATCH_SIZE', 2)]
+        for patch in self.patches:
+            patch.start()
+        self.conn = sqlite3.connect(mc.p.db_sqlite_file, check_same_thread=False)
+        self.conn.execute('CREATE TABLE Per_Object (ImageNumber INTEGER, '
+                          'ObjectNumber INTEGER, x FLOAT)')
+        self.conn.executemany('INSERT INTO Per_Object VALUES (?, ?, ?)',
+                              [(1, 1, -1.0), (1, 2, 2.0), (2, 1, None), (2, 2, 3.0), (3, 1, 1.0)])
+        self.conn.commit()
+        connID = threading.currentThread().getName()
+        self.saved = (dict(mc.db.connections), dict(mc.db.cursors))
+        mc.db.connections[connID] = self.conn
+        mc.db.cursors[connID] = self.conn.cursor()
+        mc.dm.GetImageKeysAndObjectCounts = lambda filter_name=None: [((2,), 2), ((1,), 2), ((3,), 1)]
+        self.classifier = mock.Mock()
+        self.classifier.UsedFeatures = lambda: None
+        self.classifier.LinearModel = lambda: None
+        self.classifier.Predict = lambda cell_data: (cell_data[:, 0] > 0).astype(int) + 1
+        self.classifier.PredictProba = lambda cell_data: np.column_stack(
+            [cell_data[:, 0] <= 0, cell_data[:, 0] > 0]).astype(float)
+
+    def tearDown(self):
+        import shutil
+        mc = cpa.multiclasssql
+        mc.db.connections, mc.db.cursors = self.saved
+        mc.db.connection_pool.close_all()
+        self.conn.close()
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.dir)
+
+    def test_class_table(self):
+        cpa.multiclasssql.create_perobject_class_table(self.classifier, ['negative', 'positive'],
+                                                       n_threads=1, chunk_size=2)
+        self.check_class_table()
+
+    def test_query_cache(self):
+        mc = cpa.multiclasssql
+        self.classifier.Fingerprint = lambda: 'model a'
+        # on MySQL, writing the class table needn't change the object table's modify date
+        with mock.patch.object(mc.db, 'get_objects_modify_date', lambda: 1.0):
+            mc.db.invalidate_cache()
+            mc.create_perobject_class_table(self.classifier, ['negative', 'positive'], n_threads=1)
+            eq_(mc.db.execute_cached('SELECT COUNT(*) FROM Per_Class'), [(5,)])
+            mc.dm.GetImageKeysAndObjectCounts = lambda filter_name=None: [((2,), 2), ((1,), 2)]
+            mc.create_perobject_class_table(self.classifier, ['negative', 'positive'], n_threads=1)
+            eq_(mc.db.execute_cached('SELECT COUNT(*) FROM Per_Class'), [(4,)])
+            mc.IncrementalPerImageCounts(self.classifier, ['negative', 'positive'], n_threads=1)
+            eq_(mc.db.execute_cached('SELECT COUNT(*) FROM Per_Class_counts'), [(2,)])
+            mc.dm.GetImageKeysAndObjectCounts = lambda filter_name=None: [((2,), 2), ((1,), 2), ((3,), 1)]
+            mc.IncrementalPerImageCounts(self.classifier, ['negative', 'positive'], n_threads=1)
+            eq_(mc.db.execute_cached('SELECT COUNT(*) FROM Per_Class_counts'), [(3,)])
+            eq_(mc.db.execute_cached('SELECT COUNT(*) FROM Per_Class'), [(5,)])
+
+    def test_small_pool(self):
+        import time
+        mc = cpa.multiclasssql
+        pool = mc.db.connection_pool
+        predict = self.classifier.Predict
+        def slow_predict(cell_data):
+            time.sleep(0.2)
+            return predict(cell_data)
+        self.classifier.Predict = slow_predict
+        with mock.patch.object(pool, '_max_size', 2), mock.patch.object(pool, 'timeout', 0.3):
+            # another thread holds one of the two connections throughout
+            self.assertIsNone(pool.checkout())
+            try:
+                mc.create_perobject_class_table(self.classifier, ['negative', 'positive'],
+                                                n_threads=2, chunk_size=1)
+            finally:
+                pool.discard()
+        self.check_class_table()
+
+    def check_class_table(self):
+        rows = self.conn.execute('SELECT ImageNumber, ObjectNumber, class, class_number '
+                                 'FROM Per_Class ORDER BY ImageNumber, ObjectNumber').fetchall()
+        eq_(rows, [(1, 1, 'negative', 1), (1, 2, 'positive', 2), (2, 1, 'negative', 1),
+                   (2, 2, 'positive', 2), (3, 1, 'positive', 2)])
+        indexes = self.conn.execute("SELECT name FROM sqlite_master WHERE type='index' "
+                                    "AND tbl_name='Per_Class'").fetchall()
+        eq_(indexes, [('idx_Per_Class',)])
+
+    def test_single_pass(self):
+        calls = []
+        predict = self.classifier.Predict
+        self.classifier.Predict = lambda cell_data: calls.append(len(cell_data)) or predict(cell_data)
+        cpa.multiclasssql.p.probability_table = 'Per_Probability'
+        try:
+            counts = cpa.multiclasssql.PerImageCounts(self.classifier, 2, class_names=['negative', 'positive'],
+                                                      n_threads=1, chunk_size=2)
+        finally:
+            cpa.multiclasssql.p.probability_table = None
+        eq_(sum(calls), 5)
+        eq_(counts, [[2, 1, 1], [1, 1, 1], [3, 0, 1]])
+        self.check_class_table()
+        rows = self.conn.execute('SELECT ImageNumber, ObjectNumber, p_negative, p_positive '
+                                 'FROM Per_Probability ORDER BY ImageNumber, ObjectNumber').fetchall()
+        eq_(rows, [(1, 1, 1.0, 0.0), (1, 2, 0.0, 1.0), (2, 1, 1.0, 0.0),
+                   (2, 2, 0.0, 1.0), (3, 1, 0.0, 1.0)])
+
+    def test_incremental(self):
+        calls = []
+        predict = self.classifier.Predict
+        self.classifier.Predict = lambda cell_data: calls.append(len(cell_data)) or predict(cell_data)
+        self.classifier.Fingerprint = lambda: 'model a'
+        mc = cpa.multiclasssql
+        counts = mc.IncrementalPerImageCounts(self.classifier, ['negative', 'positive'],
+                                              n_threads=1, chunk_size=2)
+        eq_(counts, [[2, 1, 1], [1, 1, 1], [3, 0, 1]])
+        eq_(sum(calls), 5)
+        self.check_class_table()
+
+        # a new image: only its objects are scored
+        self.conn.execute('INSERT INTO Per_Object VALUES (4, 1, 5.0)')
+        self.conn.commit()
+        mc.dm.GetImageKeysAndObjectCounts = lambda filter_name=None: [((2,), 2), ((1,), 2), ((3,), 1), ((4,), 1)]
+        del calls[:]
+        counts = mc.IncrementalPerImageCounts(self.classifier, ['negative', 'positive'], n_threads=1)
+        eq_(counts, [[2, 1, 1], [1, 1, 1], [3, 0, 1], [4, 0, 1]])
+        eq_(sum(calls), 1)
+        eq_(self.conn.execute('SELECT COUNT(*), COUNT(DISTINCT model_fingerprint) FROM Per_Class').fetchall(),
+            [(6, 1)])
+
+        # new images on either side of scored ones: those in between aren't added again
+        self.conn.execute('INSERT INTO Per_Object VALUES (0, 1, 5.0)')
+        self.conn.execute('INSERT INTO Per_Object VALUES (5, 1, 5.0)')
+        self.conn.commit()
+        mc.dm.GetImageKeysAndObjectCounts = lambda filter_name=None: [
+            ((0,), 1), ((2,), 2), ((1,), 2), ((3,), 1), ((4,), 1), ((5,), 1)]
+        del calls[:]
+        counts = mc.IncrementalPerImageCounts(self.classifier, ['negative', 'positive'], n_threads=1)
+        eq_(counts, [[0, 0, 1], [2, 1, 1], [1, 1, 1], [3, 0, 1], [4, 0, 1], [5, 0, 1]])
+        eq_(sum(calls), 2)
+        eq_(self.conn.execute('SELECT COUNT(*) FROM Per_Class').fetchall(), [(8,)])
+        eq_(self.conn.execute('SELECT COUNT(*) FROM (SELECT DISTINCT ImageNumber, ObjectNumber '
+                              'FROM Per_Class)').fetchall(), [(8,)])
+
+        # nothing new
+        del calls[:]
+        mc.IncrementalPerImageCounts(self.classifier, ['negative', 'positive'], n_threads=1)
+        eq_(sum(calls), 0)
+
+        # another model scores everything again
+        self.classifier.Fingerprint = lambda: 'model b'
+        counts = mc.IncrementalPerImageCounts(self.classifier, ['negative', 'positive'], n_threads=1)
+        eq_(sum(calls), 8)
+        eq_(self.conn.execute('SELECT COUNT(*) FROM Per_Class').fetchall(), [(8,)])
+        eq_(self.conn.execute('SELECT COUNT(*) FROM Per_Class_counts').fetchall(), [(6,)])
+
+    def test_prediction_index(self):
+        mc = cpa.multiclasssql
+        index = mc.build_prediction_index(self.classifier, n_threads=1, chunk_size=2)
+        eq_(len(index), 5)
+        eq_(sorted(index.sample(2, 10)), [(1, 2), (2, 2), (3, 1)])
+        eq_(index.sample(1, 10, [(2,), (3,)]), [(2, 1)])
+        eq_(len(index.sample(2, 2)), 2)
+        eq_(index.sample(2, 10, [(4,)]), [])
+        # every probability is 0 or 1; the least probable come first, by key
+        index.probabilities[index.object_keys[:, 1] == 2] = 0.75
+        eq_(index.most_uncertain(3), [(1, 2), (2, 2), (1, 1)])
+        eq_(index.most_uncertain(1, [(2,)]), [(2, 2)])
+        # many ties at the cutoff
+        index.probabilities[:] = 0.5
+        eq_(index.most_uncertain(2), [(1, 1), (1, 2)])
+        eq_(index.most_uncertain(3, [(2,), (3,)]), [(2, 1), (2, 2), (3, 1)])
+
+    def test_feature_store(self):
+        import os
+        calls = []
+        predict = self.classifier.Predict
+        self.classifier.Predict = lambda cell_data: calls.append(len(cell_data)) or predict(cell_data)
+        mc = cpa.multiclasssql
+        # the features must come from the store, not the database
+        with mock.patch.object(mc.p, 'feature_store_dir', os.path.join(self.dir, 'store'), create=True), \
+             mock.patch.object(mc.db, 'execute_columnar', side_effect=AssertionError):
+            # the objects of image 2 are in the rows read for images 1 to 3
+            counts = mc.PerImageCounts(self.classifier, 2, image_keys=[(1,), (3,)],
+                                       in_database=False, n_threads=1)
+            eq_(counts, [[2, 0, 0], [1, 1, 1], [3, 0, 1]])
+            eq_(sum(calls), 3)
+            keys = mc.FilterObjectsFromClassN(1, self.classifier, [(1,), (2,)], False)
+            eq_(sorted(keys), [(1, 1), (2, 1)])
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'store', 'Per_Object.features.npy')))
+        # fetching objects reads the database rather than exporting a stale store
+        self.conn.execute('DELETE FROM Per_Object WHERE x IS NULL')
+        self.conn.commit()
+        with mock.patch.object(mc.p, 'feature_store_dir', os.path.join(self.dir, 'store'), create=True), \
+             mock.patch.object(mc.featurestore.FeatureStore, 'build', side_effect=AssertionError):
+            keys = mc.FilterObjectsFromClassN(1, self.classifier, [(1,), (2,)], False)
+            eq_(sorted(keys), [(1, 1)])
+
+    def test_linear_in_database(self):
+        import numpy as np
+        # the same classes as Predict: 2 where x > 0, otherwise (and for NULL) 1
+        self.classifier.LinearModel = lambda: (np.array([[0.0], [2.0]]), np.array([0.0, 0.0]), [1, 2])
+        self.classifier.Predict = None
+        counts = cpa.multiclasssql.PerImageCounts(self.classifier, 2)
+        eq_(counts, [[2, 1, 1], [1, 1, 1], [3, 0, 1]])
+        keys = cpa.multiclasssql.FilterObjectsFromClassN(2, self.classifier, None, False)
+        eq_(sorted(keys), [(1, 2), (2, 2), (3, 1)])
+
+    def test_linear_scores(self):
+        import numpy as np
+        self.classifier.LinearModel = lambda: (np.array([[1.0], [0.0], [-0.5]]),
+                                               np.array([0.0, 0.25, 0.0]), [1, 2, 3])
+        columns, expression = cpa.multiclasssql.linear_scores(self.classifier)
+        eq_(columns, '(0.0 + 1.0*COALESCE(Per_Object.x,0)) AS _score0, (0.25) AS _score1, '
+                     '(0.0 + -0.5*COALESCE(Per_Object.x,0)) AS _score2')
+        eq_(expression, 'CASE WHEN _score0 >= _score1 AND _score0 >= _score2 THEN 1 '
+                        'WHEN _score1 >= _score2 THEN 2 ELSE 3 END')
+
+    def test_linear_pipeline(self):
+        import numpy as np
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.pipeline import make_pipeline
+        from sklearn.preprocessing import StandardScaler
+        from cpa.generalclassifier import _linear_model
+        keys = [(1, 1), (1, 2), (2, 1), (2, 2), (3, 1)]
+        values = np.array([[-1.0], [2.0], [0.0], [3.0], [1.0]])   # NULL counts as 0
+        train = np.array([[-4.0], [-3.0], [0.5], [1.5], [2.5], [9.0], [10.0]])
+        labels = np.array([1, 1, 1, 2, 2, 2, 2])
+        for with_mean in [True, False]:
+            for with_std in [True, False]:
+                pipeline = make_pipeline(StandardScaler(with_mean=with_mean, with_std=with_std),
+                                         LogisticRegression(C=100.0)).fit(train, labels)
+                self.classifier.LinearModel = lambda: _linear_model(pipeline)
+                predicted = pipeline.predict(values)
+                expected = [key for key, c in zip(keys, predicted) if c == 2]
+                self.assertTrue(0 < len(expected) < len(keys))
+                found = cpa.multiclasssql.FilterObjectsFromClassN(2, self.classifier, None, False)
+                eq_(sorted(found), expected)
+
+    def test_cancel(self):
+        def cb(fraction):
+            raise ValueError('canceled')
+        self.assertRaises(ValueError, cpa.multiclasssql.PerImageCounts, self.classifier, 2,
+                          cb=cb, class_names=['negative', 'positive'], n_threads=1, chunk_size=2)
+        tables = self.conn.execute("SELECT name FROM sqlite_master WHERE name='Per_Class'").fetchall()
+        eq_(tables, [])
@@ -0,0 +1,89 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from StringIO import StringIO
+from cpa import sqliteimport
+
+
+class ColumnKindTestCase(unittest.TestCase):
+    def test_kinds(self):
+        self.assertEqual(sqliteimport.column_kind('INTEGER'), 'int')
+        self.assertEqual(sqliteimport.column_kind('BIGINT'), 'int')
+        self.assertEqual(sqliteimport.column_kind('FLOAT'), 'float')
+        self.assertEqual(sqliteimport.column_kind('DOUBLE PRECISION'), 'float')
+        self.assertEqual(sqliteimport.column_kind('VARCHAR(20)'), None)
+        self.assertEqual(sqliteimport.column_kind('TEXT'), None)
+        self.assertEqual(sqliteimport.column_kind('DECIMAL'), 'int')
+
+
+class ParseChunkTestCase(unittest.TestCase):
+    def test_convert(self):
+        rows = sqliteimport.parse_chunk(('1,2.5,a\n\n3.5,x,"b,c"\n',
+                                         ['int', 'float', None]))
+        self.assertEqual(rows, [(1, 2.5, 'a'), (3.5, 'x', 'b,c')])
+
+    def test_nan_kept_as_text(self):
+        rows = sqliteimport.parse_chunk(('nan,\n', ['float', 'float']))
+        self.assertEqual(rows, [('nan', '')])
+
+
+class ReadChunksTestCase(unittest.TestCase):
+    def test_whole_records(self):
+        f = StringIO('1,"a\nb"\n2,c\n3,d\n')
+        chunks = list(sqliteimport.read_chunks(f, chunk_bytes=4))
+        self.assertEqual([text for text, pos in chunks], ['1,"a\nb"\n', '2,c\n3,d\n'])
+        self.assertEqual(chunks[-1][1], 16)
+
+
+class DeferPrimaryKeyTestCase(unittest.TestCase):
+    def test_defer(self):
+        stmt, index = sqliteimport.defer_primary_key(
+            'CREATE TABLE Per_Object (ImageNumber INTEGER,\nObjectNumber INTEGER,'
+            '\nPRIMARY KEY (ImageNumber, ObjectNumber) );')
+        self.assertEqual(stmt, 'CREATE TABLE Per_Object (ImageNumber INTEGER,'
+                               '\nObjectNumber INTEGER );')
+        self.assertEqual(index, 'CREATE UNIQUE INDEX IF NOT EXISTS pk_Per_Object '
+                                'ON Per_Object (ImageNumber, ObjectNumber)')
+
+    def test_no_key(self):
+        stmt = 'CREATE TABLE foo (a INTEGER)'
+        self.assertEqual(sqliteimport.defer_primary_key(stmt), (stmt, None))
+
+
+class SQLiteImporterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.conn = sqlite3.connect(os.path.join(self.dir, 'test.db'))
+        self.conn.execute('CREATE TABLE Per_Object (ImageNumber INTEGER, '
+                          'ObjectNumber INTEGER, x FLOAT, s VARCHAR(8))')
+        self.csv = os.path.join(self.dir, 'object.csv')
+        with open(self.csv, 'w') as f:
+            f.write('ImageNumber,ObjectNumber,x,s\n')
+            for i in range(100):
+                f.write('%d,%d,%s,n%d\n'%(i // 10, i % 10, i * 0.5, i))
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def test_load(self):
+        fractions = []
+        importer = sqliteimport.SQLiteImporter(self.conn, n_workers=0,
+                                               cb=fractions.append,
+                                               chunk_bytes=64)
+        self.assertEqual(importer.load([('Per_Object', self.csv, True)]), 100)
+        rows = self.conn.execute('SELECT * FROM Per_Object').fetchall()
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[11], (1, 1, 5.5, 'n11'))
+        self.assertEqual(fractions[-1], 1.0)
+        self.assertEqual(fractions, sorted(fractions))
+        self.assertEqual(self.conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+
+    def test_cancel(self):
+        def cb(fraction):
+            raise ValueError('cancelled')
+        importer = sqliteimport.SQLiteImporter(self.conn, n_workers=0, cb=cb,
+                                               chunk_bytes=64)
+        self.assertRaises(ValueError, importer.load, [('Per_Object', self.csv, True)])
@@ -0,0 +1,89 @@
+import sqlite3
+import threading
+import unittest
+from mock import patch
+import cpa.tablepager
+from cpa.tablepager import TablePager, seek_clause
+
+
+class SeekClauseTestCase(unittest.TestCase):
+    def test_asc(self):
+        self.assertEqual(seek_clause(['a', 'b'], [1, 'x'], 'ASC'),
+                         "((a > 1) OR (a = 1 AND b > 'x'))")
+
+    def test_desc(self):
+        self.assertEqual(seek_clause(['a'], [1.5], 'DESC'),
+                         "(((a < 1.5 OR a IS NULL)))")
+
+
+class TablePagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE t (id INTEGER, v FLOAT, s TEXT)')
+        # v has ties and NULLs so the key column has to break ties
+        self.rows = [(i, (i % 7 == 0) and None or float(i % 5), 's%d'%(i)) for i in range(1000)]
+        self.conn.executemany('INSERT INTO t VALUES (?, ?, ?)', self.rows)
+        self.queries = []
+        patcher = patch('cpa.tablepager.db')
+        db = patcher.start()
+        self.addCleanup(patcher.stop)
+        def execute(query, silent=False):
+            self.queries.append(query)
+            return self.conn.execute(query).fetchall()
+        db.execute.side_effect = execute
+
+    def expected(self, direction):
+        def key(row):
+            # NULLs sort first ascending
+            return (row[1] is not None, row[1], row[0])
+        return sorted(self.rows, key=key, reverse=(direction == 'DESC'))
+
+    def check(self, direction, order):
+        pager = TablePager('t', ['id', 's'], ['v'], direction, key_columns=['id'],
+                           block_size=30, max_blocks=3, prefetch=False)
+        expected = self.expected(direction)
+        for row in order:
+            self.assertEqual(pager.get_row(row), (expected[row][0], expected[row][2]))
+        self.assertEqual(pager.get_row_count(), 1000)
+        self.assertTrue(len(pager.blocks) <= 3)
+
+    def test_scroll(self):
+        for direction in ['ASC', 'DESC']:
+            self.check(direction, range(1000))
+            self.check(direction, reversed(range(1000)))
+            self.check(direction, [0, 999, 500, 531, 469, 998, 1])
+
+    def test_seek(self):
+        pager = TablePager('t', ['id'], ['v'], key_columns=['id'], where='WHERE id > 99',
+                           row_count=900, block_size=50, prefetch=False)
+        pager.get_row(0)
+        pager.get_row(60)
+        pager.get_row(899)
+        pager.get_row(820)
+        # blocks next to known rows and the last block skip no rows
+        self.assertTrue(' OFFSET 0' in self.queries[-1])
+        self.assertTrue(' OFFSET 0' in self.queries[-2])
+        self.assertEqual(pager.get_values(899, ['id', 'v']),
+                         tuple(self.expected('ASC')[-1][:2]))
+
+    def test_mysql_floats(self):
+        # float sort values aren't used to seek on MySQL
+        with patch('cpa.tablepager.p') as p:
+            p.db_type = 'mysql'
+            for direction in ['ASC', 'DESC']:
+                self.check(direction, [0, 999, 500, 531, 469, 998, 1])
+        self.assertFalse([q for q in self.queries if 'v >' in q or 'v <' in q])
+        # but other values are
+        with patch('cpa.tablepager.p') as p:
+            p.db_type = 'mysql'
+            pager = TablePager('t', ['v'], ['id'], key_columns=['id'], block_size=50,
+                               prefetch=False)
+        pager.get_row(0)
+        pager.get_row(60)
+        self.assertTrue('id > 49' in self.queries[-1])
+
+    def test_no_keys(self):
+        pager = TablePager('t', ['id'], ['id'], prefetch=False, block_size=100)
+        self.assertEqual(pager.get_row(950), (950,))
+        self.assertTrue(self.queries[-1].endswith('LIMIT 100 OFFSET 900'))
+        self.assertRaises(IndexError, pager.get_row, 1000)
@@ -0,0 +1,183 @@
+import base64
+import cPickle
+import shutil
+import tempfile
+import unittest
+import zlib
+import numpy as np
+from mock import patch
+import cpa.trainingset
+from cpa.trainingset import CellCache, TrainingSet
+
+
+class DBTestCase(unittest.TestCase):
+    '''Patches the database with objects (i, o) in images 1 and 2.'''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        # object (i, o) has measurements a = 10 * i + o and b = -o
+        self.fetched = []
+        def GetCellDataBatch(keys, columns):
+            self.fetched += keys
+            return np.array([[10 * i + o, -o] if o < 5 else [np.nan, np.nan]
+                             for i, o in keys], dtype=float).reshape((len(keys), 2))
+        self.stamp = 1.0
+
+        patchers = [patch('cpa.trainingset.db'), patch('cpa.trainingset.p'),
+                    patch('cpa.trainingset.table_source'),
+                    patch('cpa.trainingset.table_summary'),
+                    patch('cpa.trainingset.object_key_columns'),
+                    patch('cpa.trainingset.Properties.getInstance')]
+        db, p, table_source, table_summary, object_key_columns, getInstance = [
+            patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        db.GetColnamesForClassifier.return_value = ['a', 'b']
+        db.GetCellDataBatch.side_effect = GetCellDataBatch
+        db.get_objects_modify_date.side_effect = lambda: self.stamp
+        db.verify_objects_modify_date_earlier.side_effect = lambda date: self.stamp <= date
+        db.GetObjectCoordsBatch.side_effect = lambda keys: [(o, i) for i, o in keys]
+        object_key_columns.return_value = ('ImageNumber', 'ObjectNumber')
+        p.object_table = 'obj'
+        p.db_type = 'mysql'
+        p._filename = None
+        p.cell_cache_dir = self.dir
+        getInstance.return_value = p
+        self.p = p
+        table_source.return_value = {'object_table' : 'obj'}
+        table_summary.return_value = [5, [1, 1], [2, 4]]
+        self.addCleanup(self.forget)
+
+    def forget(self):
+        if CellCache._isInstantiated():
+            if CellCache.getInstance().store is not None:
+                CellCache.getInstance().store.close()
+            CellCache._forgetClassInstanceReferenceForTesting()
+
+    def restart(self):
+        self.forget()
+        self.fetched = []
+        return CellCache.getInstance()
+
+
+class CellCacheTestCase(DBTestCase):
+    def test_get_objects_data(self):
+        cache = CellCache.getInstance()
+        values = cache.get_objects_data([(1, 2), (2, 1), (1, 9), (1, 2)])
+        np.testing.assert_array_equal(values[[0, 1, 3]], [[12, -2], [21, -1], [12, -2]])
+        self.assertTrue(np.isnan(values[2]).all())
+        self.assertEqual(self.fetched, [(1, 2), (2, 1), (1, 9)])
+        self.fetched = []
+        np.testing.assert_array_equal(cache.get_objects_data([(2, 1)]), [[21, -1]])
+        self.assertTrue(np.isnan(cache.get_objects_data([(1, 9)])).all())
+        self.assertEqual(self.fetched, [])
+
+    def test_store(self):
+        CellCache.getInstance().get_objects_data([(1, 2), (2, 1)])
+        cache = self.restart()
+        np.testing.assert_array_equal(cache.get_objects_data([(2, 1), (1, 3)]), [[21, -1], [13, -3]])
+        self.assertEqual(self.fetched, [(1, 3)])
+        # the store is emptied once the object table has changed
+        self.stamp = 2.0
+        cache = self.restart()
+        cache.get_objects_data([(2, 1)])
+        self.assertEqual(self.fetched, [(2, 1)])
+
+    def test_store_unknown_modify_date(self):
+        self.stamp = None
+        CellCache.getInstance().get_objects_data([(2, 1)])
+        cache = self.restart()
+        cache.get_objects_data([(2, 1)])
+        self.assertEqual(self.fetched, [(2, 1)])
+
+    def test_memory_budget(self):
+        self.p.cell_cache_dir = None
+        cache = CellCache.getInstance()
+        cache.MEMORY_BUDGET = 3 * 8
+        cache.get_objects_data([(1, 1), (1, 2), (1, 3)])
+        cache.get_objects_data([(1, 1)])
+        cache.get_objects_data([(1, 4)])
+        self.assertEqual(list(cache.data.keys()), [(1, 3), (1, 1), (1, 4)])
+        self.assertEqual(cache.nbytes, 3 * 8)
+
+    def test_save_to_string(self):
+        self.p.cell_cache_dir = None
+        cache = CellCache.getInstance()
+        cache.get_objects_data([(1, 1), (1, 2)])
+        string = cache.save_to_string([(1, 2), (1, 3)])
+        cache = self.restart()
+        cache.load_from_string(string)
+        np.testing.assert_array_equal(cache.get_objects_data([(1, 2)]), [[12, -2]])
+        self.assertEqual(self.fetched, [])
+        # not if the object table has changed since
+        cache = self.restart()
+        self.stamp = 2.0
+        cache.load_from_string(string)
+        self.assertEqual(len(cache.data), 0)
+
+    def test_load_legacy_string(self):
+        # training sets used to cache every column of the object table
+        self.p.cell_cache_dir = None
+        cache = CellCache.getInstance()
+        oldcache = {(1, 2) : np.array([1, 2, -2, 12, 0.5])}
+        string = base64.b64encode(zlib.compress(cPickle.dumps(
+            (1.0, ['ImageNumber', 'ObjectNumber', 'b', 'a', 'c'], oldcache))))
+        cache.load_from_string(string)
+        np.testing.assert_array_equal(cache.get_objects_data([(1, 2)]), [[12, -2]])
+        self.assertEqual(self.fetched, [])
+
+
+class TrainingSetTestCase(DBTestCase):
+    def setUp(self):
+        DBTestCase.setUp(self)
+        self.p.cell_cache_dir = None
+        self.training_set = TrainingSet(self.p)
+        self.training_set.Create(['pos', 'neg'], [[(1, 2), (2, 1)], [(1, 4)]])
+        self.filename = self.dir + '/training_set'
+
+    def check(self, training_set):
+        eq = np.testing.assert_array_equal
+        eq(training_set.labels, ['pos', 'neg'])
+        self.assertEqual(training_set.entries, [('pos', (1, 2)), ('pos', (2, 1)), ('neg', (1, 4))])
+        self.assertEqual(training_set.coordinates, [(2, 1), (1, 2), (4, 1)])
+        eq(training_set.label_array, [1, 1, 2])
+        eq(training_set.label_matrix, [[1, -1], [1, -1], [-1, 1]])
+        eq(training_set.values, [[12, -2], [21, -1], [14, -4]])
+
+    def test_text(self):
+        self.training_set.Save(self.filename)
+        self.check(TrainingSet(self.p, self.filename))
+
+    def test_binary(self):
+        self.training_set.SaveBinary(self.filename)
+        self.assertTrue(cpa.trainingset.is_binary_training_set(self.filename))
+        self.restart()
+        training_set = TrainingSet(self.p, self.filename)
+        self.check(training_set)
+        # the saved measurements are used while the object table is unchanged
+        self.assertEqual(self.fetched, [])
+        self.assertEqual(cpa.trainingset.db.GetObjectCoordsBatch.call_count, 1)
+
+        training_set = TrainingSet(self.p, self.filename, labels_only=True)
+        self.assertEqual(len(training_set.values), 0)
+        self.assertEqual(len(training_set.entries), 3)
+
+        self.stamp = 2.0
+        self.restart()
+        self.check(TrainingSet(self.p, self.filename))
+        self.assertEqual(self.fetched, [(1, 2), (2, 1), (1, 4)])
+
+    def test_binary_unknown_modify_date(self):
+        self.stamp = None
+        self.training_set.SaveBinary(self.filename)
+        self.restart()
+        self.check(TrainingSet(self.p, self.filename))
+        self.assertEqual(self.fetched, [(1, 2), (2, 1), (1, 4)])
+
+    def test_binary_labels_only(self):
+        self.training_set.Create(['pos', 'neg'], [[(1, 2)], [(1, 4)]], labels_only=True)
+        self.training_set.SaveBinary(self.filename)
+        self.restart()
+        training_set = TrainingSet(self.p, self.filename)
+        np.testing.assert_array_equal(training_set.values, [[12, -2], [14, -4]])
+        self.assertEqual(self.fetched, [(1, 2), (1, 4)])
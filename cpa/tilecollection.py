@@ -15,6 +15,8 @@ import javabridge
 db = DBConnect.getInstance()
 p = Properties.getInstance()
 
+LOAD_BATCH_SIZE = 50   # tiles taken from the load queue at a time
+
 def load_lock():
     return TileCollection.getInstance().load_lock
 
@@ -126,35 +128,58 @@ class TileLoader(threading.Thread):
                     logging.info('%s aborted'%self.getName())
                     return
 
-                data = heappop(self.tile_collection.loadq)
-                obKey = data[1]
-                display_whole_image = data[2] #display whole image instead of object image
+                # Take the next few tiles so their coordinates can be looked
+                # up together
+                batch = [heappop(self.tile_collection.loadq) for i in 
+                         range(min(LOAD_BATCH_SIZE, len(self.tile_collection.loadq)))]
 
                 self.tile_collection.cv.release()
 
-                # wait until loading has completed before continuing
-                with self.tile_collection.load_lock:
-                    # Make sure tile hasn't been deleted outside this thread
-                    if not self.tile_collection.tileData.get(obKey, None):
-                        continue
-
-                    # Get the tile
-                    new_data = imagetools.FetchTile(obKey, display_whole_image=display_whole_image)
-                    if new_data is None:
-                        #if fetching fails, leave the tile blank
-                        continue
-
-                    tile_data = self.tile_collection.tileData.get(obKey, None)
-
-                    # Make sure tile hasn't been deleted outside this thread
-                    if tile_data is not None:
-                        # copy each channel
-                        for i in range(len(tile_data)):
-                            tile_data[i] = new_data[i]
-                        wx.PostEvent(self.notify_window, TileUpdatedEvent(obKey))
+                coords = self.fetch_coords([obKey for priority, obKey, display_whole_image in batch
+                                            if not display_whole_image and
+                                            self.tile_collection.tileData.get(obKey, None)])
+
+                for priority, obKey, display_whole_image in batch:
+                    # wait until loading has completed before continuing
+                    with self.tile_collection.load_lock:
+                        # Make sure tile hasn't been deleted outside this thread
+                        if not self.tile_collection.tileData.get(obKey, None):
+                            continue
+
+                        # Get the tile
+                        new_data = imagetools.FetchTile(obKey, display_whole_image=display_whole_image,
+                                                        pos=coords.get(obKey, None))
+                        if new_data is None:
+                            #if fetching fails, leave the tile blank
+                            continue
+
+                        tile_data = self.tile_collection.tileData.get(obKey, None)
+
+                        # Make sure tile hasn't been deleted outside this thread
+                        if tile_data is not None:
+                            # copy each channel
+                            for i in range(len(tile_data)):
+                                tile_data[i] = new_data[i]
+                            wx.PostEvent(self.notify_window, TileUpdatedEvent(obKey))
         finally:
             javabridge.detach()
 
+    def fetch_coords(self, obKeys):
+        '''
+        Returns {obKey : (x, y)} for the objects that have coordinates.
+        Objects left out are looked up again by FetchTile, which reports
+        the problem.
+        '''
+        if not obKeys:
+            return {}
+        try:
+            coords = db.GetObjectCoordsBatch(obKeys, none_ok=True, silent=True)
+        except Exception as e:
+            logging.error('Failed to look up tile coordinates: %s'%(e))
+            return {}
+        return dict([(obKey, tuple(xy)) for obKey, xy in zip(obKeys, coords) 
+                     if not numpy.isnan(xy).any()])
+
     def abort(self):
         self._want_abort = True
         self.tile_collection.cv.acquire()
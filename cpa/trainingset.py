@@ -7,13 +7,62 @@ import base64
 import zlib
 import wx
 import collections
+import json
+import os
+import sqlite3
+import threading
 
 import pandas as pd
 from dbconnect import *
+from featurestore import table_source, table_summary
 from singleton import Singleton
 
 db = DBConnect.getInstance()
 
+BINARY_MAGIC = b'PK\x03\x04'    # binary training sets are numpy .npz (zip) files
+
+
+def modify_stamp():
+    '''
+    Returns the modify date of the object table as a string, or None if it is
+    unknown (eg: MySQL doesn't record update times for all table types).
+    '''
+    date = db.get_objects_modify_date()
+    return None if date is None else str(date)
+
+def db_fingerprint():
+    '''
+    Identifies the object table and its state, for data read from it that
+    is kept elsewhere (see fingerprint_matches).
+    '''
+    return {'source' : table_source(), 'stamp' : modify_stamp(),
+            'summary' : table_summary() if p.db_type.lower() == 'sqlite' else None}
+
+def fingerprint_matches(fingerprint):
+    '''
+    Returns whether the object table is the same, and hasn't changed, since
+    fingerprint was taken with db_fingerprint.  SQLite only records when
+    the database file changed (eg: when a class table was written), so if
+    that has changed a SQLite table is still accepted if it has the same
+    number of objects and the same first and last object keys (like
+    FeatureStore.is_valid).  If the modify date of the table is unknown,
+    there is no telling whether it has changed, so it never matches.
+    '''
+    if fingerprint.get('source') != json.loads(json.dumps(table_source())):
+        return False
+    stamp = modify_stamp()
+    if stamp is None or fingerprint.get('stamp') in (None, 'None'):
+        return False
+    if fingerprint.get('stamp') == stamp:
+        return True
+    return (p.db_type.lower() == 'sqlite' and
+            fingerprint.get('summary') == json.loads(json.dumps(table_summary())))
+
+def is_binary_training_set(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
 class TrainingSet:
     "A class representing a set of manually labeled cells."
 
@@ -26,6 +75,8 @@ class TrainingSet:
         if filename != '':
             if csv:
                 self.LoadCSV(filename, labels_only=labels_only)
+            elif is_binary_training_set(filename):
+                self.LoadBinary(filename, labels_only=labels_only)
             else:
                 self.Load(filename, labels_only=labels_only)
 
@@ -69,28 +120,18 @@ class TrainingSet:
         self.labels = numpy.array(labels)
         self.classifier_labels = 2 * numpy.eye(len(labels), dtype=numpy.int) - 1
         
-        num_to_fetch = sum([len(k) for k in keyLists])
-        num_fetched = [0] # use a list to get static scoping
-
         # Populate the label_matrix, entries, and values
         # NB: values that are nonnumeric or Null/None are made to be 0
         for label, cl_label, keyList in zip(labels, self.classifier_labels, keyLists):
             self.label_matrix += ([cl_label] * len(keyList))
-
             self.entries += zip([label] * len(keyList), keyList)
 
-            if labels_only:
-                self.values += []
-                self.coordinates += [db.GetObjectCoords(k) for k in keyList]
-            else:
-                def get_data(k):
-                    d = self.cache.get_object_data(k)
-                    if callback is not None:
-                        callback(num_fetched[0] / float(num_to_fetch))
-                    num_fetched[0] = num_fetched[0] + 1
-                    return d
-                self.values += [get_data(k) for k in keyList]
-                self.coordinates += [db.GetObjectCoords(k) for k in keyList]
+        # Look up the data and coordinates of all objects in batches rather
+        # than one query per object
+        obKeys = self.get_object_keys()
+        if not labels_only:
+            self.values = self.cache.get_objects_data(obKeys, callback)
+        self.coordinates = [tuple(xy) for xy in db.GetObjectCoordsBatch(obKeys)]
 
         self.label_matrix = numpy.array(self.label_matrix)
         self.values = numpy.array(self.values, np.float64)
@@ -123,7 +164,7 @@ class TrainingSet:
                     continue
                 
                 obKey = tuple([int(float(k)) for k in l.strip().split(' ')[1:len(object_key_columns())+1]])
-                labelDict[label] = labelDict.get(label, []) + [obKey]
+                labelDict.setdefault(label, []).append(obKey)
 
             except:
                 logging.error('Error parsing training set %s, line >>>%s<<<'%(filename, l.strip()))
@@ -136,6 +177,58 @@ class TrainingSet:
         
         f.close()
         
+    def LoadBinary(self, filename, labels_only=False):
+        '''
+        Loads a training set saved by SaveBinary.  The measurements saved
+        with it are used if the object table hasn't changed since and the
+        classifier columns are the same, otherwise they are fetched again.
+        '''
+        self.Clear()
+        data = numpy.load(filename)
+        try:
+            labels = data['labels'].tolist()
+            label_index = data['label_index']
+            keys = data['keys']
+            coordinates = data['coordinates']
+            values = data['values']
+            colnames = data['colnames'].tolist()
+            fingerprint = json.loads(str(data['fingerprint']))
+        except:
+            logging.error('Error parsing training set %s'%(filename))
+            raise
+        finally:
+            data.close()
+        self.key_labels = object_key_columns()
+
+        try:
+            fresh = (colnames == list(self.colnames) and fingerprint_matches(fingerprint) and
+                     (labels_only or len(values) == len(keys)))
+        except:
+            logging.info("Couldn't check whether training set %s is up to date, DB "
+                         "connection lost?"%(filename))
+            fresh = False
+        if not fresh:
+            labelDict = collections.OrderedDict()
+            for i, label in enumerate(labels):
+                labelDict[label] = [tuple(k) for k in keys[label_index == i + 1].tolist()]
+            self.Renumber(labelDict)
+            self.Create(labelDict.keys(), labelDict.values(), labels_only=labels_only)
+            return
+
+        # entries are grouped by class, as in Create
+        order = numpy.argsort(label_index, kind='mergesort')
+        self.labels = numpy.array(labels)
+        self.classifier_labels = 2 * numpy.eye(len(labels), dtype=numpy.int) - 1
+        self.label_array = label_index[order]
+        self.label_matrix = self.classifier_labels[self.label_array - 1].reshape((len(order), len(labels)))
+        self.entries = [(labels[i - 1], tuple(k))
+                        for i, k in zip(self.label_array.tolist(), keys[order].tolist())]
+        self.coordinates = [tuple(xy) for xy in coordinates[order].tolist()]
+        if labels_only:
+            self.values = numpy.array([], numpy.float64)
+        else:
+            self.values = values[order].astype(numpy.float64)
+
     def LoadCSV(self, filename, labels_only=True):
         self.Clear()
         df = pd.read_csv(filename)
@@ -236,6 +329,39 @@ class TrainingSet:
         logging.info('Training set saved to %s'%filename)
         self.saved = True
 
+    def SaveBinary(self, filename):
+        '''
+        Saves the training set in a binary format, read by LoadBinary: a
+        numpy .npz file of the class labels, the object keys, coordinates
+        and measurements, and a fingerprint of the object table (see
+        db_fingerprint) to tell whether the measurements are still current.
+        '''
+        n = len(self.entries)
+        try:
+            fingerprint = db_fingerprint()
+        except:
+            logging.info("Couldn't fingerprint the object table, DB connection lost?")
+            fingerprint = {}
+        values = numpy.array(self.values, numpy.float32)
+        if len(values) != n:
+            values = numpy.zeros((0, len(self.colnames)), numpy.float32)
+        f = open(filename, 'wb')
+        try:
+            numpy.savez(f, labels=numpy.array(self.labels),
+                        label_index=numpy.array(self.label_array, numpy.int32).reshape(n),
+                        keys=numpy.array(self.get_object_keys(), numpy.int64).reshape((n, len(self.key_labels))),
+                        coordinates=numpy.array(self.coordinates, numpy.int64).reshape((n, 2)),
+                        values=values.reshape((len(values), len(self.colnames))),
+                        colnames=numpy.array(self.colnames),
+                        fingerprint=numpy.array(json.dumps(fingerprint)))
+        except:
+            logging.error("Error saving training set %s" % (filename))
+            f.close()
+            raise
+        f.close()
+        logging.info('Training set saved to %s'%filename)
+        self.saved = True
+
     def SaveAsCSV(self, filename):
         # check cache freshness
         try:
@@ -283,62 +409,262 @@ class TrainingSet:
     def get_object_keys(self):
         return [e[1] for e in self.entries]
 
+class CellStore(object):
+    '''
+    A SQLite file of the classifier columns of objects, as float32 vectors
+    keyed by object key, holding the cell data looked up by CellCache
+    between sessions.  The file is emptied when it was written for another
+    object table or other classifier columns, or when the object table has
+    changed since (see fingerprint_matches).
+    '''
+    QUERY_SIZE = 500    # keys looked up per query (SQLite allows 999 parameters)
+
+    def __init__(self, filename, columns):
+        self.filename = filename
+        self.columns = list(columns)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cells (obkey TEXT PRIMARY KEY, data BLOB)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+        self.validate()
+
+    def _metadata(self):
+        return dict([(name, json.loads(value)) for name, value in
+                     self.conn.execute('SELECT name, value FROM metadata')])
+
+    def validate(self):
+        '''
+        Empties the store unless it holds data of the current classifier
+        columns of the object table, and the table hasn't changed since (see
+        fingerprint_matches).
+        '''
+        with self.lock:
+            metadata = self._metadata()
+            if (metadata.get('columns') == self.columns and
+                fingerprint_matches(metadata.get('fingerprint', {}))):
+                stamp = modify_stamp()
+                if metadata['fingerprint']['stamp'] != stamp:
+                    metadata['fingerprint']['stamp'] = stamp
+                    self.conn.execute('UPDATE metadata SET value = ? WHERE name = ?',
+                                      (json.dumps(metadata['fingerprint']), 'fingerprint'))
+                    self.conn.commit()
+                return
+            if metadata:
+                logging.info('Cell cache %s is out of date, emptying it'%(self.filename))
+            self.conn.execute('DELETE FROM cells')
+            self.conn.execute('DELETE FROM metadata')
+            self.conn.executemany('INSERT INTO metadata VALUES (?, ?)',
+                                  [('columns', json.dumps(self.columns)),
+                                   ('fingerprint', json.dumps(db_fingerprint()))])
+            self.conn.commit()
+
+    def get_many(self, keys):
+        '''Returns a dict of the stored vectors of those of keys in the store.'''
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), self.QUERY_SIZE):
+                batch = dict([(_key_text(k), k) for k in keys[start : start + self.QUERY_SIZE]])
+                query = 'SELECT obkey, data FROM cells WHERE obkey IN (%s)'%(
+                    ', '.join(['?'] * len(batch)))
+                for text, data in self.conn.execute(query, list(batch.keys())):
+                    found[batch[text]] = numpy.frombuffer(data, dtype='f4')
+        return found
+
+    def put_many(self, keys, values):
+        '''Stores the rows of values (a float32 array) under keys.'''
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO cells VALUES (?, ?)',
+                                  [(_key_text(k), sqlite3.Binary(row.tobytes()))
+                                   for k, row in zip(keys, values)])
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def _key_text(key):
+    return ','.join([str(int(k)) for k in key])
+
+
 class CellCache(Singleton):
-    ''' caching front end for holding cell data '''
+    '''
+    Caching front end for holding cell data: the classifier columns of
+    objects, as float32 vectors.  The most recently used are kept in memory,
+    up to MEMORY_BUDGET bytes.  If Properties.cell_cache_dir is set, every
+    vector is also kept in a CellStore in that directory (relative to the
+    properties file), so the cell data of training sets doesn't have to be
+    fetched again in later sessions.
+    '''
+    BATCH_SIZE = 5000   # objects fetched per query by get_objects_data
+    MEMORY_BUDGET = 128 * 2**20   # bytes of cell data kept in memory
+
     def __init__(self):
-        self.data        = {}
-        self.colnames    = db.GetColumnNames(p.object_table)
-        if db.GetColnamesForClassifier() is not None:
-            self.col_indices = [self.colnames.index(v) for v in db.GetColnamesForClassifier()]
-        else:
-            self.col_indices = []
+        self.data        = collections.OrderedDict()
+        self.nbytes      = 0
+        self.lock        = threading.RLock()
+        self.colnames    = db.GetColnamesForClassifier() or []
         self.last_update = db.get_objects_modify_date()
+        self.store       = None
+        self._store_filename = None
+
+    def get_store(self):
+        '''
+        Returns the CellStore in Properties.cell_cache_dir, opening it if
+        needed, or None if that isn't set or the store can't be opened.
+        '''
+        if not p.cell_cache_dir:
+            return None
+        directory = p.cell_cache_dir
+        if p._filename and not os.path.isabs(directory):
+            directory = os.path.join(os.path.dirname(p._filename), directory)
+        filename = os.path.join(directory, '%s.cells.sqlite'%(p.object_table))
+        if self._store_filename != filename:
+            self._store_filename = filename
+            if self.store is not None:
+                self.store.close()
+            self.store = None
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self.store = CellStore(filename, self.colnames)
+            except (EnvironmentError, sqlite3.Error, DBException) as e:
+                logging.error('Could not open the cell cache %s, keeping cell data in '
+                              'memory only: %s'%(filename, e))
+        return self.store
+
+    def _remember(self, key, row):
+        '''Keeps a vector in memory, forgetting the least recently used ones over budget.'''
+        old = self.data.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self.data[key] = row
+        self.nbytes += row.nbytes
+        while self.nbytes > self.MEMORY_BUDGET and len(self.data) > 1:
+            self.nbytes -= self.data.popitem(last=False)[1].nbytes
+
+    def get_many(self, keys):
+        '''
+        Returns a dict of the cached vectors of those of keys (object key
+        tuples) that are in memory or in the store.
+        '''
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.data:
+                    found[key] = self.data.pop(key)
+                    self.data[key] = found[key]
+            missing = [k for k in keys if k not in found]
+            store = self.get_store()
+            if store is not None and len(missing) > 0:
+                for key, row in store.get_many(missing).items():
+                    self._remember(key, row)
+                    found[key] = row
+        return found
+
+    def put_many(self, keys, values):
+        '''Caches the rows of values (vectors of the classifier columns) under keys.'''
+        values = numpy.asarray(values, dtype='f4')
+        with self.lock:
+            for key, row in zip(keys, values):
+                self._remember(key, row)
+            store = self.get_store()
+            if store is not None:
+                store.put_many(keys, values)
 
     def load_from_string(self, str):
-        'load data from a string, verifying that the table has not changed since it was created (encoded in string)'
+        '''
+        Load data from a string written by save_to_string, verifying that the
+        table has not changed since it was created (encoded in string).
+        Strings of versions that cached every column of the object table are
+        also read.
+        '''
         try:
-            date, colnames, oldcache = cPickle.loads(zlib.decompress(base64.b64decode(str)))
+            data = cPickle.loads(zlib.decompress(base64.b64decode(str)))
+            if len(data) == 4:
+                date, colnames, keys, values = data
+            else:
+                date, colnames, oldcache = data
+                keys = list(oldcache.keys())
+                # Strings started sneaking into some caches when we started
+                # classifying entire images.  Detect this case and force an
+                # update to flush them.
+                if len(keys) > 0 and oldcache[keys[0]].dtype.kind == 'S':
+                    return
+                values = numpy.array([oldcache[k] for k in keys]).reshape((len(keys), -1))
+            values = values[:, [list(colnames).index(col) for col in self.colnames]]
         except:
             # silent failure
             return
-        # Strings started sneaking into some caches when we started classifying entire images.
-        # Detect this case and force an update to flush them.
-        if len(oldcache) > 0:
-            if oldcache.values()[0].dtype.kind == 'S':
-                return
         # verify the database hasn't been changed
-        if db.verify_objects_modify_date_earlier(date):
-            self.data.update(oldcache)
-            self.colnames = colnames
+        if len(keys) > 0 and db.verify_objects_modify_date_earlier(date):
+            self.put_many([tuple(k) for k in keys], values)
 
     def save_to_string(self, keys):
-        'convert the cache data to a string, but only for certain keys'
-        temp = {}
-        for k in keys:
-            if k in self.data:
-                temp[k] = self.data[k]
-        output = (db.get_objects_modify_date(), self.colnames, temp)
-        return base64.b64encode(zlib.compress(cPickle.dumps(output)))
+        '''convert the cache data to a string, but only for certain keys'''
+        found = self.get_many(list(collections.OrderedDict.fromkeys(keys)))
+        keys = list(found.keys())
+        values = numpy.array([found[k] for k in keys], dtype='f4').reshape((len(keys), len(self.colnames)))
+        output = (db.get_objects_modify_date(), self.colnames, keys, values)
+        return base64.b64encode(zlib.compress(cPickle.dumps(output, cPickle.HIGHEST_PROTOCOL)))
 
     def get_object_data(self, key):
-        if key not in self.data:
-            self.data[key] = db.GetCellData(key)
-        return self.data[key][self.col_indices]
+        return self.get_objects_data([key])[0]
+
+    def get_objects_data(self, keys, callback=None):
+        '''
+        Returns the data of many objects as a 2-D array, fetching the ones
+        that aren't cached with DBConnect.GetCellDataBatch, BATCH_SIZE keys
+        per query.
+        callback -- called with the fraction of objects fetched so far
+        '''
+        found = self.get_many(list(collections.OrderedDict.fromkeys(keys)))
+        missing = [k for k in collections.OrderedDict.fromkeys(keys) if k not in found]
+        for start in range(0, len(missing), self.BATCH_SIZE):
+            batch = missing[start : start + self.BATCH_SIZE]
+            # Rows of NaN (objects whose features are all NULL or that aren't
+            # in the object table) are cached too, so they aren't refetched.
+            rows = db.GetCellDataBatch(batch, self.colnames).astype('f4')
+            self.put_many(batch, rows)
+            found.update(zip(batch, rows))
+            if callback is not None:
+                callback((start + len(batch)) / float(len(missing)))
+        values = numpy.empty((len(keys), len(self.colnames)))
+        values.fill(numpy.nan)
+        for i, key in enumerate(keys):
+            if key in found:
+                values[i] = found[key]
+        return values
 
     def clear_if_objects_modified(self):
         if not db.verify_objects_modify_date_earlier(self.last_update):
-            self.data = {}
-            self.last_update = db.get_objects_modify_date()
+            with self.lock:
+                self.data = collections.OrderedDict()
+                self.nbytes = 0
+                self.last_update = db.get_objects_modify_date()
+                if self.store is not None:
+                    self.store.validate()
         
 
 if __name__ == "__main__":
+    # usage: trainingset.py PROPERTIES TRAINING_SET [OUTPUT]
+    # Prints the training set, or converts it to OUTPUT: a binary training
+    # set if it ends in .npz, CSV if it ends in .csv, else text.
     from sys import argv
     from properties import Properties
     p = Properties.getInstance()
     p.LoadFile(argv[1])
-    tr = TrainingSet(p)
-    tr.Load(argv[2])
-    for i in range(len(tr.labels)):
-        print(tr.labels[i], end=' ')
-        print(" ".join([str(v) for v in tr.values[i]]))
-        
+    tr = TrainingSet(p, argv[2], csv=argv[2].endswith('.csv'))
+    if len(argv) > 3:
+        if argv[3].endswith('.npz'):
+            tr.SaveBinary(argv[3])
+        elif argv[3].endswith('.csv'):
+            tr.SaveAsCSV(argv[3])
+        else:
+            tr.Save(argv[3])
+    else:
+        for i in range(len(tr.labels)):
+            print(tr.labels[i], end=' ')
+            print(" ".join([str(v) for v in tr.values[i]]))